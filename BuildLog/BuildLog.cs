@@ -0,0 +1,112 @@
+#nullable enable
+
+using System;
+using System.Collections.Generic;
+using System.IO;
+using System.Linq;
+using System.Text.Json;
+using Microsoft.Build.Framework;
+using Microsoft.Build.Logging;
+
+namespace SpaceEngineers.BuildLog;
+
+// Read MSBuild binary logs (-bl) and print, for each project built, its wall
+// time, the time spent compiling it (its Csc tasks), whether it succeeded and
+// its errors, with the full path of their file and their position. The
+// errors which belong to no project (bad command line...) are under "".
+public class Program
+{
+    public static void Main(string[] args)
+    {
+        if (args.Length == 0)
+        {
+            Console.WriteLine($"Usage: <binlog path>...");
+            Environment.Exit(1);
+        }
+        var projects = new SortedDictionary<string, Project>(StringComparer.Ordinal);
+        foreach (var path in args)
+            Read(path, projects);
+        var result = new SortedDictionary<string, object>(StringComparer.Ordinal);
+        foreach (var (file, project) in projects)
+        {
+            result[file] = new Dictionary<string, object>
+            {
+                ["duration"] = Math.Max(0, (project.End - project.Start).TotalSeconds),
+                ["compile"] = project.Compile.TotalSeconds,
+                ["succeeded"] = project.Succeeded,
+                ["errors"] = project.Errors,
+            };
+        }
+        Console.WriteLine(JsonSerializer.Serialize(result));
+    }
+
+    static void Read(string path, SortedDictionary<string, Project> projects)
+    {
+        // a newer SDK than this MSBuild may have written it: the events used
+        // here haven't changed
+        var replay = new BinaryLogReplayEventSource { AllowForwardCompatibility = true };
+        var compiling = new Dictionary<(int, int, int), DateTime>();
+
+        Project Get(string? file)
+        {
+            file = string.IsNullOrEmpty(file) ? "" : Path.GetFullPath(file);
+            if (!projects.TryGetValue(file, out var project))
+                projects[file] = project = new Project();
+            return project;
+        }
+
+        static (int, int, int) Task(BuildEventContext? context)
+        {
+            return context == null ? (0, 0, 0) : (context.NodeId, context.ProjectContextId, context.TaskId);
+        }
+
+        // a project is started once per target list (restore, then build)
+        replay.ProjectStarted += (_, e) =>
+        {
+            var project = Get(e.ProjectFile);
+            if (project.Start == default || e.Timestamp < project.Start)
+                project.Start = e.Timestamp;
+        };
+        replay.ProjectFinished += (_, e) =>
+        {
+            var project = Get(e.ProjectFile);
+            if (e.Timestamp > project.End)
+                project.End = e.Timestamp;
+            project.Succeeded &= e.Succeeded;
+        };
+        replay.TaskStarted += (_, e) =>
+        {
+            if (e.TaskName == "Csc")
+                compiling[Task(e.BuildEventContext)] = e.Timestamp;
+        };
+        replay.TaskFinished += (_, e) =>
+        {
+            if (e.TaskName == "Csc" && compiling.Remove(Task(e.BuildEventContext), out var start))
+                Get(e.ProjectFile).Compile += e.Timestamp - start;
+        };
+        replay.ErrorRaised += (_, e) =>
+        {
+            var file = e.File ?? "";
+            if (file != "" && !Path.IsPathRooted(file) && !string.IsNullOrEmpty(e.ProjectFile))
+                file = Path.Join(Path.GetDirectoryName(e.ProjectFile), file);
+            Get(e.ProjectFile).Errors.Add(new Dictionary<string, object>
+            {
+                ["file"] = file == "" ? "" : Path.GetFullPath(file),
+                ["line"] = e.LineNumber,
+                ["column"] = e.ColumnNumber,
+                ["code"] = e.Code ?? "",
+                ["message"] = e.Message ?? "",
+            });
+        };
+        replay.Replay(path);
+    }
+}
+
+class Project
+{
+    public DateTime Start;
+    public DateTime End;
+    public TimeSpan Compile;
+    public bool Succeeded = true;
+    public readonly List<Dictionary<string, object>> Errors = new();
+}
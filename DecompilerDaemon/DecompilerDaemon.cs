@@ -0,0 +1,306 @@
+#nullable enable
+
+using System;
+using System.Collections.Generic;
+using System.Globalization;
+using System.IO;
+using System.Linq;
+using System.Net.Sockets;
+using System.Reflection.PortableExecutable;
+using System.Text;
+using System.Text.Json;
+using System.Threading;
+using System.Threading.Tasks;
+using ICSharpCode.Decompiler;
+using ICSharpCode.Decompiler.Metadata;
+using ICSharpCode.Decompiler.TypeSystem;
+using SpaceEngineers.DecompilerHost;
+
+namespace SpaceEngineers.DecompilerDaemon;
+
+// Serve the requests of decompile.py client on a Unix socket, keeping the
+// assemblies and their type systems loaded in between. One JSON object per
+// line each way:
+//   {"command": "type", "assembly": path, "type": full name} -> {"source"}, as
+//       it is in the project
+//   {"command": "assembly", "assembly": path, "output": directory} -> {"project"}
+//       like ilspycmd --project --nested-directories
+//   {"command": "references", "roots": [path...]} -> {"graph"}, like ListReferences
+//   {"command": "extract-types", "game": directory[, "verify": true]} ->
+//       {"source"}, like ExtractTypes [--verify]
+//   {"command": "stop"} -> {}
+// or {"error": message}. The decompiler flags are those of DecompilerHost,
+// given once on the command line. An assembly not used for --idle-timeout seconds
+// is unloaded, and the daemon exits when nothing is loaded anymore and no
+// request came for as long.
+public class Program
+{
+    public static void Main(string[] args)
+    {
+        Options options;
+        try { options = new Options(args); }
+        catch (Exception e) when (e is ArgumentException or FormatException)
+        {
+            Console.Error.WriteLine(e.Message);
+            Console.WriteLine($"Usage: --socket <path> [--idle-timeout <seconds>] [--languageversion <version>] [--referencepath <directory>]... [-ds <setting>=<value>]...");
+            Environment.Exit(1);
+            return;
+        }
+        new Server(options).Run().GetAwaiter().GetResult();
+    }
+
+    public static void Log(string message)
+    {
+        Console.Error.WriteLine($"{DateTime.Now:yyyy-MM-dd HH:mm:ss} {message}");
+    }
+}
+
+class Options
+{
+    public readonly string Socket = "";
+    public readonly TimeSpan IdleTimeout = TimeSpan.FromMinutes(5);
+    public readonly DecompilerOptions Decompiler = new();
+
+    public Options(string[] args)
+    {
+        for (var i = 0; i < args.Length; i++)
+        {
+            var option = args[i];
+            var value = ++i < args.Length ? args[i] : throw new ArgumentException($"{option}: missing value");
+            switch (option)
+            {
+                case "--socket":
+                    Socket = Path.GetFullPath(value);
+                    break;
+                case "--idle-timeout":
+                    IdleTimeout = TimeSpan.FromSeconds(double.Parse(value, CultureInfo.InvariantCulture));
+                    break;
+                default:
+                    if (!Decompiler.Parse(option, value)) throw new ArgumentException($"unknown option: {option}");
+                    break;
+            }
+        }
+        if (Socket == "") throw new ArgumentException("--socket is required");
+    }
+}
+
+// An assembly with what decompiling it needs, loaded once.
+class Loaded
+{
+    public readonly PEFile Module;
+    public readonly UniversalAssemblyResolver Resolver;
+    public readonly DecompilerSettings Settings;
+    public readonly DecompilerTypeSystem TypeSystem;
+
+    public Loaded(string path, Options options)
+    {
+        // read at once: the game may be updated while it's loaded
+        using (var stream = File.OpenRead(path))
+            Module = new PEFile(path, stream, PEStreamOptions.PrefetchEntireImage);
+        Resolver = new UniversalAssemblyResolver(path, false, Module.DetectTargetFrameworkId());
+        foreach (var directory in options.Decompiler.ReferencePaths)
+            Resolver.AddSearchDirectory(directory);
+        Settings = options.Decompiler.Settings(Module);
+        TypeSystem = new DecompilerTypeSystem(Module, Resolver, Settings);
+    }
+}
+
+class Entry
+{
+    public required (DateTime, long) Stamp;
+    public required Lazy<Loaded> Value;
+    public DateTime LastUsed = DateTime.UtcNow;
+}
+
+class Server
+{
+    readonly Options options;
+    // by full path; an assembly which changed on disk is loaded again
+    readonly Dictionary<string, Entry> loaded = new(StringComparer.Ordinal);
+    readonly CancellationTokenSource stop = new();
+    DateTime lastRequest = DateTime.UtcNow;
+    int running;
+
+    public Server(Options options)
+    {
+        this.options = options;
+    }
+
+    public async Task Run()
+    {
+        var path = options.Socket;
+        if (File.Exists(path))
+        {
+            if (Alive(path))
+            {
+                Program.Log($"already running: {path}");
+                return;
+            }
+            File.Delete(path);  // left by a daemon which didn't exit cleanly
+        }
+        using var listener = new Socket(AddressFamily.Unix, SocketType.Stream, ProtocolType.Unspecified);
+        listener.Bind(new UnixDomainSocketEndPoint(path));
+        if (!OperatingSystem.IsWindows())
+            File.SetUnixFileMode(path, UnixFileMode.UserRead | UnixFileMode.UserWrite);
+        listener.Listen();
+        Program.Log($"listening: {path}");
+        var period = options.IdleTimeout / 4;
+        using var timer = new Timer(_ => Evict(), null, period, period);
+        try
+        {
+            while (true)
+            {
+                var client = await listener.AcceptAsync(stop.Token);
+                _ = Task.Run(() => Serve(client));
+            }
+        }
+        catch (OperationCanceledException) { }
+        finally
+        {
+            File.Delete(path);
+        }
+        Program.Log("stopped");
+    }
+
+    static bool Alive(string path)
+    {
+        using var socket = new Socket(AddressFamily.Unix, SocketType.Stream, ProtocolType.Unspecified);
+        try { socket.Connect(new UnixDomainSocketEndPoint(path)); }
+        catch (SocketException) { return false; }
+        return true;
+    }
+
+    async Task Serve(Socket client)
+    {
+        using var stream = new NetworkStream(client, ownsSocket: true);
+        using var reader = new StreamReader(stream, new UTF8Encoding(false));
+        using var writer = new StreamWriter(stream, new UTF8Encoding(false));
+        var line = await reader.ReadLineAsync();
+        if (line == null) return;
+        Interlocked.Increment(ref running);
+        Dictionary<string, object> response;
+        try
+        {
+            using var request = JsonDocument.Parse(line);
+            response = Handle(request.RootElement);
+        }
+        catch (Exception e)
+        {
+            Program.Log($"{line}: {e}");
+            response = new() { ["error"] = $"{e.GetType().Name}: {e.Message}" };
+        }
+        finally
+        {
+            lastRequest = DateTime.UtcNow;
+            Interlocked.Decrement(ref running);
+        }
+        await writer.WriteAsync(JsonSerializer.Serialize(response) + "\n");
+        await writer.FlushAsync();
+    }
+
+    Dictionary<string, object> Handle(JsonElement request)
+    {
+        var command = request.GetProperty("command").GetString();
+        switch (command)
+        {
+            case "type":
+                {
+                    var assembly = Load(Argument(request, "assembly"));
+                    var decompiler = new ProjectDecompiler(assembly.Settings, assembly.Resolver, assembly.Resolver);
+                    var source = decompiler.DecompileType(assembly.TypeSystem, Argument(request, "type"));
+                    return new() { ["source"] = source };
+                }
+            case "assembly":
+                {
+                    var assembly = Load(Argument(request, "assembly"));
+                    return new() { ["project"] = DecompileProject(assembly, Argument(request, "output")) };
+                }
+            case "references":
+                {
+                    var roots = request.GetProperty("roots").EnumerateArray().Select(r => r.GetString()!);
+                    return new() { ["graph"] = ListReferences.Program.Graph(roots) };
+                }
+            case "extract-types":
+                {
+                    var game = Argument(request, "game");
+                    var verify = request.TryGetProperty("verify", out var value) && value.ValueKind == JsonValueKind.True;
+                    return new() { ["source"] = verify ? ExtractTypes.Program.Verified(game) : ExtractTypes.Program.Extract(game) };
+                }
+            case "stop":
+                stop.Cancel();
+                return new();
+            default:
+                throw new ArgumentException($"unknown command: {command}");
+        }
+    }
+
+    static string Argument(JsonElement request, string name)
+    {
+        if (!request.TryGetProperty(name, out var value) || value.GetString() is not string s)
+            throw new ArgumentException($"missing: {name}");
+        return s;
+    }
+
+    Loaded Load(string path)
+    {
+        path = Path.GetFullPath(path);
+        var info = new FileInfo(path);
+        if (!info.Exists) throw new FileNotFoundException(path);
+        var stamp = (info.LastWriteTimeUtc, info.Length);
+        Entry? entry;
+        lock (loaded)
+        {
+            if (!loaded.TryGetValue(path, out entry) || entry.Stamp != stamp)
+            {
+                entry = new Entry { Stamp = stamp, Value = new Lazy<Loaded>(() => new Loaded(path, options)) };
+                loaded[path] = entry;
+            }
+            entry.LastUsed = DateTime.UtcNow;
+        }
+        try
+        {
+            var created = entry.Value.IsValueCreated;
+            var result = entry.Value.Value;
+            if (!created) Program.Log($"loaded: {path}");
+            return result;
+        }
+        catch
+        {
+            // don't keep the failure: the next request tries again
+            lock (loaded)
+            {
+                if (loaded.GetValueOrDefault(path) == entry) loaded.Remove(path);
+            }
+            throw;
+        }
+    }
+
+    static string DecompileProject(Loaded assembly, string output)
+    {
+        Directory.CreateDirectory(output);
+        var project = Path.Join(output, Path.GetFileNameWithoutExtension(assembly.Module.FileName) + ".csproj");
+        var decompiler = new ProjectDecompiler(assembly.Settings, assembly.Resolver, assembly.Resolver);
+        using (var writer = new StreamWriter(File.Create(project)))
+            decompiler.DecompileProject(assembly.Module, output, writer);
+        return project;
+    }
+
+    void Evict()
+    {
+        var now = DateTime.UtcNow;
+        var evicted = false;
+        lock (loaded)
+        {
+            foreach (var (path, entry) in loaded.ToList())
+            {
+                if (now - entry.LastUsed < options.IdleTimeout) continue;
+                loaded.Remove(path);
+                evicted = true;
+                Program.Log($"unloaded: {path}");
+            }
+            if (loaded.Count == 0 && running == 0 && now - lastRequest >= options.IdleTimeout)
+                stop.Cancel();
+        }
+        if (evicted) GC.Collect();  // give the memory back now
+    }
+}
@@ -0,0 +1,267 @@
+#nullable enable
+
+using System;
+using System.Collections.Concurrent;
+using System.Collections.Generic;
+using System.Globalization;
+using System.IO;
+using System.Linq;
+using System.Reflection.Metadata;
+using System.Reflection.PortableExecutable;
+using System.Threading.Tasks;
+using ICSharpCode.Decompiler;
+using ICSharpCode.Decompiler.CSharp;
+using ICSharpCode.Decompiler.CSharp.OutputVisitor;
+using ICSharpCode.Decompiler.CSharp.ProjectDecompiler;
+using ICSharpCode.Decompiler.Metadata;
+using ICSharpCode.Decompiler.TypeSystem;
+
+namespace SpaceEngineers.DecompilerHost;
+
+// Decompile assemblies into projects as ilspycmd --project
+// --nested-directories does, with the same library, but all in one process:
+// the assemblies are decompiled in parallel, largest first, their types in
+// parallel too, and they share one metadata cache, so the references common
+// to all of them (mscorlib, VRage...) are read once. Each assembly goes to
+// <output>/<name>/<name>.csproj, and its path is printed once it's done.
+// With -t, a single type goes to <output>/<name>.decompiled.cs, as it is in
+// the project.
+public class Program
+{
+    public static void Main(string[] args)
+    {
+        var options = new DecompilerOptions();
+        var jobs = Environment.ProcessorCount;
+        string? output = null;
+        string? type = null;
+        var assemblies = new List<string>();
+        try
+        {
+            for (var i = 0; i < args.Length; i++)
+            {
+                var option = args[i];
+                if (option == "--version")
+                {
+                    Console.WriteLine($"DecompilerHost {typeof(CSharpDecompiler).Assembly.GetName().Version}");
+                    return;
+                }
+                if (!option.StartsWith('-'))
+                {
+                    assemblies.Add(Path.GetFullPath(option));
+                    continue;
+                }
+                var value = ++i < args.Length ? args[i] : throw new ArgumentException($"{option}: missing value");
+                switch (option)
+                {
+                    case "-j":
+                        jobs = int.Parse(value, CultureInfo.InvariantCulture);
+                        break;
+                    case "-o":
+                        output = value;
+                        break;
+                    case "-t":
+                        type = value;
+                        break;
+                    default:
+                        if (!options.Parse(option, value)) throw new ArgumentException($"unknown option: {option}");
+                        break;
+                }
+            }
+            if (output == null || assemblies.Count == 0 || (type != null && assemblies.Count != 1))
+                throw new ArgumentException("expected: -o <directory> and assemblies, a single one with -t");
+        }
+        catch (Exception e) when (e is ArgumentException or FormatException)
+        {
+            Console.Error.WriteLine(e.Message);
+            Console.WriteLine($"Usage: [-j <jobs>] [--languageversion <version>] [--referencepath <directory>]... [-ds <setting>=<value>]... [-t <type>] -o <directory> <assembly path>...");
+            Environment.Exit(1);
+            return;
+        }
+
+        var metadata = new MetadataCache(options.ReferencePaths);
+        if (type != null)
+        {
+            var module = metadata.Load(assemblies[0]);
+            var resolver = metadata.Resolver(module);
+            var settings = options.Settings(module);
+            var decompiler = new ProjectDecompiler(settings, resolver, resolver.Classifier);
+            var source = decompiler.DecompileType(new DecompilerTypeSystem(module, resolver, settings), type);
+            File.WriteAllText(Path.Join(output, Path.GetFileNameWithoutExtension(module.FileName) + ".decompiled.cs"), source);
+            return;
+        }
+        // the jobs are shared, not multiplied: a few assemblies at once, each
+        // decompiling its types with its share of them, so the largest one
+        // doesn't end alone on a single thread
+        var parallel = Math.Min(assemblies.Count, (int)Math.Ceiling(Math.Sqrt(jobs)));
+        var share = Math.Max(1, jobs / parallel);
+        var order = assemblies.OrderByDescending(path => new FileInfo(path).Length);
+        Parallel.ForEach(order, new ParallelOptions { MaxDegreeOfParallelism = parallel }, path =>
+        {
+            DecompileProject(metadata, options, path, output, share);
+            lock (Console.Out)
+            {
+                Console.WriteLine(path);
+                Console.Out.Flush();
+            }
+        });
+    }
+
+    static void DecompileProject(MetadataCache metadata, DecompilerOptions options, string path, string output, int jobs)
+    {
+        var module = metadata.Load(path);
+        var name = Path.GetFileNameWithoutExtension(path);
+        var directory = Path.Join(output, name);
+        Directory.CreateDirectory(directory);
+        var resolver = metadata.Resolver(module);
+        var decompiler = new ProjectDecompiler(options.Settings(module), resolver, resolver.Classifier)
+        {
+            MaxDegreeOfParallelism = jobs,
+        };
+        using (var writer = new StreamWriter(File.Create(Path.Join(directory, name + ".csproj"))))
+            decompiler.DecompileProject(module, directory, writer);
+    }
+}
+
+// WholeProjectDecompiler, which also decompiles a single type as it writes
+// it in a project: with the same transforms (invalid identifiers escaped,
+// CLSCompliant attributes removed...) and settings, where CSharpDecompiler
+// alone would write Foo<>Actor for the Foo_003C_003EActor of the project.
+public class ProjectDecompiler : WholeProjectDecompiler
+{
+    public ProjectDecompiler(DecompilerSettings settings, IAssemblyResolver resolver, AssemblyReferenceClassifier classifier)
+        : base(settings, resolver, null, classifier, null)
+    {
+    }
+
+    // a top-level type of the main module, as in its file of the project
+    public string DecompileType(DecompilerTypeSystem typeSystem, string type)
+    {
+        var definition = typeSystem.MainModule.GetTypeDefinition(new FullTypeName(type).TopLevelTypeName)
+            ?? throw new ArgumentException($"no such type: {type}");
+        var decompiler = CreateDecompiler(typeSystem);
+        var syntaxTree = decompiler.DecompileTypes(new[] { (TypeDefinitionHandle)definition.MetadataToken });
+        var writer = new StringWriter();
+        syntaxTree.AcceptVisitor(new CSharpOutputVisitor(writer, Settings.CSharpFormattingOptions));
+        return writer.ToString();
+    }
+}
+
+// The flags shared with ilspycmd, and the settings ilspycmd makes of them.
+public class DecompilerOptions
+{
+    LanguageVersion languageVersion = LanguageVersion.Latest;
+    public readonly List<string> ReferencePaths = new();
+    readonly List<(string, string)> settings = new();
+
+    // false if option isn't one of them
+    public bool Parse(string option, string value)
+    {
+        switch (option)
+        {
+            case "--languageversion":
+                languageVersion = Enum.Parse<LanguageVersion>(value);
+                return true;
+            case "--referencepath":
+                if (value != "") ReferencePaths.Add(value);
+                return true;
+            case "-ds":
+                var parts = value.Split('=', 2);
+                if (parts.Length != 2) throw new ArgumentException($"-ds {value}: expected <setting>=<value>");
+                settings.Add((parts[0], parts[1]));
+                return true;
+            default:
+                return false;
+        }
+    }
+
+    public DecompilerSettings Settings(MetadataFile module)
+    {
+        var result = new DecompilerSettings(languageVersion)
+        {
+            ThrowOnAssemblyResolveErrors = false,
+            UseSdkStyleProjectFormat = WholeProjectDecompiler.CanUseSdkStyleProjectFormat(module),
+            UseNestedDirectoriesForNamespaces = true,
+        };
+        foreach (var (name, value) in settings)
+        {
+            var property = typeof(DecompilerSettings).GetProperty(name)
+                ?? throw new ArgumentException($"-ds {name}: no such setting");
+            property.SetValue(result, Convert.ChangeType(value, property.PropertyType, CultureInfo.InvariantCulture));
+        }
+        return result;
+    }
+}
+
+// The assemblies read so far, by full path, whichever assembly they were
+// read for. UniversalAssemblyResolver only finds the files: one per
+// directory and target framework, which all the game assemblies share.
+public class MetadataCache
+{
+    readonly List<string> referencePaths;
+    readonly ConcurrentDictionary<string, Lazy<PEFile>> files = new(StringComparer.Ordinal);
+    readonly ConcurrentDictionary<(string, string), UniversalAssemblyResolver> finders = new();
+
+    public MetadataCache(List<string> referencePaths)
+    {
+        this.referencePaths = referencePaths;
+    }
+
+    public PEFile Load(string path)
+    {
+        return files.GetOrAdd(Path.GetFullPath(path), p => new Lazy<PEFile>(() =>
+        {
+            // read at once, it's shared by the threads
+            using var stream = File.OpenRead(p);
+            return new PEFile(p, stream, PEStreamOptions.PrefetchEntireImage);
+        })).Value;
+    }
+
+    public ModuleResolver Resolver(MetadataFile module)
+    {
+        var directory = Path.GetDirectoryName(module.FileName) ?? "";
+        var framework = module.DetectTargetFrameworkId();
+        var finder = finders.GetOrAdd((directory, framework), _ =>
+        {
+            var resolver = new UniversalAssemblyResolver(module.FileName, false, framework);
+            foreach (var referencePath in referencePaths)
+                resolver.AddSearchDirectory(referencePath);
+            return resolver;
+        });
+        return new ModuleResolver(this, finder);
+    }
+}
+
+// Resolve the references of a module through the cache.
+public class ModuleResolver : IAssemblyResolver
+{
+    readonly MetadataCache metadata;
+    public readonly UniversalAssemblyResolver Classifier;
+
+    public ModuleResolver(MetadataCache metadata, UniversalAssemblyResolver finder)
+    {
+        this.metadata = metadata;
+        Classifier = finder;
+    }
+
+    public MetadataFile? Resolve(IAssemblyReference reference)
+    {
+        var file = Classifier.FindAssemblyFile(reference);
+        return file == null ? null : metadata.Load(file);
+    }
+
+    public MetadataFile? ResolveModule(MetadataFile mainModule, string moduleName)
+    {
+        var file = Path.Join(Path.GetDirectoryName(mainModule.FileName), moduleName);
+        return File.Exists(file) ? metadata.Load(file) : null;
+    }
+
+    public Task<MetadataFile?> ResolveAsync(IAssemblyReference reference)
+    {
+        return Task.Run(() => Resolve(reference));
+    }
+
+    public Task<MetadataFile?> ResolveModuleAsync(MetadataFile mainModule, string moduleName)
+    {
+        return Task.Run(() => ResolveModule(mainModule, moduleName));
+    }
+}
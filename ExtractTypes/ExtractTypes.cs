@@ -1,6 +1,14 @@
+#nullable enable
+
 using System;
+using System.Collections.Generic;
 using System.IO;
+using System.Linq;
 using System.Reflection;
+using System.Reflection.Metadata;
+using System.Reflection.PortableExecutable;
+using System.Runtime.Loader;
+using System.Text;
 
 namespace SpaceEngineers.ExtractTypes;
 
@@ -15,41 +23,103 @@ public class Program
 
     public static void Main(string[] args)
     {
-        if (args.Length == 0)
+        var mode = args.Length == 2 ? args[0] : "";
+        if (args.Length == 0 || args.Length > 2 || (mode != "" && mode != "--reflection" && mode != "--verify"))
         {
-            Console.WriteLine($"Usage: <assembly path>");
+            Console.WriteLine($"Usage: [--reflection|--verify] <assembly path>");
             Environment.Exit(1);
         }
-        var path = args[0];
-        var shouldRegister = findShouldRegister(path);
-        Console.WriteLine("using System.Collections.Generic;");
-        Console.WriteLine("");
-        Console.WriteLine("namespace VRage.Network;");
-        Console.WriteLine("");
-        Console.WriteLine("public class OriginalTypes");
-        Console.WriteLine("{");
-        Console.WriteLine("\tpublic static readonly Dictionary<string, string[]> List = new Dictionary<string, string[]> {");
+        var path = args[args.Length - 1];
+        if (mode == "--verify")
+        {
+            try
+            {
+                Console.Write(Verified(path));
+            }
+            catch (InvalidDataException e)
+            {
+                Console.Error.WriteLine(e.Message);
+                Environment.Exit(1);
+            }
+        }
+        else if (mode == "--reflection")
+        {
+            Console.Write(Write(path, ReflectionTypes(path)));
+        }
+        else
+        {
+            Console.Write(Extract(path));
+        }
+    }
+
+    // OriginalTypes.cs for the game in path, from the metadata
+    public static string Extract(string path)
+    {
+        return Write(path, MetadataTypes(path));
+    }
+
+    // Extract(), checked against MyTypeTable.ShouldRegister of the game
+    // itself: the order of the types is the network protocol, a port which
+    // no longer agrees with the game would break multiplayer
+    public static string Verified(string path)
+    {
+        var expected = Write(path, ReflectionTypes(path));
+        var actual = Write(path, MetadataTypes(path));
+        if (expected != actual)
+        {
+            var e = expected.Split('\n');
+            var a = actual.Split('\n');
+            var i = 0;
+            while (i < e.Length && i < a.Length && e[i] == a[i]) i++;
+            throw new InvalidDataException($"line {i + 1}: reflection {(i < e.Length ? e[i].Trim() : "EOF")}, metadata {(i < a.Length ? a[i].Trim() : "EOF")}");
+        }
+        return actual;
+    }
+
+    static string Write(string path, Func<string, IEnumerable<string>> types)
+    {
+        var sb = new StringBuilder();
+        sb.Append("using System.Collections.Generic;\n");
+        sb.Append("\n");
+        sb.Append("namespace VRage.Network;\n");
+        sb.Append("\n");
+        sb.Append("public class OriginalTypes\n");
+        sb.Append("{\n");
+        sb.Append("\tpublic static readonly Dictionary<string, string[]> List = new Dictionary<string, string[]> {\n");
         foreach (var assembly in assemblies)
         {
-            Console.WriteLine("\t\t{\"" + assembly+ "\", new string[] {");
-            foreach (var type in Assembly.LoadFrom(Path.Join(path, assembly)).GetTypes())
+            sb.Append("\t\t{\"" + assembly + "\", new string[] {\n");
+            foreach (var type in types(assembly))
             {
-                if (!shouldRegister(type))
-                {
-                    continue;
-                }
-                Console.WriteLine("\t\t\t\t\"" + type.FullName + "\",");
+                sb.Append("\t\t\t\t\"" + type + "\",\n");
             }
-            Console.WriteLine("\t\t\t}");
-            Console.WriteLine("\t\t},");
+            sb.Append("\t\t\t}\n");
+            sb.Append("\t\t},\n");
         }
-        Console.WriteLine("\t};");
-        Console.WriteLine("}");
+        sb.Append("\t};\n");
+        sb.Append("}\n");
+        return sb.ToString().Replace("\n", Environment.NewLine);
+    }
+
+    // Load the assemblies and ask the game itself. They are loaded in a
+    // context of their own, collected once unused: the daemon sees each
+    // version of the game.
+    static Func<string, IEnumerable<string>> ReflectionTypes(string path)
+    {
+        var context = new AssemblyLoadContext("game", isCollectible: true);
+        context.Resolving += (context, name) =>
+        {
+            var filename = Path.GetFullPath(Path.Join(path, name.Name + ".dll"));
+            return File.Exists(filename) ? context.LoadFromAssemblyPath(filename) : null;
+        };
+        var shouldRegister = findShouldRegister(context, path);
+        return (string assembly) => context.LoadFromAssemblyPath(Path.GetFullPath(Path.Join(path, assembly))).GetTypes()
+            .Where(shouldRegister).Select(type => type.FullName!).ToList();
     }
 
-    static Func<Type, bool> findShouldRegister(string path)
+    static Func<Type, bool> findShouldRegister(AssemblyLoadContext context, string path)
     {
-        var asm = Assembly.LoadFrom(Path.Join(path, "VRage.dll"));
+        var asm = context.LoadFromAssemblyPath(Path.GetFullPath(Path.Join(path, "VRage.dll")));
         var myTypeTable = asm.GetType("VRage.Network.MyTypeTable");
         if (myTypeTable == null) {
             throw new Exception($"could not find VRage.Network.MyTypeTable in {asm.Location}");
@@ -59,6 +129,278 @@ public class Program
         {
             throw new Exception($"could not find VRage.Network.MyTypeTable::ShouldRegister in {asm.Location}");
         }
-        return (Type type) => { return (bool)methodInfo.Invoke(null, new object[] { type }); };
+        return (Type type) => { return (bool)methodInfo.Invoke(null, new object[] { type })!; };
+    }
+
+    // Read the type tables without loading anything, in GetTypes() order.
+    static Func<string, IEnumerable<string>> MetadataTypes(string path)
+    {
+        var metadata = new Metadata(path);
+        return (string assembly) =>
+        {
+            var module = metadata.Load(Path.GetFileNameWithoutExtension(assembly))
+                ?? throw new FileNotFoundException(Path.Join(path, assembly));
+            // the first row is the <Module> pseudo type
+            return module.Reader.TypeDefinitions.Skip(1)
+                .Where(handle => metadata.ShouldRegister(new TypeKey(module, handle)))
+                .Select(handle => module.FullName(handle)).ToList();
+        };
+    }
+}
+
+class Module
+{
+    public readonly MetadataReader Reader;
+    readonly PEReader pe;
+    readonly Dictionary<string, TypeDefinitionHandle> types = new();
+
+    public Module(string filename)
+    {
+        pe = new PEReader(File.OpenRead(filename));
+        Reader = pe.GetMetadataReader();
+        foreach (var handle in Reader.TypeDefinitions)
+        {
+            types[FullName(handle)] = handle;
+        }
+    }
+
+    // like Type.FullName: Namespace.Outer+Inner`1
+    public string FullName(TypeDefinitionHandle handle)
+    {
+        var type = Reader.GetTypeDefinition(handle);
+        var name = Reader.GetString(type.Name);
+        var declaring = type.GetDeclaringType();
+        if (!declaring.IsNil)
+        {
+            return FullName(declaring) + "+" + name;
+        }
+        var ns = Reader.GetString(type.Namespace);
+        return ns.Length == 0 ? name : ns + "." + name;
+    }
+
+    public TypeDefinitionHandle? Find(string fullName)
+    {
+        return types.TryGetValue(fullName, out var handle) ? handle : null;
+    }
+}
+
+record TypeKey(Module Module, TypeDefinitionHandle Handle);
+
+// MyTypeTable.ShouldRegister on metadata, resolving base types and
+// interfaces across the game assemblies.
+class Metadata
+{
+    const string IMyReplicable = "VRage.Network.IMyReplicable";
+    const string IMyEventOwner = "VRage.Network.IMyEventOwner";
+    const string NotReplicableAttribute = "VRage.Network.NotReplicableAttribute";
+    const string StaticEventOwnerAttribute = "VRage.Network.StaticEventOwnerAttribute";
+    const string ProtoContractAttribute = "ProtoBuf.ProtoContractAttribute";
+
+    readonly string path;
+    readonly Dictionary<string, Module?> modules = new();
+    readonly Dictionary<(TypeKey, string), bool> assignable = new();
+
+    public Metadata(string path)
+    {
+        this.path = path;
+    }
+
+    public Module? Load(string assemblyName)
+    {
+        if (!modules.TryGetValue(assemblyName, out var module))
+        {
+            // framework assemblies aren't there, and never implement game interfaces
+            var filename = Path.Join(path, assemblyName + ".dll");
+            module = File.Exists(filename) ? new Module(filename) : null;
+            modules[assemblyName] = module;
+        }
+        return module;
+    }
+
+    public bool ShouldRegister(TypeKey type)
+    {
+        return IsReplicated(type) || CanHaveEvents(type) || IsSerializableClass(type);
+    }
+
+    bool IsReplicated(TypeKey type)
+    {
+        var attributes = Definition(type).Attributes;
+        return (attributes & TypeAttributes.Abstract) == 0
+            && IsAssignableTo(type, IMyReplicable)
+            && !HasAttribute(type, NotReplicableAttribute, false);
+    }
+
+    bool CanHaveEvents(TypeKey type)
+    {
+        return HasAttribute(type, StaticEventOwnerAttribute, true) || IsAssignableTo(type, IMyEventOwner);
+    }
+
+    bool IsSerializableClass(TypeKey type)
+    {
+        // [Serializable] is a flag in metadata, not a custom attribute
+#pragma warning disable SYSLIB0050
+        return (Definition(type).Attributes & TypeAttributes.Serializable) != 0
+#pragma warning restore SYSLIB0050
+            || HasAttribute(type, ProtoContractAttribute, false);
+    }
+
+    static TypeDefinition Definition(TypeKey type)
+    {
+        return type.Module.Reader.GetTypeDefinition(type.Handle);
+    }
+
+    // typeof(fullName).IsAssignableFrom(type) for a class or an interface
+    bool IsAssignableTo(TypeKey type, string fullName)
+    {
+        if (assignable.TryGetValue((type, fullName), out var result))
+        {
+            return result;
+        }
+        assignable[(type, fullName)] = false;  // cycles in broken metadata
+        var definition = Definition(type);
+        result = type.Module.FullName(type.Handle) == fullName;
+        if (!result && !definition.BaseType.IsNil)
+        {
+            var baseType = Resolve(type.Module, definition.BaseType);
+            result = baseType != null && IsAssignableTo(baseType, fullName);
+        }
+        foreach (var handle in definition.GetInterfaceImplementations())
+        {
+            if (result) break;
+            var implementation = type.Module.Reader.GetInterfaceImplementation(handle);
+            var iface = Resolve(type.Module, implementation.Interface);
+            result = iface != null && IsAssignableTo(iface, fullName);
+        }
+        assignable[(type, fullName)] = result;
+        return result;
+    }
+
+    bool HasAttribute(TypeKey type, string fullName, bool inherit)
+    {
+        for (TypeKey? t = type; t != null;)
+        {
+            var reader = t.Module.Reader;
+            var definition = Definition(t);
+            foreach (var handle in definition.GetCustomAttributes())
+            {
+                if (AttributeName(reader, reader.GetCustomAttribute(handle)) == fullName)
+                {
+                    return true;
+                }
+            }
+            if (!inherit || definition.BaseType.IsNil) break;
+            t = Resolve(t.Module, definition.BaseType);
+        }
+        return false;
+    }
+
+    static string? AttributeName(MetadataReader reader, CustomAttribute attribute)
+    {
+        EntityHandle type;
+        if (attribute.Constructor.Kind == HandleKind.MemberReference)
+        {
+            type = reader.GetMemberReference((MemberReferenceHandle)attribute.Constructor).Parent;
+        }
+        else if (attribute.Constructor.Kind == HandleKind.MethodDefinition)
+        {
+            type = reader.GetMethodDefinition((MethodDefinitionHandle)attribute.Constructor).GetDeclaringType();
+        }
+        else
+        {
+            return null;
+        }
+        if (type.Kind == HandleKind.TypeReference)
+        {
+            return ReferenceName(reader, (TypeReferenceHandle)type);
+        }
+        if (type.Kind == HandleKind.TypeDefinition)
+        {
+            var definition = reader.GetTypeDefinition((TypeDefinitionHandle)type);
+            var ns = reader.GetString(definition.Namespace);
+            var name = reader.GetString(definition.Name);
+            return ns.Length == 0 ? name : ns + "." + name;
+        }
+        return null;
+    }
+
+    static string ReferenceName(MetadataReader reader, TypeReferenceHandle handle)
+    {
+        var reference = reader.GetTypeReference(handle);
+        var name = reader.GetString(reference.Name);
+        if (reference.ResolutionScope.Kind == HandleKind.TypeReference)
+        {
+            return ReferenceName(reader, (TypeReferenceHandle)reference.ResolutionScope) + "+" + name;
+        }
+        var ns = reader.GetString(reference.Namespace);
+        return ns.Length == 0 ? name : ns + "." + name;
+    }
+
+    TypeKey? Resolve(Module module, EntityHandle handle)
+    {
+        var reader = module.Reader;
+        switch (handle.Kind)
+        {
+            case HandleKind.TypeDefinition:
+                return new TypeKey(module, (TypeDefinitionHandle)handle);
+            case HandleKind.TypeSpecification:
+                {
+                    // a generic instance resolves to its generic definition
+                    var spec = reader.GetTypeSpecification((TypeSpecificationHandle)handle);
+                    var blob = reader.GetBlobReader(spec.Signature);
+                    if (blob.ReadSignatureTypeCode() != SignatureTypeCode.GenericTypeInstance)
+                    {
+                        return null;
+                    }
+                    blob.ReadSignatureTypeCode();  // class or value type
+                    return Resolve(module, blob.ReadTypeHandle());
+                }
+            case HandleKind.TypeReference:
+                {
+                    var reference = (TypeReferenceHandle)handle;
+                    var scope = reader.GetTypeReference(reference).ResolutionScope;
+                    while (scope.Kind == HandleKind.TypeReference)
+                    {
+                        scope = reader.GetTypeReference((TypeReferenceHandle)scope).ResolutionScope;
+                    }
+                    var fullName = ReferenceName(reader, reference);
+                    if (scope.Kind == HandleKind.AssemblyReference)
+                    {
+                        var assembly = reader.GetAssemblyReference((AssemblyReferenceHandle)scope);
+                        return Find(Load(reader.GetString(assembly.Name)), fullName, 0);
+                    }
+                    return Find(module, fullName, 0);
+                }
+            default:
+                return null;
+        }
+    }
+
+    // follow type forwarders, e.g. to VRage.Library
+    TypeKey? Find(Module? module, string fullName, int depth)
+    {
+        if (module == null || depth > 8)
+        {
+            return null;
+        }
+        var handle = module.Find(fullName);
+        if (handle != null)
+        {
+            return new TypeKey(module, handle.Value);
+        }
+        var reader = module.Reader;
+        foreach (var exportedHandle in reader.ExportedTypes)
+        {
+            var exported = reader.GetExportedType(exportedHandle);
+            var ns = reader.GetString(exported.Namespace);
+            var name = reader.GetString(exported.Name);
+            if ((ns.Length == 0 ? name : ns + "." + name) != fullName
+                || exported.Implementation.Kind != HandleKind.AssemblyReference)
+            {
+                continue;
+            }
+            var assembly = reader.GetAssemblyReference((AssemblyReferenceHandle)exported.Implementation);
+            return Find(Load(reader.GetString(assembly.Name)), fullName, depth + 1);
+        }
+        return null;
     }
 }
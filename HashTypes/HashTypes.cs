@@ -0,0 +1,496 @@
+#nullable enable
+
+using System;
+using System.Collections.Generic;
+using System.Collections.Immutable;
+using System.IO;
+using System.Linq;
+using System.Reflection;
+using System.Reflection.Emit;
+using System.Reflection.Metadata;
+using System.Reflection.Metadata.Ecma335;
+using System.Reflection.PortableExecutable;
+using System.Security.Cryptography;
+using System.Text;
+using System.Text.Json;
+
+namespace SpaceEngineers.HashTypes;
+
+// Hash each top-level type of the assemblies, with its nested types: names,
+// signatures, attributes, constants and IL, the tokens of the IL replaced by
+// the names they refer to. A type's hash then only changes with its own
+// definition, not when other types are added or removed. The rest of the
+// assembly (identity, references, assembly attributes, resources...) has its
+// own hash. Each type also lists the top-level types it refers to, whose
+// changes may change how it decompiles.
+public class Program
+{
+    public static void Main(string[] args)
+    {
+        if (args.Length == 0)
+        {
+            Console.WriteLine($"Usage: <assembly path>...");
+            Environment.Exit(1);
+        }
+        var hashers = new SortedDictionary<string, Hasher>(StringComparer.Ordinal);
+        foreach (var path in args.Select(Path.GetFullPath))
+        {
+            try { hashers[path] = new Hasher(path); }
+            catch (BadImageFormatException) { continue; /* not dotnet, e.g. native C++ */ }
+            catch (InvalidOperationException) { continue; /* no metadata */ }
+        }
+        // only the references to the types of these assemblies are useful
+        var defined = new HashSet<string>(hashers.Values.SelectMany(h => h.Types.Keys), StringComparer.Ordinal);
+        var result = new SortedDictionary<string, object>(StringComparer.Ordinal);
+        foreach (var (path, hasher) in hashers)
+        {
+            var types = new SortedDictionary<string, object>(StringComparer.Ordinal);
+            foreach (var (name, type) in hasher.Types)
+            {
+                types[name] = new Dictionary<string, object>
+                {
+                    ["namespace"] = type.Namespace,
+                    ["name"] = type.Name,
+                    ["hash"] = type.Hash,
+                    ["references"] = type.References.Where(r => r != name && defined.Contains(r))
+                        .OrderBy(r => r, StringComparer.Ordinal).ToList(),
+                };
+            }
+            result[path] = new Dictionary<string, object>
+            {
+                ["assembly"] = hasher.Assembly,
+                ["types"] = types,
+            };
+        }
+        Console.WriteLine(JsonSerializer.Serialize(result));
+    }
+}
+
+record TypeHash(string Namespace, string Name, string Hash, HashSet<string> References);
+
+class Hasher
+{
+    // operand of each opcode, to walk the IL
+    static readonly Dictionary<short, OperandType> operands = Operands();
+
+    readonly PEReader pe;
+    readonly MetadataReader reader;
+    readonly Names names;
+    public readonly string Assembly;
+    public readonly SortedDictionary<string, TypeHash> Types = new(StringComparer.Ordinal);
+
+    public Hasher(string filename)
+    {
+        pe = new PEReader(new MemoryStream(File.ReadAllBytes(filename)));
+        reader = pe.GetMetadataReader();
+        names = new Names(reader);
+        Assembly = HashAssembly();
+        foreach (var handle in reader.TypeDefinitions)
+        {
+            var type = reader.GetTypeDefinition(handle);
+            if (!type.GetDeclaringType().IsNil || handle == MetadataTokens.TypeDefinitionHandle(1))
+            {
+                continue;  // nested, or the <Module> pseudo type hashed with the assembly
+            }
+            names.References = new HashSet<string>(StringComparer.Ordinal);
+            var w = new Writer();
+            Type(w, handle);
+            Types[names.Type(handle)] = new TypeHash(reader.GetString(type.Namespace),
+                reader.GetString(type.Name), w.Hash(), names.References);
+        }
+    }
+
+    static Dictionary<short, OperandType> Operands()
+    {
+        var result = new Dictionary<short, OperandType>();
+        foreach (var field in typeof(OpCodes).GetFields(BindingFlags.Public | BindingFlags.Static))
+        {
+            var opcode = (OpCode)field.GetValue(null)!;
+            result.TryAdd(opcode.Value, opcode.OperandType);
+        }
+        return result;
+    }
+
+    string HashAssembly()
+    {
+        var w = new Writer();
+        if (reader.IsAssembly)
+        {
+            var assembly = reader.GetAssemblyDefinition();
+            w.Add("assembly", reader.GetString(assembly.Name), assembly.Version.ToString(),
+                reader.GetString(assembly.Culture), (int)assembly.Flags, Blob(assembly.PublicKey));
+            CustomAttributes(w, assembly.GetCustomAttributes());
+        }
+        CustomAttributes(w, reader.GetModuleDefinition().GetCustomAttributes());
+        foreach (var handle in reader.AssemblyReferences)
+        {
+            var reference = reader.GetAssemblyReference(handle);
+            w.Add("reference", reader.GetString(reference.Name), reference.Version.ToString(),
+                reader.GetString(reference.Culture), Blob(reference.PublicKeyOrToken));
+        }
+        for (var row = 1; row <= reader.GetTableRowCount(TableIndex.ModuleRef); row++)
+        {
+            w.Add("module", reader.GetString(reader.GetModuleReference(MetadataTokens.ModuleReferenceHandle(row)).Name));
+        }
+        foreach (var handle in reader.ManifestResources)
+        {
+            var resource = reader.GetManifestResource(handle);
+            w.Add("resource", reader.GetString(resource.Name), (int)resource.Attributes);
+            if (resource.Implementation.IsNil)
+            {
+                // embedded: a length prefixed blob in the resources directory
+                var directory = pe.PEHeaders.CorHeader!.ResourcesDirectory;
+                var data = pe.GetSectionData(directory.RelativeVirtualAddress).GetReader();
+                data.Offset = (int)resource.Offset;
+                w.Add(data.ReadBytes(data.ReadInt32()));
+            }
+        }
+        foreach (var handle in reader.ExportedTypes)
+        {
+            var exported = reader.GetExportedType(handle);
+            w.Add("exported", reader.GetString(exported.Namespace), reader.GetString(exported.Name));
+        }
+        // <Module>: module initializers, global fields and methods
+        names.References = new HashSet<string>();
+        Type(w, MetadataTokens.TypeDefinitionHandle(1));
+        return w.Hash();
+    }
+
+    void Type(Writer w, TypeDefinitionHandle handle)
+    {
+        var type = reader.GetTypeDefinition(handle);
+        var layout = type.GetLayout();
+        w.Add("type", names.Type(handle), (int)type.Attributes, layout.PackingSize, layout.Size);
+        w.Add("base", type.BaseType.IsNil ? "" : names.Entity(type.BaseType));
+        foreach (var implementationHandle in type.GetInterfaceImplementations())
+        {
+            var implementation = reader.GetInterfaceImplementation(implementationHandle);
+            w.Add("implements", names.Entity(implementation.Interface));
+            CustomAttributes(w, implementation.GetCustomAttributes());
+        }
+        GenericParameters(w, type.GetGenericParameters());
+        CustomAttributes(w, type.GetCustomAttributes());
+        foreach (var fieldHandle in type.GetFields())
+        {
+            var field = reader.GetFieldDefinition(fieldHandle);
+            w.Add("field", reader.GetString(field.Name), (int)field.Attributes,
+                field.DecodeSignature(names, null), field.GetOffset());
+            Constant(w, field.GetDefaultValue());
+            CustomAttributes(w, field.GetCustomAttributes());
+        }
+        foreach (var methodHandle in type.GetMethods())
+        {
+            Method(w, methodHandle);
+        }
+        foreach (var propertyHandle in type.GetProperties())
+        {
+            var property = reader.GetPropertyDefinition(propertyHandle);
+            var accessors = property.GetAccessors();
+            w.Add("property", reader.GetString(property.Name), (int)property.Attributes,
+                names.Signature(property.DecodeSignature(names, null)),
+                names.Method(accessors.Getter), names.Method(accessors.Setter));
+            Constant(w, property.GetDefaultValue());
+            CustomAttributes(w, property.GetCustomAttributes());
+        }
+        foreach (var eventHandle in type.GetEvents())
+        {
+            var e = reader.GetEventDefinition(eventHandle);
+            var accessors = e.GetAccessors();
+            w.Add("event", reader.GetString(e.Name), (int)e.Attributes, names.Entity(e.Type),
+                names.Method(accessors.Adder), names.Method(accessors.Remover), names.Method(accessors.Raiser));
+            CustomAttributes(w, e.GetCustomAttributes());
+        }
+        foreach (var implementationHandle in type.GetMethodImplementations())
+        {
+            var implementation = reader.GetMethodImplementation(implementationHandle);
+            w.Add("override", names.Entity(implementation.MethodBody), names.Entity(implementation.MethodDeclaration));
+        }
+        foreach (var nested in type.GetNestedTypes())
+        {
+            Type(w, nested);
+        }
+    }
+
+    void Method(Writer w, MethodDefinitionHandle handle)
+    {
+        var method = reader.GetMethodDefinition(handle);
+        w.Add("method", reader.GetString(method.Name), (int)method.Attributes, (int)method.ImplAttributes,
+            names.Signature(method.DecodeSignature(names, null)));
+        GenericParameters(w, method.GetGenericParameters());
+        CustomAttributes(w, method.GetCustomAttributes());
+        foreach (var parameterHandle in method.GetParameters())
+        {
+            var parameter = reader.GetParameter(parameterHandle);
+            w.Add("parameter", parameter.SequenceNumber, reader.GetString(parameter.Name), (int)parameter.Attributes);
+            Constant(w, parameter.GetDefaultValue());
+            CustomAttributes(w, parameter.GetCustomAttributes());
+        }
+        var import = method.GetImport();
+        if (!import.Module.IsNil)
+        {
+            w.Add("import", reader.GetString(reader.GetModuleReference(import.Module).Name),
+                reader.GetString(import.Name), (int)import.Attributes);
+        }
+        if (method.RelativeVirtualAddress == 0)
+        {
+            return;
+        }
+        var body = pe.GetMethodBody(method.RelativeVirtualAddress);
+        var locals = body.LocalSignature.IsNil ? "" : string.Join(",",
+            reader.GetStandaloneSignature(body.LocalSignature).DecodeLocalSignature(names, null));
+        w.Add("body", body.MaxStack, body.LocalVariablesInitialized ? 1 : 0, locals);
+        foreach (var region in body.ExceptionRegions)
+        {
+            w.Add("region", (int)region.Kind, region.TryOffset, region.TryLength, region.HandlerOffset,
+                region.HandlerLength, region.FilterOffset, region.CatchType.IsNil ? "" : names.Entity(region.CatchType));
+        }
+        IL(w, body.GetILReader());
+    }
+
+    void IL(Writer w, BlobReader il)
+    {
+        while (il.RemainingBytes > 0)
+        {
+            int value = il.ReadByte();
+            if (value == 0xFE)
+            {
+                value = 0xFE00 | il.ReadByte();
+            }
+            w.Add(value);
+            if (!operands.TryGetValue((short)value, out var operand))
+            {
+                operand = OperandType.InlineNone;
+            }
+            switch (operand)
+            {
+                case OperandType.InlineNone:
+                    break;
+                case OperandType.ShortInlineBrTarget:
+                case OperandType.ShortInlineI:
+                case OperandType.ShortInlineVar:
+                    w.Add(il.ReadByte());
+                    break;
+                case OperandType.InlineVar:
+                    w.Add(il.ReadUInt16());
+                    break;
+                case OperandType.InlineBrTarget:
+                case OperandType.InlineI:
+                case OperandType.ShortInlineR:
+                    w.Add(il.ReadInt32());
+                    break;
+                case OperandType.InlineI8:
+                case OperandType.InlineR:
+                    w.Add(il.ReadInt64().ToString());
+                    break;
+                case OperandType.InlineSwitch:
+                    var count = il.ReadInt32();
+                    w.Add(count);
+                    for (var i = 0; i < count; i++)
+                    {
+                        w.Add(il.ReadInt32());
+                    }
+                    break;
+                case OperandType.InlineString:
+                    w.Add(reader.GetUserString(MetadataTokens.UserStringHandle(il.ReadInt32() & 0xFFFFFF)));
+                    break;
+                default:
+                    // fields, methods, types, signatures: by name
+                    w.Add(names.Entity(MetadataTokens.EntityHandle(il.ReadInt32())));
+                    break;
+            }
+        }
+    }
+
+    void GenericParameters(Writer w, GenericParameterHandleCollection parameters)
+    {
+        foreach (var handle in parameters)
+        {
+            var parameter = reader.GetGenericParameter(handle);
+            w.Add("generic", reader.GetString(parameter.Name), (int)parameter.Attributes);
+            foreach (var constraintHandle in parameter.GetConstraints())
+            {
+                var constraint = reader.GetGenericParameterConstraint(constraintHandle);
+                w.Add("constraint", names.Entity(constraint.Type));
+                CustomAttributes(w, constraint.GetCustomAttributes());
+            }
+            CustomAttributes(w, parameter.GetCustomAttributes());
+        }
+    }
+
+    void CustomAttributes(Writer w, CustomAttributeHandleCollection attributes)
+    {
+        foreach (var handle in attributes)
+        {
+            var attribute = reader.GetCustomAttribute(handle);
+            w.Add("attribute", names.Entity(attribute.Constructor));
+            w.Add(reader.GetBlobBytes(attribute.Value));
+        }
+    }
+
+    void Constant(Writer w, ConstantHandle handle)
+    {
+        if (!handle.IsNil)
+        {
+            var constant = reader.GetConstant(handle);
+            w.Add("constant", (int)constant.TypeCode);
+            w.Add(reader.GetBlobBytes(constant.Value));
+        }
+    }
+
+    string Blob(BlobHandle handle)
+    {
+        return Convert.ToHexString(reader.GetBlobBytes(handle));
+    }
+}
+
+// SHA-256 of a sequence of values
+class Writer
+{
+    readonly IncrementalHash hash = IncrementalHash.CreateHash(HashAlgorithmName.SHA256);
+
+    public void Add(params object[] values)
+    {
+        foreach (var value in values)
+        {
+            if (value is byte[] bytes)
+            {
+                Add(bytes.Length);
+                hash.AppendData(bytes);
+                continue;
+            }
+            hash.AppendData(Encoding.UTF8.GetBytes(value.ToString() + "\0"));
+        }
+    }
+
+    public string Hash()
+    {
+        return Convert.ToHexString(hash.GetHashAndReset()).ToLowerInvariant();
+    }
+}
+
+// Names of types and members, as they appear in signatures and IL. The
+// top-level types referred to are collected in References.
+class Names : ISignatureTypeProvider<string, object?>
+{
+    readonly MetadataReader reader;
+    public HashSet<string> References = new(StringComparer.Ordinal);
+
+    public Names(MetadataReader reader)
+    {
+        this.reader = reader;
+    }
+
+    // like Type.FullName: Namespace.Outer+Inner`1
+    public string Type(TypeDefinitionHandle handle)
+    {
+        var type = reader.GetTypeDefinition(handle);
+        var name = reader.GetString(type.Name);
+        var declaring = type.GetDeclaringType();
+        if (!declaring.IsNil)
+        {
+            return Type(declaring) + "+" + name;
+        }
+        var ns = reader.GetString(type.Namespace);
+        return ns.Length == 0 ? name : ns + "." + name;
+    }
+
+    string Reference(TypeReferenceHandle handle)
+    {
+        var reference = reader.GetTypeReference(handle);
+        var name = reader.GetString(reference.Name);
+        if (reference.ResolutionScope.Kind == HandleKind.TypeReference)
+        {
+            return Reference((TypeReferenceHandle)reference.ResolutionScope) + "+" + name;
+        }
+        var ns = reader.GetString(reference.Namespace);
+        return ns.Length == 0 ? name : ns + "." + name;
+    }
+
+    string Refer(string fullName)
+    {
+        var plus = fullName.IndexOf('+');
+        References.Add(plus < 0 ? fullName : fullName.Substring(0, plus));
+        return fullName;
+    }
+
+    public string Entity(EntityHandle handle)
+    {
+        switch (handle.Kind)
+        {
+            case HandleKind.TypeDefinition:
+                return Refer(Type((TypeDefinitionHandle)handle));
+            case HandleKind.TypeReference:
+                return Refer(Reference((TypeReferenceHandle)handle));
+            case HandleKind.TypeSpecification:
+                return reader.GetTypeSpecification((TypeSpecificationHandle)handle).DecodeSignature(this, null);
+            case HandleKind.FieldDefinition:
+                {
+                    var field = reader.GetFieldDefinition((FieldDefinitionHandle)handle);
+                    return Entity(field.GetDeclaringType()) + "::" + reader.GetString(field.Name)
+                        + " " + field.DecodeSignature(this, null);
+                }
+            case HandleKind.MethodDefinition:
+                {
+                    var method = reader.GetMethodDefinition((MethodDefinitionHandle)handle);
+                    return Entity(method.GetDeclaringType()) + "::" + reader.GetString(method.Name)
+                        + Signature(method.DecodeSignature(this, null));
+                }
+            case HandleKind.MemberReference:
+                {
+                    var member = reader.GetMemberReference((MemberReferenceHandle)handle);
+                    var parent = member.Parent.Kind == HandleKind.ModuleReference
+                        ? reader.GetString(reader.GetModuleReference((ModuleReferenceHandle)member.Parent).Name)
+                        : Entity(member.Parent);
+                    var signature = member.GetKind() == MemberReferenceKind.Method
+                        ? Signature(member.DecodeMethodSignature(this, null))
+                        : " " + member.DecodeFieldSignature(this, null);
+                    return parent + "::" + reader.GetString(member.Name) + signature;
+                }
+            case HandleKind.MethodSpecification:
+                {
+                    var spec = reader.GetMethodSpecification((MethodSpecificationHandle)handle);
+                    return Entity(spec.Method) + "<" + string.Join(",", spec.DecodeSignature(this, null)) + ">";
+                }
+            case HandleKind.StandaloneSignature:
+                {
+                    var signature = reader.GetStandaloneSignature((StandaloneSignatureHandle)handle);
+                    return signature.GetKind() == StandaloneSignatureKind.Method
+                        ? Signature(signature.DecodeMethodSignature(this, null))
+                        : string.Join(",", signature.DecodeLocalSignature(this, null));
+                }
+            default:
+                return handle.Kind.ToString();
+        }
+    }
+
+    public string Method(MethodDefinitionHandle handle)
+    {
+        return handle.IsNil ? "" : reader.GetString(reader.GetMethodDefinition(handle).Name);
+    }
+
+    public string Signature(MethodSignature<string> signature)
+    {
+        return "(" + string.Join(",", signature.ParameterTypes) + "):" + signature.ReturnType
+            + " " + (int)signature.Header.CallingConvention + (signature.Header.IsInstance ? " instance" : "")
+            + (signature.GenericParameterCount > 0 ? " <" + signature.GenericParameterCount + ">" : "");
+    }
+
+    public string GetArrayType(string elementType, ArrayShape shape)
+    {
+        return elementType + "[" + shape.Rank + ":" + string.Join(",", shape.Sizes) + ":" + string.Join(",", shape.LowerBounds) + "]";
+    }
+
+    public string GetByReferenceType(string elementType) => elementType + "&";
+    public string GetFunctionPointerType(MethodSignature<string> signature) => "method " + Signature(signature);
+    public string GetGenericInstantiation(string genericType, ImmutableArray<string> typeArguments) => genericType + "<" + string.Join(",", typeArguments) + ">";
+    public string GetGenericMethodParameter(object? genericContext, int index) => "!!" + index;
+    public string GetGenericTypeParameter(object? genericContext, int index) => "!" + index;
+    public string GetModifiedType(string modifier, string unmodifiedType, bool isRequired) => unmodifiedType + (isRequired ? " modreq(" : " modopt(") + modifier + ")";
+    public string GetPinnedType(string elementType) => elementType + " pinned";
+    public string GetPointerType(string elementType) => elementType + "*";
+    public string GetPrimitiveType(PrimitiveTypeCode typeCode) => typeCode.ToString();
+    public string GetSZArrayType(string elementType) => elementType + "[]";
+    public string GetTypeFromDefinition(MetadataReader reader, TypeDefinitionHandle handle, byte rawTypeKind) => Refer(Type(handle));
+    public string GetTypeFromReference(MetadataReader reader, TypeReferenceHandle handle, byte rawTypeKind) => Refer(Reference(handle));
+    public string GetTypeFromSpecification(MetadataReader reader, object? genericContext, TypeSpecificationHandle handle, byte rawTypeKind) => reader.GetTypeSpecification(handle).DecodeSignature(this, genericContext);
+}
@@ -4,6 +4,7 @@ using System.IO;
 using System.Linq;
 using System.Reflection.Metadata;
 using System.Reflection.PortableExecutable;
+using System.Text.Json;
 
 namespace SpaceEngineers.ListReferences;
 
@@ -13,30 +14,50 @@ public class Program
     {
         if (args.Length == 0)
         {
-            Console.WriteLine($"Usage: <assembly path>");
+            Console.WriteLine($"Usage: <assembly path>...");
             Environment.Exit(1);
         }
-        var dir = Path.GetDirectoryName(args[0]);
-        var visited = new SortedSet<string>();
-        var queue = new Queue<string>();
-        queue.Enqueue(args[0]);
+        Console.WriteLine(JsonSerializer.Serialize(Graph(args)));
+    }
+
+    // Walk all roots at once, assemblies they share are only read once.
+    public static Dictionary<string, object> Graph(IEnumerable<string> files)
+    {
+        var roots = files.Select(Path.GetFullPath).ToList();
+        var nodes = new SortedSet<string>(StringComparer.Ordinal);
+        var edges = new List<string[]>();
+        var missing = new SortedSet<string>(StringComparer.Ordinal);
+        var queue = new Queue<string>(roots);
         while (queue.Any())
         {
             var file = queue.Dequeue();
-            visited.Add(Path.GetFileName(file));
-            foreach (var reference in ListReferences(file))
+            if (nodes.Contains(file) || missing.Contains(file)) continue;
+            if (!File.Exists(file))
+            {
+                missing.Add(file);
+                continue;
+            }
+            nodes.Add(file);
+            List<string> references;
+            try { references = ListReferences(file); }
+            catch (BadImageFormatException) { continue; /* not dotnet, e.g. native C++ */ }
+            catch (InvalidOperationException) { continue; /* no metadata */ }
+            var dir = Path.GetDirectoryName(file);
+            foreach (var reference in references)
             {
                 if (!isSpaceEngineers(reference)) continue;
                 var path = Path.Join(dir, reference + ".dll");
-                if (visited.Contains(Path.GetFileName(path))) continue;
-                try { queue.Enqueue(path); }
-                catch (BadImageFormatException) { /* not dotnet, e.g. native C++ */ }
+                edges.Add([file, path]);
+                queue.Enqueue(path);
             }
         }
-        foreach (var reference in visited)
+        return new Dictionary<string, object>
         {
-            Console.WriteLine(reference);
-        }
+            ["roots"] = roots,
+            ["nodes"] = nodes,
+            ["edges"] = edges,
+            ["missing"] = missing,
+        };
     }
 
     // List from the PE and its metadata instead of through Assembly.LoadFrom.
@@ -0,0 +1,967 @@
+#!/usr/bin/env python3
+# Benchmark decompile.py on synthetic game trees.
+#
+# Runs offline, without the game nor .NET: DecompilerHost, dotnet,
+# ListReferences, ExtractTypes and HashTypes are replaced by stubs (this script
+# with --stub) and the game assemblies by JSON files describing the projects
+# the DecompilerHost stub writes. The trees are shaped like the game's:
+# projects referencing each other, nested namespace directories, files of
+# various sizes with the code the fixes remove or rewrite, and patches
+# applying to it. The output of each benchmark is checked against the trees
+# the generator writes for it: a benchmark which gets faster by doing the
+# wrong thing fails.
+#
+# Times are compared with the baselines of benchmark.json, which are in units
+# of a calibration workload (in plain Python, timed before each run of a
+# benchmark, the best time counting) so that they hold on a faster or slower
+# machine. After speeding something up on purpose, run with
+# --update-baseline.
+
+import argparse
+import concurrent.futures
+import contextlib
+import difflib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Callable, Collection, Iterator, List, Optional, Tuple
+
+import decompile
+
+# (project, share of the files, game projects it references)
+PROJECTS: List[Tuple[str, float, List[str]]] = [
+    ('VRage.Library', 0.04, []),
+    ('VRage.Math', 0.02, ['VRage.Library']),
+    ('VRage', 0.10, ['VRage.Library', 'VRage.Math']),
+    ('VRage.Network', 0.02, ['VRage', 'VRage.Library']),
+    ('VRage.Game', 0.12, ['VRage', 'VRage.Library', 'VRage.Math']),
+    ('VRage.Render', 0.04, ['VRage', 'VRage.Library', 'VRage.Math']),
+    ('VRage.Render11', 0.06, ['VRage', 'VRage.Math', 'VRage.Render']),
+    ('VRage.Scripting', 0.02, ['VRage', 'VRage.Game', 'VRage.Library']),
+    ('Sandbox.Common', 0.04, ['VRage', 'VRage.Game', 'VRage.Math']),
+    ('Sandbox.Graphics', 0.04, ['Sandbox.Common', 'VRage', 'VRage.Render']),
+    ('Sandbox.Game', 0.34, ['Sandbox.Common', 'Sandbox.Graphics', 'VRage',
+                            'VRage.Game', 'VRage.Library', 'VRage.Math',
+                            'VRage.Network', 'VRage.Scripting']),
+    ('SpaceEngineers.ObjectBuilders', 0.06, ['VRage', 'VRage.Game']),
+    ('SpaceEngineers.Game', 0.08, ['Sandbox.Common', 'Sandbox.Game',
+                                   'SpaceEngineers.ObjectBuilders', 'VRage',
+                                   'VRage.Game', 'VRage.Math']),
+    ('SpaceEngineers', 0.02, ['Sandbox.Game', 'SpaceEngineers.Game', 'VRage',
+                              'VRage.Render11']),
+]
+
+# number of .cs files of each tree, the game has about 25000
+SIZES = {'small': 1000, 'medium': 5000, 'large': 25000}
+
+# share of the files with code for each fix
+FEATURES = {
+    'actor': 0.35,
+    'accessor': 0.25,
+    'sync-composer': 0.05,
+    'nullable': 0.03,
+    'repo-path': 0.02,
+    'sealed-invoke': 0.01,
+}
+
+# (fix, pattern, marker) of the blocks removed by the actor, accessor and
+# sync-composer fixes
+BLOCKS = [
+    ('actor', r'\s*private class \w+_003C_003EActor', '_003C_003EActor'),
+    ('accessor', r'\s*protected class \w+_003C_003EAccessor',
+     '_003C_003EAccessor'),
+    ('sync-composer', r'\s*protected class \w+003C_003ESyncComposer',
+     '003C_003ESyncComposer'),
+]
+
+WORDS = [
+    'Entity', 'Grid', 'Block', 'Cube', 'Character', 'Session', 'Physics',
+    'Render', 'Terminal', 'Inventory', 'Weapon', 'Thrust', 'Voxel', 'Planet',
+    'Cockpit', 'Conveyor', 'Sensor', 'Light', 'Gui', 'Screen', 'Control',
+    'Definition', 'Builder', 'Component', 'Replication', 'Projector',
+    'Assembler', 'Refinery', 'Antenna', 'Battery',
+]
+
+BASELINE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'benchmark.json')
+
+HOST_VERSION = 'DecompilerHost 9.0.0.7889-stub'
+
+TOOLS = ['DecompilerHost', 'dotnet', 'ListReferences', 'ExtractTypes',
+         'HashTypes']
+
+# types changed in the game assemblies of the delta benchmark, per project
+DELTA_CHANGES = {'VRage': 2, 'Sandbox.Game': 6, 'SpaceEngineers.Game': 2}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark decompile.py on synthetic game trees')
+    parser.add_argument('--size', action='append', choices=sorted(SIZES),
+                        help='Tree sizes to run (default: small and medium)')
+    parser.add_argument('--benchmark', action='append',
+                        choices=sorted(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help='Jobs of the parallel runs (default: %(default)s)')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='Keep the best of N runs, of 2N when slower than the baseline (default: %(default)s)')
+    parser.add_argument('--threshold', metavar='ratio', type=float,
+                        default=0.25,
+                        help='Fail when slower than the baseline by more than this (default: %(default)s)')
+    parser.add_argument('--min-delta', metavar='seconds', type=float,
+                        default=0.02,
+                        help='Ignore differences below this, as noise (default: %(default)s)')
+    parser.add_argument('--baseline', metavar='file', default=BASELINE,
+                        help='Baseline times (default: %(default)s)')
+    parser.add_argument(
+        '--update-baseline', action=argparse.BooleanOptionalAction,
+        default=False, help='Store the times as the new baselines')
+    parser.add_argument('--work-dir', metavar='directory',
+                        help='Generate the trees there and keep them (default: a temporary directory)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the logs of decompile.py')
+    return parser.parse_args()
+
+
+def main() -> None:
+    if sys.argv[1:2] == ['--stub']:
+        stub(sys.argv[2], sys.argv[3:])
+        return
+
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    assert args.jobs >= 1 and args.repeat >= 1
+    sizes = args.size or ['small', 'medium']
+    benchmarks = args.benchmark or list(BENCHMARKS)
+
+    baseline: dict[str, float] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='se-benchmark-')
+    # the best time of each benchmark, and the times of the calibration runs
+    # in between, of which the best is the speed of the machine
+    results = {}
+    calibration: List[float] = []
+    try:
+        for size in sizes:
+            corpus = Corpus(os.path.join(work_dir, size), SIZES[size])
+            corpus.setup()
+            for name in benchmarks:
+                for jobs in sorted({1, args.jobs}):
+                    if jobs > 1 and not BENCHMARKS[name][1]:
+                        continue  # sequential only
+                    key = '%s/%s' % (size, name)
+                    if jobs > 1:
+                        key += ' -j%i' % jobs
+                    times: List[float] = []
+                    for i in range(args.repeat * 2):
+                        if i == args.repeat:
+                            # a regression is confirmed by as many runs
+                            # more: the machine may have been busy
+                            base = baseline.get(key)
+                            if args.update_baseline or base is None or not slower(
+                                    min(times), base * min(calibration),
+                                    args.threshold, args.min_delta):
+                                break
+                            logging.info('%s: slower, again', key)
+                        calibration.append(calibrate(work_dir))
+                        with quiet(not args.verbose):
+                            times.append(BENCHMARKS[name][0](corpus, jobs))
+                    results[key] = min(times)
+                    logging.info('%s: %.3f s', key, results[key])
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    logging.info('calibration: %.3f s', min(calibration))
+    regressions = report(results, baseline, min(calibration), args.threshold,
+                         args.min_delta)
+    if args.update_baseline:
+        baseline.update({k: round(v / min(calibration), 3)
+                         for k, v in results.items()})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        logging.info('baselines updated: %s', args.baseline)
+    elif regressions:
+        logging.error('%i regressions', regressions)
+        exit(1)
+
+
+def report(results: dict[str, float], baseline: dict[str, float],
+           calibration: float, threshold: float, min_delta: float) -> int:
+    # the baselines are shown in seconds on this machine
+    regressions = 0
+    width = max(len(key) for key in results)
+    print('%-*s %10s %10s %8s' %
+          (width, 'benchmark', 'baseline', 'time', 'change'))
+    for key, t in results.items():
+        if key not in baseline:
+            print('%-*s %10s %10.3f %8s new' % (width, key, '-', t, '-'))
+            continue
+        base = baseline[key] * calibration
+        status = ''
+        if slower(t, base, threshold, min_delta):
+            status = 'REGRESSION'
+            regressions += 1
+        elif slower(base, t, threshold, min_delta):
+            status = 'faster'
+        print('%-*s %10.3f %10.3f %+7.0f%% %s' % (
+            width, key, base, t, (t / base - 1) * 100 if base else 0, status))
+    return regressions
+
+
+def slower(t: float, base: float, threshold: float, min_delta: float) -> bool:
+    return t > base * (1 + threshold) and t - base > min_delta
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool) -> Iterator[None]:
+    # decompile.py logs every project and file it touches
+    level = logging.getLogger().level
+    if enabled:
+        logging.getLogger().setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        logging.getLogger().setLevel(level)
+
+
+@contextlib.contextmanager
+def chdir(path: str) -> Iterator[None]:
+    # decompile.py works in the current directory
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+# A synthetic game and its decompiled tree, before and after the fixes, with
+# patches for the fixed tree. The generator writes each tree itself, which
+# the output of the benchmarks is compared with:
+#   game/          assemblies (JSON for the stubs) and native dependencies
+#   .NETFramework/ reference assemblies
+#   bin/           stubs
+#   patches/       patches of the fixed tree, per project
+#   decompiled/    as written by DecompilerHost
+#   fixed/         decompiled, as the fixes should leave it
+#   patched/       fixed, as the patches should leave it
+class Corpus(object):
+
+    def __init__(self, root: str, size: int):
+        self.root = os.path.abspath(root)
+        self.size = size
+        self.game_dir = os.path.join(self.root, 'game')
+        self.netframework = os.path.join(self.root, '.NETFramework', 'v4.8')
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.patch_dir = os.path.join(self.root, 'patches')
+        self.decompiled = os.path.join(self.root, 'decompiled')
+        self.fixed = os.path.join(self.root, 'fixed')
+        self.patched = os.path.join(self.root, 'patched')
+        self.names = [name for name, _, _ in PROJECTS]
+
+    def setup(self) -> None:
+        if os.path.isdir(self.patched):
+            logging.info('reuse: %s', self.root)
+        else:
+            logging.info('generate: %s (%i files)', self.root, self.size)
+            if os.path.isdir(self.root):
+                shutil.rmtree(self.root)
+            self.generate()
+        # the stubs of the tools, which may be new since the tree was made
+        os.makedirs(self.bin_dir, exist_ok=True)
+        for tool in TOOLS:
+            filename = os.path.join(self.bin_dir, tool)
+            with open(filename, 'w') as f:
+                f.write('#!/bin/sh\nexec "%s" "%s" --stub %s "$@"\n' % (
+                    sys.executable, os.path.abspath(__file__), tool))
+            os.chmod(filename, 0o755)
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        setattr(decompile, 'dotnet_binary',
+                lambda project: os.path.join(self.bin_dir, project))
+        # the code of the stubs
+        setattr(decompile, 'dotnet_assembly',
+                lambda project: os.path.abspath(__file__))
+        decompile.PATCH_DIR = self.patch_dir
+
+    def generate(self) -> None:
+        os.makedirs(self.game_dir)
+        for spec in assemblies(self.size).values():
+            with open(os.path.join(self.game_dir, spec['file']), 'w') as f:
+                json.dump(spec, f)
+        for dependency in ['HavokWrapper.dll', 'VRage.Native.dll', 'steam_api64.dll']:
+            pathlib.Path(self.game_dir, dependency).write_bytes(
+                random.Random(dependency).randbytes(2**16))
+        os.makedirs(self.netframework)
+        for assembly in ['mscorlib.dll', 'System.dll', 'System.Core.dll']:
+            pathlib.Path(self.netframework, assembly).touch()
+
+        for spec in assemblies(self.size).values():
+            write_project(spec, os.path.join(self.decompiled, spec['name']),
+                          self.game_dir, self.netframework)
+            write_project(spec, os.path.join(self.fixed, spec['name']),
+                          self.game_dir, self.netframework, FEATURES)
+        shutil.copytree(self.fixed, self.patched)
+        self.write_patches()
+
+    def write_patches(self) -> None:
+        # patches changing a few statements of some files, each file patched
+        # once, and the files they make in patched/. Some were made on a
+        # slightly different version, the hunks are then found at an offset.
+        for name, share, _ in PROJECTS:
+            rng = random.Random('patches %s' % name)
+            project_dir = os.path.join(self.fixed, name)
+            files = sorted(os.path.relpath(os.path.join(root, f), self.fixed)
+                           for root, _, fs in os.walk(project_dir) for f in fs
+                           if f.endswith('.cs'))
+            count = min(12, 1 + len(files) // 200)
+            chosen = rng.sample(files, min(len(files), count * 2))
+            os.makedirs(os.path.join(self.patch_dir, name))
+            for i in range(count):
+                diff: List[str] = []
+                for path in chosen[i * 2:i * 2 + 2]:
+                    with open(os.path.join(self.fixed, path)) as f:
+                        old = f.readlines()
+                    new = patch(rng, old)
+                    with open(os.path.join(self.patched, path), 'w') as f:
+                        f.writelines(new)
+                    # drop some using lines on both sides: the hunks are
+                    # then off by as many lines in the tree
+                    shift = rng.choice([0, 0, 1, 2])
+                    diff += difflib.unified_diff(
+                        old[shift:], new[shift:],
+                        'a/' + path.replace(os.sep, '/'),
+                        'b/' + path.replace(os.sep, '/'))
+                if not diff:
+                    continue
+                filename = os.path.join(
+                    self.patch_dir, name, 'synthetic-%02i.patch' % i)
+                with open(filename, 'w') as f:
+                    f.writelines(diff)
+
+    def copy(self, tree: str, path: str) -> str:
+        # a fresh output directory with the given tree
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        shutil.copytree(tree, path)
+        return path
+
+    def projects(self) -> dict[str, str]:
+        return {name: os.path.join(self.game_dir, spec['file'])
+                for name, spec in assemblies(self.size).items()}
+
+    def update(self, path: str) -> str:
+        # a next version of the game: some types changed in a few assemblies
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        shutil.copytree(self.game_dir, path)
+        for spec in self.changed():
+            with open(os.path.join(path, spec['file']), 'w') as f:
+                json.dump(spec, f)
+        return path
+
+    def expected(self, path: str, selected: Optional[str] = None) -> str:
+        # patched/ for the next version of the game, or with only the type
+        # selected of it
+        self.copy(self.patched, path)
+        for spec in self.changed():
+            for namespace, name, i in types(spec):
+                if i not in spec['changed'] or selected not in (
+                        None, '%s.%s' % (namespace, name)):
+                    continue
+                filename = os.path.join(path, spec['name'],
+                                        *namespace.split('.'), name + '.cs')
+                with open(filename) as f:
+                    text = change(f.read())
+                with open(filename, 'w') as f:
+                    f.write(text)
+        return path
+
+    def changed(self) -> List[dict[str, Any]]:
+        # the assemblies which change in the next version of the game
+        specs = []
+        for name, count in DELTA_CHANGES.items():
+            spec = assemblies(self.size)[name]
+            spec['changed'] = list(
+                range(1, spec['files'], spec['files'] // count + 1))
+            specs.append(spec)
+        return specs
+
+
+def assemblies(size: int) -> dict[str, dict[str, Any]]:
+    # what the stubs need to know about each assembly
+    return {name: {
+        'name': name,
+        'file': name + ('.exe' if name == 'SpaceEngineers' else '.dll'),
+        'files': max(1, round(size * share)),
+        'references': references,
+    } for name, share, references in PROJECTS}
+
+
+def patch(rng: random.Random, old: List[str]) -> List[str]:
+    # the lines of a patched file
+    candidates = [i for i, line in enumerate(old)
+                  if line.startswith('\t\t\t') and line.rstrip().endswith(';')]
+    new = list(old)
+    for i in sorted(rng.sample(candidates, min(3, len(candidates))), reverse=True):
+        new[i] = new[i].rstrip('\n') + ' // patched\n'
+        if rng.random() < 0.3:
+            new.insert(i + 1, old[i][:len(old[i]) - len(old[i].lstrip())] +
+                       'MyLog.Default.WriteLine("patched");\n')
+    return new
+
+
+def write_project(spec: dict[str, Any], directory: str, game_dir: str,
+                  netframework: str, fixes: Collection[str] = ()) -> None:
+    # what DecompilerHost writes for an assembly, as the given fixes leave it
+    name = spec['name']
+    os.makedirs(directory)
+    with open(os.path.join(directory, name + '.csproj'), 'w') as f:
+        f.write(csproj(spec, game_dir, netframework))
+    os.makedirs(os.path.join(directory, 'Properties'))
+    with open(os.path.join(directory, 'Properties', 'AssemblyInfo.cs'), 'w') as f:
+        f.write(
+            'using System.Reflection;\n\n[assembly: AssemblyTitle("%s")]\n[assembly: AssemblyVersion("1.0.0.0")]\n' % name)
+    for namespace, class_name, i in types(spec):
+        path = os.path.join(directory, *namespace.split('.'))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, class_name + '.cs'), 'w') as f:
+            f.write(type_source(spec, namespace, class_name, i, fixes))
+
+
+def types(spec: dict[str, Any]) -> Iterator[Tuple[str, str, int]]:
+    # the (namespace, name, index) of each type of an assembly
+    name = spec['name']
+    rng = random.Random(name)
+    namespaces = [name] + ['%s.%s' % (name, word) for word in
+                           rng.sample(WORDS, min(len(WORDS), spec['files'] // 40))]
+    if name == 'VRage':
+        # VRage/Network/OriginalTypes.cs is written there
+        namespaces.insert(0, 'VRage.Network')
+    for i in range(spec['files']):
+        namespace = namespaces[0] if i == 0 else rng.choice(namespaces)
+        class_name = 'My%s%s%i' % (rng.choice(WORDS), rng.choice(WORDS), i)
+        yield namespace, class_name, i
+
+
+def type_source(spec: dict[str, Any], namespace: str, name: str, i: int,
+                fixes: Collection[str] = ()) -> str:
+    # each type has its own random generator: the stubs make any one alone
+    text = source(random.Random('%s %i' % (spec['name'], i)), namespace, name,
+                  fixes)
+    if i in spec.get('changed', []):
+        text = change(text)
+    return text
+
+
+def change(text: str) -> str:
+    # a type as it is in the next version of the game
+    return text.replace('\tprivate int m_count;\n',
+                        '\tprivate int m_count;\n\n\tprivate int m_changed;\n', 1)
+
+
+def csproj(spec: dict[str, Any], game_dir: str, netframework: str) -> str:
+    references = [(r, os.path.join(game_dir, r + '.dll'))
+                  for r in spec['references']]
+    references += [(r, os.path.join(netframework, r + '.dll'))
+                   for r in ['System', 'System.Core']]
+    if spec['name'] == 'Sandbox.Game':
+        references += [(r, os.path.join(game_dir, r + '.dll'))
+                       for r in ['HavokWrapper', 'ProtoBuf.Net', 'Newtonsoft.Json']]
+    items = ''.join('''    <Reference Include="%s">
+      <HintPath>%s</HintPath>
+    </Reference>
+''' % (include, hint_path) for include, hint_path in sorted(references))
+    return '''<Project Sdk="Microsoft.NET.Sdk">
+  <PropertyGroup>
+    <AssemblyName>%s</AssemblyName>
+    <GenerateAssemblyInfo>False</GenerateAssemblyInfo>
+    <OutputType>%s</OutputType>
+    <TargetFramework>net48</TargetFramework>
+  </PropertyGroup>
+  <PropertyGroup>
+    <LangVersion>12.0</LangVersion>
+    <AllowUnsafeBlocks>True</AllowUnsafeBlocks>
+  </PropertyGroup>
+  <PropertyGroup>
+    <RootNamespace />
+  </PropertyGroup>
+  <ItemGroup>
+%s  </ItemGroup>
+</Project>
+''' % (spec['name'], 'WinExe' if spec['file'].endswith('.exe') else 'Library', items)
+
+
+def source(rng: random.Random, namespace: str, name: str,
+           fixes: Collection[str] = ()) -> str:
+    # a class as ILSpy writes it, with code for some of the fixes, or as
+    # those in fixes leave it: the random draws are the same either way
+    features = {f for f, share in FEATURES.items() if rng.random() < share}
+    # (the fix removing it, member)
+    members: List[Tuple[str, str]] = []
+    for i in range(min(300, int(rng.lognormvariate(2.0, 1.0)) + 1)):
+        members.append(('', method(rng, name, i, features, fixes)))
+    if 'sync-composer' in features:
+        members.insert(rng.randrange(len(members) + 1), ('sync-composer', '''	protected class m_value_003C_003ESyncComposer : ISyncComposer
+	{
+		public sealed override void Compose(%s obj, int index, ISyncType target)
+		{
+			((%s)obj).m_value = (Sync<float, SyncDirection.BothWays>)target;
+		}
+	}
+''' % (name, name)))
+    if 'accessor' in features:
+        members.insert(rng.randrange(len(members) + 1), ('accessor', '''	protected class %s_003C_003Em_count_003C_003EAccessor : IMemberAccessor<%s, int>
+	{
+		[MethodImpl(MethodImplOptions.AggressiveInlining)]
+		public sealed override void Set(ref %s owner, in int value)
+		{
+			owner.m_count = value;
+		}
+
+		[MethodImpl(MethodImplOptions.AggressiveInlining)]
+		public sealed override void Get(ref %s owner, out int value)
+		{
+			value = owner.m_count;
+		}
+	}
+''' % (namespace.replace('.', '_'), name, name, name)))
+    if 'actor' in features:
+        members.append(('actor', '''	private class %s_003C_003EActor : IActivator, IActivator<%s>
+	{
+		private sealed override object CreateInstance()
+		{
+			return new %s();
+		}
+
+		private sealed override %s CreateInstance()
+		{
+			return new %s();
+		}
+	}
+''' % (name, name, name, name, name)))
+    fields = '\tprivate int m_count;\n\n\tprivate readonly List<string> m_names = new List<string>();\n'
+    if 'nullable' in features:
+        fields += '\n\t[%s]\n\tpublic float? m_value;\n' % (
+            'VRage.Serialization.Nullable' if 'nullable' in fixes else 'Nullable')
+    return '''using System;
+using System.Collections.Generic;
+using System.Runtime.CompilerServices;
+using VRage.Network;
+
+namespace %s;
+
+[StaticEventOwner]
+public class %s : IMyEventProxy
+{
+%s
+%s}
+''' % (namespace, name, fields,
+       '\n'.join(m for fix, m in members if fix not in fixes))
+
+
+def method(rng: random.Random, name: str, i: int, features: set[str],
+           fixes: Collection[str]) -> str:
+    word = rng.choice(WORDS)
+    body = ['\t\tif (value > m_count)\n', '\t\t{\n',
+            '\t\t\tm_count = value;\n', '\t\t}\n']
+    for _ in range(rng.randrange(1, 6)):
+        kind = rng.randrange(4)
+        if kind == 0:
+            body += ['\t\tforeach (string item in m_names)\n', '\t\t{\n',
+                     '\t\t\tMyLog.Default.WriteLine(string.Format("{0}: {1}", item, value));\n',
+                     '\t\t}\n']
+        elif kind == 1:
+            body += ['\t\t// keep { and } balanced in the caller\n',
+                     "\t\tchar open = '{';\n"]
+        elif kind == 2:
+            body += ['\t\tfor (int i = 0; i < m_names.Count; i++)\n', '\t\t{\n',
+                     '\t\t\tm_names[i] = m_names[i].Trim();\n', '\t\t}\n']
+        else:
+            body += ['\t\tm_count += %s(value * %i);\n' % (word, i)]
+    if 'repo-path' in features and i == 0:
+        body.append('\t\tMyLog.Default.WriteLine("%s%s\\\\%s.cs");\n' % (
+            '' if 'repo-path' in fixes else 'E:\\\\Repo1\\\\Sources\\\\',
+            name, name))
+    if 'sealed-invoke' in features and i == 0:
+        modifiers = 'public void Invoke' if 'sealed-invoke' in fixes else 'public sealed void Invoke'
+    else:
+        modifiers = 'public void %s%s%i' % ('Update', word, i)
+    return '\t%s(int value)\n\t{\n%s\t}\n' % (modifiers, ''.join(body))
+
+
+def stub(tool: str, args: List[str]) -> None:
+    if tool == 'dotnet':
+        return  # check() needs it in PATH, dotnet_build() runs it
+    if tool == 'DecompilerHost':
+        if '--version' in args:
+            print(HOST_VERSION)
+            return
+        output = args[args.index('-o') + 1]
+        netframework = args[args.index('--referencepath') + 1]
+        files = [a for a in args if a.endswith(('.dll', '.exe'))]
+        if '-t' in args:
+            # a single type, written as <assembly>.decompiled.cs
+            with open(files[0]) as f:
+                spec = json.load(f)
+            for namespace, name, i in types(spec):
+                if '%s.%s' % (namespace, name) == args[args.index('-t') + 1]:
+                    with open(os.path.join(output, spec['name'] + '.decompiled.cs'), 'w') as f:
+                        f.write(type_source(spec, namespace, name, i))
+            return
+        for filename in files:
+            with open(filename) as f:
+                spec = json.load(f)
+            write_project(spec, os.path.join(output, spec['name']),
+                          os.path.dirname(filename), netframework)
+            print(os.path.abspath(filename), flush=True)
+        return
+    if tool == 'ListReferences':
+        roots = [os.path.abspath(f) for f in args]
+        nodes: set[str] = set()
+        edges = []
+        missing: set[str] = set()
+        queue = list(roots)
+        while queue:
+            filename = queue.pop(0)
+            if filename in nodes or filename in missing:
+                continue
+            if not os.path.exists(filename):
+                missing.add(filename)
+                continue
+            nodes.add(filename)
+            with open(filename) as f:
+                spec = json.load(f)
+            for reference in spec['references']:
+                path = os.path.join(os.path.dirname(
+                    filename), reference + '.dll')
+                edges.append([filename, path])
+                queue.append(path)
+        print(json.dumps({'roots': roots, 'nodes': sorted(nodes), 'edges': edges,
+                          'missing': sorted(missing)}))
+        return
+    if tool == 'ExtractTypes':
+        game_dir = args[-1]
+        names = sorted(f for f in os.listdir(game_dir) if f.endswith('.dll'))
+        print('using System.Collections.Generic;\n\nnamespace VRage.Network;\n')
+        print('public class OriginalTypes\n{')
+        print(
+            '\tpublic static readonly Dictionary<string, string[]> List = new Dictionary<string, string[]> {')
+        for name in names:
+            print('\t\t{"%s", new string[] {' % name)
+            for i in range(100):
+                print('\t\t\t\t"%s.MyType%i",' %
+                      (os.path.splitext(name)[0], i))
+            print('\t\t\t}\n\t\t},')
+        print('\t};\n}')
+        return
+    if tool == 'HashTypes':
+        hashes = {}
+        for filename in args:
+            with open(filename) as f:
+                spec = json.load(f)
+            hashes[os.path.abspath(filename)] = {
+                'assembly': hashlib.sha256(json.dumps(
+                    [spec['name'], spec['references']]).encode('utf-8')).hexdigest(),
+                'types': {'%s.%s' % (namespace, name): {
+                    'namespace': namespace,
+                    'name': name,
+                    # what type_source() depends on
+                    'hash': hashlib.sha256(json.dumps(
+                        [namespace, name, i, i in spec.get('changed', [])]).encode('utf-8')).hexdigest(),
+                    'references': [],
+                } for namespace, name, i in types(spec)},
+            }
+        print(json.dumps(hashes))
+        return
+    raise Exception('unknown stub: %s' % tool)
+
+
+def timed(fn: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def compare(path: str, expected: str) -> None:
+    # the .cs files of the output of a benchmark must be those of the tree
+    # expected, but OriginalTypes.cs (from the ExtractTypes stub)
+    def sources(tree: str) -> dict[str, bytes]:
+        files = {}
+        for root, dirs, names in os.walk(tree):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for f in names:
+                if f.endswith('.cs') and f != 'OriginalTypes.cs':
+                    filename = os.path.join(root, f)
+                    files[os.path.relpath(filename, tree)] = pathlib.Path(
+                        filename).read_bytes()
+        return files
+    actual, wanted = sources(path), sources(expected)
+    wrong = sorted(f for f in set(actual) | set(wanted)
+                   if actual.get(f) != wanted.get(f))
+    if wrong:
+        raise Exception('%s: %i files not as in %s: %s' % (
+            path, len(wrong), expected, ', '.join(wrong[:5])))
+
+
+def calibrate(work_dir: str) -> float:
+    # the time of a workload independent of decompile.py, of the kinds of
+    # work of the benchmarks: regex and string work on a hundred files, which
+    # are written and read back, and starting a stub
+    sources = [source(random.Random('calibration %i' % i), 'Calibration',
+                      'MyCalibration%i' % i) for i in range(100)]
+    path = os.path.join(work_dir, 'calibration')
+
+    def run() -> None:
+        os.makedirs(path)
+        for i, s in enumerate(sources):
+            for _, pattern, _ in BLOCKS:
+                s = re.sub(pattern, '', s)
+            filename = os.path.join(path, '%i.cs' % i)
+            pathlib.Path(filename).write_text(s)
+            hashlib.sha256(pathlib.Path(filename).read_bytes()).hexdigest()
+        subprocess.run([sys.executable, '-c', ''], check=True)
+        shutil.rmtree(path)
+    return timed(run)
+
+
+def bench_remove_block(corpus: Corpus, jobs: int) -> float:
+    # the block removal fixes alone, on the files they apply to, in memory
+    blocks = [fix for fix, _, _ in BLOCKS]
+    sources = []
+    expected = []
+    for spec in assemblies(corpus.size).values():
+        for namespace, name, i in types(spec):
+            sources.append(type_source(spec, namespace, name, i))
+            expected.append(type_source(spec, namespace, name, i, blocks))
+    results = []
+
+    def run() -> None:
+        for s in sources:
+            for _, pattern, marker in BLOCKS:
+                if marker in s:
+                    s = decompile.remove_block(pattern, s)
+            results.append(s)
+    t = timed(run)
+    wrong = sum(r != e for r, e in zip(results, expected))
+    if wrong:
+        raise Exception('remove_block: %i of %i sources not as expected' %
+                        (wrong, len(expected)))
+    return t
+
+
+def bench_fixes(corpus: Corpus, jobs: int) -> float:
+    path = corpus.copy(corpus.decompiled, os.path.join(corpus.root, 'work'))
+    with chdir(path):
+        workspace = decompile.Workspace()
+        executor = None
+        if jobs > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            executor.submit(int).result()
+
+        def run() -> None:
+            for name in corpus.names:
+                decompile.fixes(workspace, name, jobs, executor)
+        try:
+            t = timed(run)
+        finally:
+            if executor:
+                executor.shutdown()
+    compare(path, corpus.fixed)
+    return t
+
+
+def bench_index(corpus: Corpus, jobs: int) -> float:
+    # indexing the whole tree, as the first run does
+    path = corpus.copy(corpus.fixed, os.path.join(corpus.root, 'work'))
+    with chdir(path):
+        workspace = decompile.Workspace()
+        files = {name: {'stat': [st.st_size, st.st_mtime_ns],
+                        'sha256': decompile.file_digest(name)}
+                 for name, st in workspace.entries.items()
+                 if name.endswith('.cs')}
+        os.makedirs('.decompile')
+        executor = None
+        if jobs > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            executor.submit(int).result()
+
+        def run() -> None:
+            index = decompile.SymbolIndex('.decompile')
+            for name in corpus.names:
+                index.update(workspace, name, jobs, executor)
+            index.save(files)
+        try:
+            t = timed(run)
+        finally:
+            if executor:
+                executor.shutdown()
+        # each file declares its type
+        with contextlib.closing(sqlite3.connect(os.path.join(
+                '.decompile', decompile.INDEX_FILE))) as db:
+            classes = set(db.execute(
+                "SELECT path, full_name FROM symbols WHERE kind = 'class'"))
+    expected = {('/'.join([spec['name']] + namespace.split('.') + [name + '.cs']),
+                 '%s.%s' % (namespace, name))
+                for spec in assemblies(corpus.size).values()
+                for namespace, name, _ in types(spec)}
+    if classes != expected:
+        raise Exception('index: %i classes missing, %i unexpected' % (
+            len(expected - classes), len(classes - expected)))
+    return t
+
+
+def bench_patches(corpus: Corpus, jobs: int) -> float:
+    path = corpus.copy(corpus.fixed, os.path.join(corpus.root, 'work'))
+    with chdir(path):
+        workspace = decompile.Workspace()
+        patches = decompile.Patches(workspace, corpus.projects(), True, False,
+                                    None)
+
+        def run() -> None:
+            for name in corpus.names:
+                if name in patches.groups:
+                    patches.apply(name)
+            patches.finish()
+        t = timed(run)
+    compare(path, corpus.patched)
+    return t
+
+
+def bench_project(corpus: Corpus, jobs: int) -> float:
+    # only the .csproj files are needed
+    path = os.path.join(corpus.root, 'work')
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    for name in corpus.names:
+        os.makedirs(os.path.join(path, name))
+        shutil.copyfile(os.path.join(corpus.decompiled, name, name + '.csproj'),
+                        os.path.join(path, name, name + '.csproj'))
+    with chdir(path):
+        graph = decompile.ProjectGraph(decompile.Workspace(), corpus.names)
+
+        def run() -> None:
+            for name in corpus.names:
+                graph.update(name)
+        t = timed(run)
+    # the references to the game assemblies are those to their projects
+    for name, _, references in PROJECTS:
+        with open(os.path.join(path, name, name + '.csproj')) as f:
+            found = re.findall(
+                r'<ProjectReference Include="([^"]*)"', f.read())
+        if sorted(found) != sorted('../%s/%s.csproj' % (r, r) for r in references):
+            raise Exception('project %s: references %s' % (name, found))
+    return t
+
+
+def bench_solution(corpus: Corpus, jobs: int) -> float:
+    path = corpus.copy(corpus.fixed, os.path.join(corpus.root, 'work'))
+    with chdir(path):
+        workspace = decompile.Workspace()
+        t = timed(lambda: decompile.create_solution(
+            workspace, 'SpaceEngineers.slnx'))
+        with open('SpaceEngineers.slnx') as f:
+            found = re.findall(r'<Project Path="([^"]*)"', f.read())
+    if sorted(found) != sorted('%s/%s.csproj' % (n, n) for n in corpus.names):
+        raise Exception('solution: projects %s' % found)
+    return t
+
+
+def bench_pipeline(corpus: Corpus, jobs: int) -> float:
+    # a whole run, decompiling with the DecompilerHost stub: the stub itself is
+    # most of the decompile step, about as long as the fixes
+    path = os.path.join(corpus.root, 'work')
+    t = timed(pipeline(corpus, corpus.game_dir, path, jobs))
+    compare(path, corpus.patched)
+    return t
+
+
+def bench_delta(corpus: Corpus, jobs: int) -> float:
+    # a run on the next version of the game, from the tree of the previous
+    # one: most projects are copied, a few types decompiled one by one. With
+    # the stubs, decompiling is as cheap as copying: this measures the
+    # overhead of the copy, the plan and the DecompilerHost runs per type
+    baseline = os.path.join(corpus.root, 'work-baseline')
+    pipeline(corpus, corpus.game_dir, baseline, jobs)()
+    game_dir = corpus.update(os.path.join(corpus.root, 'game-next'))
+    path = os.path.join(corpus.root, 'work')
+    t = timed(pipeline(corpus, game_dir, path, jobs, '--baseline', baseline))
+    compare(path, corpus.expected(os.path.join(corpus.root, 'expected')))
+    return t
+
+
+def bench_select(corpus: Corpus, jobs: int) -> float:
+    # a type of the next version of the game, looked up (--type) in the tree
+    # of the previous one
+    tree = os.path.join(corpus.root, 'work-baseline')
+    pipeline(corpus, corpus.game_dir, tree, jobs)()
+    game_dir = corpus.update(os.path.join(corpus.root, 'game-next'))
+    namespace, name, _ = list(
+        types(assemblies(corpus.size)['Sandbox.Game']))[1]
+    path = os.path.join(corpus.root, 'work')
+    run = pipeline(corpus, game_dir, path, jobs,
+                   '--type', '%s.%s' % (namespace, name))
+    shutil.copytree(tree, path, symlinks=True, dirs_exist_ok=True)
+    t = timed(run)
+    compare(path, corpus.expected(os.path.join(corpus.root, 'expected'),
+                                  '%s.%s' % (namespace, name)))
+    return t
+
+
+def pipeline(corpus: Corpus, game_dir: str, path: str, jobs: int,
+             *extra: str) -> Callable[[], None]:
+    # a run of decompile.py in a new directory path
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    argv = sys.argv
+    sys.argv = ['decompile.py', '--file',
+                os.path.join(game_dir, 'SpaceEngineers.exe'),
+                '--netframework', corpus.netframework, '--no-cache',
+                '--jobs', str(jobs), '--no-ignore-broken-patches',
+                '--decompiler-host'] + list(extra)
+    try:
+        args = decompile.parse_args()
+    finally:
+        sys.argv = argv
+    decompile.check(args)
+
+    def run() -> None:
+        with chdir(path):
+            decompile.run_pipeline(args)
+    return run
+
+
+# name: (function, whether it also runs with -j)
+BENCHMARKS: dict[str, Tuple[Callable[[Corpus, int], float], bool]] = {
+    'remove_block': (bench_remove_block, False),
+    'fixes': (bench_fixes, True),
+    'patches': (bench_patches, False),
+    'project': (bench_project, False),
+    'solution': (bench_solution, False),
+    'pipeline': (bench_pipeline, True),
+    'delta': (bench_delta, True),
+    'select': (bench_select, False),
+    'index': (bench_index, True),
+}
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,45 @@
 # Decompile Space Engineers.
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import fnmatch
+import functools
 import glob
+import graphlib
+import hashlib
+import json
 import logging
 import os
 import pathlib
 import re
+import select
 import shutil
+import socket
+import sqlite3
 import stat
 import string
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-from typing import Any, cast, List
+from typing import Any, Callable, cast, Collection, Coroutine, IO, Iterator, List, Optional, Tuple, TypeVar
 
 import lxml.etree
 
+if sys.platform != 'win32':
+    import fcntl
+    import resource
+
+import patcher
+
+T = TypeVar('T')
+
 
 PACKAGES = {k: {'Include': v.get('Include', k), 'Version': v['Version']}
             for k, v in {
@@ -91,6 +116,8 @@ RUNTIME_DEPENDENCIES = SERVER_RUNTIME_DEPENDENCIES + [
     'msvcr120.dll',
 ]
 
+PATCH_DIR = os.path.join(os.path.dirname(__file__), 'patches')
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -99,14 +126,38 @@ def parse_args() -> argparse.Namespace:
                         help='Decompile this file and its related references')
     parser.add_argument('--netframework', metavar='directory',
                         help='Path to .NET Framework assemblies')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='Run up to N steps (and fixes or patches processes) in parallel; the decompiler uses all cores')
+    parser.add_argument(
+        '--decompiler-host', action=argparse.BooleanOptionalAction, default=False,
+        help='Decompile with DecompilerHost instead of ilspycmd: one process for all the assemblies, and single types for delta runs and --type (needs ICSharpCode.Decompiler restored)')
+    parser.add_argument(
+        '--cache', action=argparse.BooleanOptionalAction, default=True,
+        help='Reuse decompiled projects and reference graphs of unchanged assemblies')
+    parser.add_argument('--cache-dir', metavar='directory',
+                        default=default_cache_dir(),
+                        help='Cache directory (default: %(default)s)')
+    parser.add_argument('--cache-size', metavar='GiB', type=float, default=4,
+                        help='Evict least recently used entries above this size (default: %(default)s)')
 
     parser.add_argument(
         '--clean', action=argparse.BooleanOptionalAction, default=False,
         help='Empty current directory (except dotfiles) before starting')
     parser.add_argument(
         '--dependencies', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        '--link-dependencies', action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Reflink or hardlink the dependencies from the game when the file system allows it, instead of copying them')
     parser.add_argument(
         '--decompile', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--baseline', metavar='directory',
+                        help='Start from the tree decompiled there from other versions of the assemblies, decompiling only the types which changed (see .decompile/delta.json)')
+    parser.add_argument('--type', metavar='name', action='append', default=[],
+                        help='Decompile only this type (full name, wildcards allowed) into the tree, fixing and patching only its file')
+    parser.add_argument('--namespace', metavar='name', action='append',
+                        default=[],
+                        help='Decompile only the types of this namespace and the namespaces within, like --type')
     parser.add_argument(
         '--xml-serializers', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument(
@@ -115,66 +166,510 @@ def parse_args() -> argparse.Namespace:
         '--patches', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument(
         '--ignore-broken-patches', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        '--verify-types', action=argparse.BooleanOptionalAction, default=False,
+        help='Extract the types again even if they are cached, checking those read from the metadata against the game itself by reflection')
+    parser.add_argument(
+        '--refresh-patches', action=argparse.BooleanOptionalAction, default=False,
+        help='Relocate the hunks of broken patches and rewrite the patches, reported in .decompile/%s' % REFRESH_FILE)
     parser.add_argument(
         '--projects', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument(
         '--solution', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        '--build', action=argparse.BooleanOptionalAction, default=False,
+        help='Build each project as soon as it and the projects it references are generated, then report their compile times and map the errors to the patch or fix rules which last changed their file (see .decompile/build)')
+    parser.add_argument(
+        '--index', action=argparse.BooleanOptionalAction, default=True,
+        help='Keep an index of the types and members declared in the tree, for decompile.py lookup')
+    parser.add_argument('--store', metavar='directory',
+                        help='Also archive the tree in this content-addressed store, shared by the game versions (see decompile.py checkout)')
+    parser.add_argument('--store-version', metavar='name',
+                        help='The version of the tree in the store')
+    parser.add_argument('--git-fast-import', metavar='repository',
+                        help='Also commit the tree to this git repository through git fast-import, without checking it out, over the files of the branch (those not generated are kept): only the files which changed since the last commit are read')
+    parser.add_argument('--git-branch', metavar='name',
+                        help='The branch to commit to (default: the repository\'s HEAD)')
+    parser.add_argument('--git-message', metavar='text',
+                        help='The commit message (default: the --store-version, or the assemblies)')
+    parser.add_argument(
+        '--watch', action=argparse.BooleanOptionalAction, default=False,
+        help='Then watch the directory of the first --file and, once the game is updated there, run again on the assemblies which changed, keeping the others\' projects as they are')
+    parser.add_argument('--profile', metavar='file',
+                        help='Write a Chrome trace of the run (chrome://tracing, ui.perfetto.dev) and its summary table as file.txt')
+    parser.add_argument('--project-graph', metavar='file', action='append',
+                        default=[],
+                        help='Write the project dependency graph and build order, as DOT if file ends with .dot, JSON otherwise')
     return parser.parse_args()
 
 
+def parse_client_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='decompile.py client',
+        description='Send a request to the decompiler daemon, which keeps the assemblies loaded; it starts on first use')
+    parser.add_argument('--socket', metavar='file',
+                        default=os.path.join(
+                            default_cache_dir(), 'daemon.sock'),
+                        help='Unix socket of the daemon (default: %(default)s)')
+    parser.add_argument('--netframework', metavar='directory',
+                        help='Path to .NET Framework assemblies, when starting the daemon')
+    parser.add_argument('--idle-timeout', metavar='seconds', type=float,
+                        default=300,
+                        help='Unload assemblies unused for this long, then stop, when starting the daemon (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('type', help='Print the source of a type')
+    command.add_argument('assembly')
+    command.add_argument('type', help='Full name, Namespace.Name`1')
+    command = commands.add_parser(
+        'assembly', help='Decompile an assembly into a project directory, as the pipeline does')
+    command.add_argument('assembly')
+    command.add_argument('-o', '--output', metavar='directory', required=True)
+    command = commands.add_parser(
+        'references', help='Print the reference graph of assemblies as JSON, like ListReferences')
+    command.add_argument('file', nargs='+')
+    command = commands.add_parser(
+        'extract-types', help='Print VRage/Network/OriginalTypes.cs for the game there, like ExtractTypes')
+    command.add_argument('game_dir')
+    command.add_argument(
+        '--verify', action=argparse.BooleanOptionalAction, default=False,
+        help='Check the types read from the metadata against the game itself by reflection')
+    commands.add_parser('stop', help='Stop the daemon')
+    return parser.parse_args(argv)
+
+
+def parse_lookup_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='decompile.py lookup',
+        description='Find where a type or member is declared in a decompiled tree, from its index')
+    parser.add_argument('symbol',
+                        help='Name, Type.Member or full name, wildcards allowed')
+    parser.add_argument('-C', '--directory', metavar='directory', default='.',
+                        help='The decompiled tree (default: current directory)')
+    parser.add_argument('--kind', choices=['class', 'struct', 'interface', 'enum', 'record', 'delegate', 'method', 'constructor', 'destructor', 'operator', 'property', 'indexer', 'field', 'event'],
+                        help='Only the symbols of this kind')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--derived', action='store_true',
+                       help='Find the types deriving from or implementing the type instead')
+    group.add_argument('--attribute', action='store_true',
+                       help='Find the symbols with the attribute instead')
+    return parser.parse_args(argv)
+
+
+def parse_checkout_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='decompile.py checkout',
+        description='Make the tree of a version archived with --store, hardlinking the files of the store')
+    parser.add_argument('version', nargs='?',
+                        help='The version (default: list them)')
+    parser.add_argument('--store', metavar='directory', required=True,
+                        help='The store')
+    parser.add_argument('-o', '--output', metavar='directory',
+                        help='The tree to make, which must not exist or be empty (default: the version)')
+    return parser.parse_args(argv)
+
+
 def main() -> None:
-    args = parse_args()
     logging.basicConfig(
         level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    if sys.argv[1:2] == ['client']:
+        client(parse_client_args(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ['lookup']:
+        lookup(parse_lookup_args(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ['checkout']:
+        checkout(parse_checkout_args(sys.argv[2:]))
+        return
 
+    args = parse_args()
     check(args)
-    dotnet_build('ExtractTypes')
-    dotnet_build('ListReferences')
-    game_dir = os.path.dirname(args.file[0])
-
-    if args.clean:
-        logging.info('clean')
-        for e in glob.glob('*'):
-            if os.path.isdir(e):
-                shutil.rmtree(e)
-            else:
-                os.remove(e)
+    profiler.enabled = bool(args.profile)
+    try:
+        if args.watch:
+            watch(args)
+        else:
+            run_pipeline(args)
+    finally:
+        if args.profile:
+            for line in profiler.summary():
+                logging.info('%s', line)
+            profiler.write(args.profile)
+
+
+def client(args: argparse.Namespace) -> None:
+    # the daemon has its own working directory
+    request: dict[str, Any] = {'command': args.command}
+    if args.command in ('type', 'assembly'):
+        request['assembly'] = os.path.abspath(args.assembly)
+    if args.command == 'type':
+        request['type'] = args.type
+    elif args.command == 'assembly':
+        request['output'] = os.path.abspath(args.output)
+    elif args.command == 'references':
+        request['roots'] = [os.path.abspath(f) for f in args.file]
+    elif args.command == 'extract-types':
+        request['game'] = os.path.abspath(args.game_dir)
+        request['verify'] = args.verify
+
+    try:
+        response = daemon_request(args.socket, request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # not running, or the socket of one which didn't exit cleanly
+        if args.command == 'stop':
+            return
+        start_daemon(args.socket, args.netframework, args.idle_timeout)
+        response = daemon_request(args.socket, request)
+    if 'source' in response:
+        sys.stdout.write(response['source'])
+    elif 'project' in response:
+        print(response['project'])
+    elif 'graph' in response:
+        print(json.dumps(response['graph']))
+
+
+def lookup(args: argparse.Namespace) -> None:
+    filename = os.path.join(args.directory, '.decompile', INDEX_FILE)
+    if not os.path.exists(filename):
+        print('no index: %s, run decompile.py there first' % filename)
+        exit(1)
+    # Type.Member matches the members named Member of the types named Type
+    wildcard = any(c in args.symbol for c in '*?[')
+    name = args.symbol.split('.')[-1]
+    if args.derived or args.attribute:
+        name = short_name(args.symbol)
+        if args.attribute:
+            name = attribute_name(name)
+        table = 'bases' if args.derived else 'attributes'
+        query = 'SELECT s.* FROM symbols s JOIN %s x ON x.symbol = s.id WHERE x.name %s ?' % (
+            table, 'GLOB' if wildcard else '=')
+        parameters = [name]
+    elif wildcard:
+        query = 'SELECT * FROM symbols s WHERE (s.name GLOB ? OR s.full_name GLOB ? OR s.full_name GLOB ?)'
+        parameters = [args.symbol, args.symbol, '*.' + args.symbol]
+    else:
+        query = 'SELECT * FROM symbols s WHERE s.name = ? AND (s.full_name = ? OR s.full_name GLOB ? OR ? = ?)'
+        parameters = [name, args.symbol, '*.' +
+                      args.symbol, name, args.symbol]
+    if args.kind:
+        query += ' AND s.kind = ?'
+        parameters.append(args.kind)
+    query += ' ORDER BY s.full_name, s.path, s.line'
+
+    found = False
+    uri = pathlib.Path(os.path.abspath(filename)).as_uri() + '?mode=ro'
+    with contextlib.closing(sqlite3.connect(uri, uri=True)) as db:
+        for id, path, line, kind, _, full_name, type_name in db.execute(query, parameters):
+            found = True
+            text = '%s:%i: %s %s' % (os.path.normpath(os.path.join(
+                args.directory, path)), line, kind, full_name)
+            bases = [b for b, in db.execute(
+                'SELECT text FROM bases WHERE symbol = ? ORDER BY rowid', (id,))]
+            if bases:
+                text += ' : ' + ', '.join(bases)
+            for assembly, position in db.execute(
+                    'SELECT assembly, position FROM original_types WHERE type_name = ?', (type_name,)):
+                text += ' (original type %i of %s)' % (position, assembly)
+            print(text)
+    if not found:
+        exit(1)
 
-    if args.dependencies:
-        logging.info('copy dependencies')
-        os.makedirs('dependencies', exist_ok=True)
-        for dep in COMPILE_DEPENDENCIES + RUNTIME_DEPENDENCIES:
-            src = os.path.join(game_dir, dep)
-            if os.path.exists(src):
-                shutil.copyfile(src, os.path.join('dependencies', dep))
 
-    if args.decompile or args.patches:
-        projects = projects_to_decompile(args.file, args.xml_serializers)
+def run_pipeline(args: argparse.Namespace,
+                 previous: Optional[dict[str, str]] = None) -> dict[str, str]:
+    # returns the digests of the assemblies, with --watch; the projects of
+    # those with the previous digest are kept as they are in the tree
+
+    # all at once, in the background: each is waited for where it's used
+    for project in ['ListReferences', 'DecompilerHost', 'HashTypes',
+                    'ExtractTypes'] + (['BuildLog'] if args.build else []):
+        if project != 'DecompilerHost' or args.decompiler_host:
+            dotnet_build(project)
+    # the tree is built in the staging directory: paths must be absolute
+    game_dir = os.path.abspath(os.path.dirname(args.file[0]))
+    if args.netframework:
+        args.netframework = os.path.abspath(args.netframework)
+    args.cache_dir = os.path.abspath(args.cache_dir)
+    args.project_graph = [os.path.abspath(f) for f in args.project_graph]
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+    if args.store:
+        args.store = os.path.abspath(args.store)
+    if args.git_fast_import:
+        args.git_fast_import = os.path.abspath(args.git_fast_import)
+
+    output = Output()
+    try:
+        if args.clean:
+            logging.info('clean')
+            output.clean()
+        cache_dir = args.cache_dir if args.cache else None
+
+        projects: dict[str, str] = {}
+        if args.decompile or args.patches:
+            with profiler.span('setup', 'references'):
+                projects = projects_to_decompile(
+                    args.file, args.xml_serializers, cache_dir)
+        assemblies = {}
+        if args.watch:
+            with profiler.span('setup', 'hash assemblies'):
+                assemblies = {f: file_digest(f) for f in sorted(
+                    {os.path.abspath(f) for f in projects.values()} |
+                    {os.path.join(game_dir, f) for f in EXTRACT_TYPES_ASSEMBLIES})
+                    if os.path.exists(f)}
+        if args.fixes:
+            editorconfig()
+        delta = None
+        skip = list(projects) if args.decompile else []
+        if args.decompile:
+            delta = Delta(args, projects, cache_dir)
+            if delta.selected:
+                with profiler.span('setup', 'hash types'):
+                    delta.hash()
+                # the projects of the other types stay as they are
+                projects = {k: v for k, v in projects.items()
+                            if k in delta.plans}
+                skip = [k for k in projects if k not in delta.fresh]
+            elif previous:
+                kept = [name for name, f in projects.items()
+                        if previous.get(os.path.abspath(f)) ==
+                        assemblies[os.path.abspath(f)]]
+                # OriginalTypes.cs is in VRage
+                extract = 'VRage' not in kept or any(
+                    previous.get(os.path.join(game_dir, f)) !=
+                    assemblies.get(os.path.join(game_dir, f))
+                    for f in EXTRACT_TYPES_ASSEMBLIES)
+                delta.keep(kept, extract)
+                skip = [k for k in projects if k not in delta.fresh]
+
+        with profiler.span('setup', 'stage output'):
+            output.prepare(skip)
+        index = SymbolIndex(output.directory) if args.index else None
+        builder = Builder(output.directory, output.previous) \
+            if args.build else None
+        store = Store(args.store, output.previous) if args.store else None
+        git = GitImport(output.directory, args.git_fast_import,
+                        args.git_branch, output.previous) \
+            if args.git_fast_import else None
+        os.chdir(output.staging)
+        try:
+            workspace = build(args, game_dir, projects, cache_dir, delta,
+                              index, builder, store, git, output.directory)
+        finally:
+            os.chdir(output.root)
+        with profiler.span('setup', 'publish'):
+            files = output.publish(workspace, {
+                **(git.hashed if git else {}),
+                **(store.stored if store else {})})
+        if store:
+            with profiler.span('setup', 'store'):
+                store.save(args.store_version, files)
+        if git:
+            with profiler.span('setup', 'git fast-import'):
+                git.commit(files, args.git_message or args.store_version or
+                           'Decompile %s' % ', '.join(
+                               os.path.basename(f) for f in args.file or []))
+        if delta:
+            delta.save(output.directory)
+        if index:
+            with profiler.span('setup', 'save index'):
+                index.save(files)
+        if builder and builder.failed:
+            raise Exception('build failed: %s (see %s)' % (
+                ', '.join(builder.failed),
+                os.path.join(builder.directory, 'report.json')))
+    finally:
+        output.finish()
+    return assemblies
+
+
+def build(args: argparse.Namespace, game_dir: str, projects: dict[str, str],
+          cache_dir: Optional[str], delta: Optional['Delta'],
+          index: Optional['SymbolIndex'] = None,
+          builder: Optional['Builder'] = None,
+          store: Optional['Store'] = None,
+          git: Optional['GitImport'] = None,
+          directory: Optional[str] = None) -> 'Workspace':
+    # directory: .decompile, for the reports
+    with profiler.span('setup', 'index workspace'):
+        workspace = Workspace()
+    csprojs = workspace.glob(os.path.join('*', '*.csproj'))
+    # the projects to decompile and those already there
+    names = sorted({os.path.dirname(f) for f in csprojs} | set(
+        projects if args.decompile else ()))
+
+    # steps are added stage by stage; each project's last step is in chains
+    pipeline = Pipeline()
+    chains: dict[str, List[str]] = {name: [] for name in names}
+
+    def ends() -> List[str]:
+        return [step for chain in chains.values() for step in chain]
 
-    if args.decompile:
-        decompile(projects, args.netframework)
+    if args.dependencies:
+        pipeline.add('dependencies', functools.partial(
+            copy_dependencies, workspace, game_dir, args.link_dependencies,
+            args.jobs))
 
+    if delta and not delta.selected:
+        # with a baseline, what to decompile depends on the hashes
+        hashes = pipeline.add('hash-types', delta.hash)
+    if args.decompile:
+        cache = None
+        if args.cache:
+            cache = DecompileCache(
+                args.cache_dir, int(args.cache_size * 2**30))
+        decompiler = Decompiler(workspace, args.netframework, cache, delta,
+                                not args.decompiler_host)
+        after = [hashes] if args.baseline else []
+        if args.jobs == 1:
+            step = pipeline.add(
+                'decompile', functools.partial(decompiler.run, projects),
+                after=after)
+            for name in projects:
+                chains[name] = [step]
+        else:
+            # a single host decompiles them all (the largest first); each
+            # project goes on as soon as it's written, the smallest first
+            step = pipeline.add(
+                'decompile', functools.partial(decompiler.start, projects),
+                after=after)
+            for name in sorted(projects, key=lambda p: os.path.getsize(projects[p])):
+                chains[name] = [pipeline.add(
+                    'decompile:%s' % name,
+                    functools.partial(decompiler.wait, name, projects[name]),
+                    after=[step], nice=1)]
+        if cache:
+            pipeline.add('cache', cache.evict, after=ends())
+
+    executor = None
+    if args.jobs > 1 and (args.fixes or args.patches or index or store):
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs)
+        # start the workers now: forking once steps run in threads is unsafe
+        executor.submit(int).result()
+
+    # the files decompiled again by delta projects, or the selected types:
+    # the others were fixed and patched already
+    fresh = delta.fresh if delta else None
     if args.fixes:
-        fixes()
+        for name in names:
+            chains[name] = [pipeline.add(
+                'fixes:%s' % name,
+                functools.partial(fixes, workspace, name, args.jobs, executor,
+                                  fresh),
+                after=chains[name])]
 
     if args.patches:
-        patches(projects, game_dir, not args.ignore_broken_patches)
+        patches = Patches(workspace, projects, not args.ignore_broken_patches,
+                          args.refresh_patches, executor, fresh, directory)
+        # only needed by the VRage patches: extracted while decompiling
+        types = []
+        if 'VRage' in patches.groups and (not delta or delta.extract_types):
+            types = [pipeline.add('extract-types', functools.partial(
+                patches.extract_types, game_dir, cache_dir,
+                args.verify_types))]
+        for name in names:
+            if name in patches.groups:
+                chains[name] = [pipeline.add(
+                    'patches:%s' % name,
+                    functools.partial(patches.apply, name),
+                    after=chains[name] + types)]
+        if patches.deferred():
+            step = pipeline.add('patches', patches.finish, after=ends())
+            chains = {name: [step] for name in names}
+
+    if index:
+        # nothing waits for it: the sources are final
+        for name in names:
+            pipeline.add('index:%s' % name, functools.partial(
+                index.update, workspace, name, args.jobs, executor),
+                after=chains[name], nice=1)
 
     if args.projects:
-        logging.info('updating projects')
-        for f in glob.glob(os.path.join('*', '*.csproj')):
-            project(os.path.dirname(f))
+        graph = ProjectGraph(workspace, names)
+        for name in names:
+            if delta and delta.selected and name in delta.decompile and \
+                    os.path.join(name, '%s.csproj' % name) not in workspace:
+                continue  # only the selected types, no project yet
+            chains[name] = [pipeline.add(
+                'project:%s' % name, functools.partial(graph.update, name),
+                after=chains[name])]
+        if args.project_graph:
+            def export() -> None:
+                for filename in args.project_graph:
+                    graph.export(filename)
+            pipeline.add('project-graph', export, after=ends())
     else:
-        for f in glob.glob(os.path.join('*', '*.csproj')):
-            os.remove(f)
+        def remove_projects() -> None:
+            for f in workspace.glob(os.path.join('*', '*.csproj')):
+                workspace.remove(f)
+        step = pipeline.add('remove-projects', remove_projects, after=ends())
+        chains = {name: [step] for name in names}
+
+    if store:
+        # nothing waits for them either, the rest of the tree is stored last
+        for name in names:
+            pipeline.add('store:%s' % name, functools.partial(
+                store.add, workspace, name, args.jobs, executor),
+                after=chains[name], nice=1)
+    if git:
+        # the blobs of the stream, read in the steps' threads
+        for name in names:
+            pipeline.add('git:%s' % name, functools.partial(
+                git.add, workspace, name), after=chains[name], nice=1)
 
     if args.solution:
-        create_solution('SpaceEngineers.slnx')
-    elif os.path.exists('SpaceEngineers.slnx'):
-        os.remove('SpaceEngineers.slnx')
+        pipeline.add('solution', functools.partial(
+            create_solution, workspace, 'SpaceEngineers.slnx'), after=ends())
+    elif 'SpaceEngineers.slnx' in workspace:
+        workspace.remove('SpaceEngineers.slnx')
+
+    if builder:
+        # those with a project: the others wait for nothing
+        built = [name for name in names if 'project:%s' %
+                 name in pipeline.steps]
+        builder.expect(built)
+        for name in built:
+            pipeline.add('build:%s' % name, functools.partial(
+                builder.start, graph, name), after=chains[name])
+        pipeline.add('build', functools.partial(builder.report, workspace),
+                     after=['build:%s' % name for name in built])
+
+    if store:
+        pipeline.add('store', functools.partial(
+            store.add, workspace, '', args.jobs, executor),
+            after=list(pipeline.steps))
+    if git:
+        pipeline.add('git', functools.partial(git.add, workspace, ''),
+                     after=[step for step in pipeline.steps if step != 'store'])
+
+    try:
+        pipeline.run(args.jobs)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    return workspace
 
 
 def check(args: argparse.Namespace) -> None:
+    assert args.jobs >= 1
+    assert args.projects or not args.project_graph
+    assert args.projects or not args.build
+    assert bool(args.store) == bool(args.store_version)
+    if args.store_version:
+        assert os.sep not in args.store_version
+    assert args.git_fast_import or not (args.git_branch or args.git_message)
+    if args.git_fast_import and not shutil.which('git'):
+        print('required: git: apt install git')
+        exit(1)
+    assert args.decompile or not args.baseline
+    if args.watch:
+        assert args.decompile and not (args.type or args.namespace)
+    if args.baseline:
+        assert os.path.isdir(args.baseline)
+    if args.type or args.namespace:
+        assert args.decompile and not args.baseline
+        # relocated hunks of files not decompiled would be lost
+        assert not args.refresh_patches
     if args.decompile:
         assert len(args.file)
         for file in args.file:
@@ -189,7 +684,7 @@ def check(args: argparse.Namespace) -> None:
     if not shutil.which('dotnet'):
         print('required: dotnet: apt install dotnet-sdk-9.0')
         exit(1)
-    if not shutil.which('ilspycmd'):
+    if args.decompile and not args.decompiler_host and not shutil.which('ilspycmd'):
         print('required: ilspycmd:')
         print('  git clone https://github.com/icsharpcode/ILSpy')
         print('  cd ILSpy')
@@ -198,13 +693,70 @@ def check(args: argparse.Namespace) -> None:
         exit(1)
 
 
-def dotnet_build(project: str) -> None:
-    if os.path.exists(dotnet_binary(project)):
-        return
+# helper builds, started (or skipped) once per project and process
+builds: dict[str, 'concurrent.futures.Future[None]'] = {}
+builds_lock = threading.Lock()
+
+
+def dotnet_build(project: str) -> 'concurrent.futures.Future[None]':
+    # builds project in the background, unless its binary was built from the
+    # sources it has now; dotnet_tool() waits for it
+    with builds_lock:
+        if project not in builds:
+            builds[project] = runner.submit(build_helper(project))
+        return builds[project]
+
+
+async def build_helper(project: str) -> None:
+    stamp = os.path.splitext(dotnet_binary(project))[0] + '.sources'
+    digest = await runner.thread(dotnet_sources_digest, project)
+    with contextlib.suppress(FileNotFoundError):
+        if (os.path.exists(dotnet_binary(project)) and
+                pathlib.Path(stamp).read_text() == digest):
+            return
+    logging.info('build: %s', project)
     d = os.path.join(os.path.dirname(__file__), project)
-    subprocess.run(['dotnet', 'build', '--configuration',
-                   'Release'], cwd=d, stdout=subprocess.DEVNULL, check=True)
+    # no build servers: they would outlive the build, holding its stderr
+    await runner.run(['dotnet', 'build', '--configuration', 'Release',
+                      '--disable-build-servers'],
+                     'dotnet build %s' % project, subprocess.DEVNULL, d,
+                     None, BUILD_TIMEOUT)
     assert os.path.exists(dotnet_binary(project))
+    write_file(stamp, digest.encode('utf-8'))
+
+
+def dotnet_sources_digest(project: str) -> str:
+    # of the .cs and .csproj files of project and of the projects it
+    # references, by path relative to the repository
+    root = os.path.dirname(os.path.abspath(__file__))
+    digests = {}
+    seen = {project}
+    todo = [project]
+    while todo:
+        d = os.path.join(root, todo.pop())
+        for dirpath, dirnames, filenames in os.walk(d):
+            dirnames[:] = sorted(set(dirnames) - {'bin', 'obj'})
+            for f in filenames:
+                if not f.endswith(('.cs', '.csproj')):
+                    continue
+                path = os.path.join(dirpath, f)
+                digests[os.path.relpath(path, root)] = file_digest(path)
+                if not f.endswith('.csproj'):
+                    continue
+                for reference in lxml.etree.parse(path).iterfind('.//ProjectReference'):
+                    # ..\ExtractTypes\ExtractTypes.csproj
+                    name = pathlib.PureWindowsPath(
+                        reference.get('Include', '')).parent.name
+                    if name not in seen:
+                        seen.add(name)
+                        todo.append(name)
+    return hashlib.sha256(json.dumps(sorted(digests.items())).encode('utf-8')).hexdigest()
+
+
+def dotnet_tool(project: str) -> str:
+    # the binary of project, once built
+    dotnet_build(project).result()
+    return dotnet_binary(project)
 
 
 def dotnet_binary(project: str) -> str:
@@ -215,46 +767,1821 @@ def dotnet_binary(project: str) -> str:
     return f
 
 
-def projects_to_decompile(files: List[str], xml_serializers: bool) -> dict[str, str]:
-    references = set()
-    for file in files:
-        p = subprocess.run([dotnet_binary('ListReferences'), file],
-                           stdout=subprocess.PIPE, encoding='utf-8', check=True)
-        for ref in p.stdout.splitlines():
-            references.add(os.path.join(os.path.dirname(file), ref))
-
-        if xml_serializers:
-            for filename in sorted(references):
-                f, _ = os.path.splitext(filename)
-                f += '.XmlSerializers.dll'
-                if os.path.exists(f):
-                    references.add(f)
-
+def dotnet_assembly(project: str) -> str:
+    # the code itself: the binary is only a launcher, the same for all
+    return os.path.splitext(dotnet_tool(project))[0] + '.dll'
+
+
+def start_daemon(path: str, netframework: Optional[str],
+                 idle_timeout: float) -> None:
+    # DecompilerDaemon, detached, with the flags of DecompilerHost; returns
+    # once it listens on path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    flags = decompiler_flags(
+        os.path.abspath(netframework) if netframework else '')
+    log = path + '.log'
+    logging.info('start daemon: %s (log: %s)', path, log)
+    with open(log, 'ab') as f:
+        p = subprocess.Popen(
+            [dotnet_tool('DecompilerDaemon'), '--socket', path,
+             '--idle-timeout', str(idle_timeout)] + flags,
+            stdin=subprocess.DEVNULL, stdout=f, stderr=f,
+            start_new_session=True)
+    deadline = time.time() + 30
+    while True:
+        # another client may have started one at the same time: this one
+        # then exits as soon as it sees it
+        exited = p.poll() is not None
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(path)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+        if exited:
+            raise Exception('daemon exited with %i, see %s' %
+                            (p.returncode, log))
+        if time.time() > deadline:
+            raise Exception('daemon not listening after 30s, see %s' % log)
+        time.sleep(0.05)
+
+
+def daemon_request(path: str, request: dict[str, Any]) -> dict[str, Any]:
+    # one JSON line each way
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        chunks = []
+        while chunk := s.recv(1 << 20):
+            chunks.append(chunk)
+    response: dict[str, Any] = json.loads(b''.join(chunks))
+    if 'error' in response:
+        raise Exception('daemon: %s' % response['error'])
+    return response
+
+
+def projects_to_decompile(files: List[str], xml_serializers: bool,
+                          cache_dir: Optional[str]) -> dict[str, str]:
+    graph = reference_graph(files, cache_dir)
+    for filename in graph['missing']:
+        logging.warning('missing reference: %s', filename)
+    references = set(graph['nodes'])
+
+    if xml_serializers:
+        for filename in graph['nodes']:
+            f, _ = os.path.splitext(filename)
+            f += '.XmlSerializers.dll'
+            if os.path.exists(f):
+                references.add(f)
+
+    dependencies = {os.path.splitext(f)[0] for f in COMPILE_DEPENDENCIES}
     projects = {}
     for filename in sorted(references):
         project_name, _ = os.path.splitext(os.path.basename(filename))
-        if project_name in [os.path.splitext(f)[0] for f in COMPILE_DEPENDENCIES]:
+        if project_name in dependencies:
             continue
         projects[project_name] = filename
 
     return projects
 
 
-def decompile(projects: dict[str, str], netframework: str) -> None:
-    for project_name in projects:
-        if os.path.isdir(project_name):
-            logging.debug('clean: %s' % project_name)
-            shutil.rmtree(project_name)
-
-    v = subprocess.run(['ilspycmd', '--disable-updatecheck', '--version'],
-                       check=True, stdout=subprocess.PIPE, encoding='utf-8')
-    version = v.stdout.splitlines()[0]
-    logging.info('using %s', version)
+def reference_graph(files: List[str], cache_dir: Optional[str]) -> Any:
+    # one ListReferences call for all roots
+    roots = sorted(os.path.abspath(f) for f in files)
+    tool = dotnet_tool('ListReferences')
+
+    def compute() -> Tuple[Any, List[str]]:
+        graph = json.loads(run([tool] + roots, 'ListReferences',
+                               stdout=subprocess.PIPE, timeout=TOOL_TIMEOUT))
+        return graph, graph['nodes'] + graph['missing'] + [tool]
+    return stat_cached(cache_dir, 'references.json', json.dumps(roots),
+                       compute)
+
+
+def type_hashes(assemblies: Collection[str], cache_dir: Optional[str]) -> Any:
+    # the hashes of the types of each assembly (see Delta), by HashTypes
+    paths = sorted(os.path.abspath(f) for f in assemblies)
+    tool = dotnet_tool('HashTypes')
+
+    def compute() -> Tuple[Any, List[str]]:
+        logging.info('hash types')
+        hashes = json.loads(run([tool] + paths, 'HashTypes',
+                                stdout=subprocess.PIPE, timeout=TOOL_TIMEOUT))
+        return hashes, paths + [tool]
+    return stat_cached(cache_dir, 'type-hashes.json', json.dumps(paths),
+                       compute)
+
+
+def stat_cached(cache_dir: Optional[str], name: str, key: str,
+                compute: Callable[[], Tuple[Any, List[str]]]) -> Any:
+    # the value of compute() for key, cached in cache_dir/name and reused
+    # while none of the files it returned (the inputs: assemblies, the tool
+    # itself) changed size or mtime
+    cache: dict[str, Any] = {}
+    filename = None
+    if cache_dir:
+        filename = os.path.join(cache_dir, name)
+        try:
+            with open(filename) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+        entry = cache.get(key)
+        # ('value' isn't in the entries of older versions)
+        if entry and 'value' in entry and all(
+                file_stat(path) == v for path, v in entry['stat'].items()):
+            logging.debug('cached: %s', filename)
+            return entry['value']
+
+    value, inputs = compute()
+
+    if filename:
+        cache[key] = {
+            'stat': {path: file_stat(path) for path in inputs},
+            'value': value,
+        }
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '%s.%i' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, filename)
+    return value
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def write_file(filename: str, data: bytes) -> None:
+    # write a new file in place of filename, which may be a hardlink to the
+    # published output (see Output): it must not be written through
+    tmp = '%s.%i.tmp' % (filename, threading.get_native_id())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    try:
+        shutil.copymode(filename, tmp)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp, filename)
+
+
+def file_stat(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def completed(futures: Collection[concurrent.futures.Future[T]]) -> Iterator[Tuple[concurrent.futures.Future[T], T]]:
+    # like as_completed(), but fail fast: cancel pending work on an error
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            result = future.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+        yield future, result
+
+
+# Spans of a --profile run: pipeline steps, subprocesses, patch files, fix
+# rules and .csproj handling, with wall time, CPU time and peak RSS. Worker
+# processes measure with event() and send the events back with their results.
+class Profiler(object):
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: List[dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def add(self, *events: dict[str, Any]) -> None:
+        if self.enabled:
+            with self.lock:
+                self.events += events
+
+    @contextlib.contextmanager
+    def span(self, category: str, name: str) -> Iterator[None]:
+        start, cpu = time.time(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(event(category, name, start, time.time() - start,
+                           time.thread_time() - cpu))
+
+    def summary(self) -> List[str]:
+        rows: dict[Tuple[str, str], List[float]] = {}
+        for e in self.events:
+            row = rows.setdefault((e['cat'], e['name']), [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += e['dur']
+            row[2] += e['cpu']
+            row[3] = max(row[3], e['rss'])
+        width = max([len(name) for _, name in rows] + [4])
+        lines = ['%-10s %-*s %6s %10s %10s %9s' % (
+            'category', width, 'name', 'count', 'wall (s)', 'cpu (s)', 'rss (MiB)')]
+        for (category, name), (count, wall, cpu, rss) in sorted(
+                rows.items(), key=lambda r: -r[1][1]):
+            lines.append('%-10s %-*s %6i %10.3f %10.3f %9.1f' % (
+                category, width, name, count, wall, cpu, rss / 2**20))
+        return lines
+
+    def write(self, filename: str) -> None:
+        # Chrome trace event format, for chrome://tracing or ui.perfetto.dev
+        trace: List[dict[str, Any]] = []
+        for e in self.events:
+            trace.append({
+                'name': e['name'], 'cat': e['cat'], 'ph': 'X',
+                'ts': e['ts'] * 1e6, 'dur': e['dur'] * 1e6,
+                'pid': e['pid'], 'tid': e['tid'],
+                'args': dict(e['args'], cpu_ms=e['cpu'] * 1e3,
+                             rss_mib=e['rss'] / 2**20),
+            })
+            if e['cat'] == 'process':
+                trace.append({'name': 'process_name', 'ph': 'M',
+                              'pid': e['pid'], 'args': {'name': e['name']}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        with open(os.path.splitext(filename)[0] + '.txt', 'w') as f:
+            f.write('\n'.join(self.summary()) + '\n')
+
+
+profiler = Profiler()
+
+
+def event(category: str, name: str, start: float, wall: float, cpu: float,
+          **args: Any) -> dict[str, Any]:
+    # a span of the current process and thread
+    return {'cat': category, 'name': name, 'ts': start, 'dur': wall,
+            'cpu': cpu, 'rss': max_rss(), 'pid': os.getpid(),
+            'tid': threading.get_native_id(), 'args': args}
+
+
+def max_rss(usage: Any = None) -> int:
+    # peak resident set size in bytes, of this process by default
+    if sys.platform == 'win32':
+        return 0
+    if usage is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return int(usage.ru_maxrss) * (1 if sys.platform == 'darwin' else 1024)
+
+
+# External commands all run from one asyncio event loop, in a thread of its
+# own: at most RUN_LIMIT of them at once, each killed once past its timeout,
+# and what they print (but the output asked for) logged line by line after
+# their name. The pipes are read and the processes waited for in threads:
+# Windows pipes can't be awaited, and os.wait4() gives the CPU time and peak
+# RSS of the child itself. run() is the synchronous front of it, for the
+# threads of the steps.
+RUN_LIMIT = max(2, os.cpu_count() or 1)
+# seconds: the builds of the helpers, a run of one of them, and the
+# decompilation of all the assemblies
+BUILD_TIMEOUT = 900
+TOOL_TIMEOUT = 600
+DECOMPILE_TIMEOUT = 3600
+# seconds the output of an exited command is still read for (at most a pipe
+# buffer is left)
+PIPE_GRACE = 1
+
+
+class Runner(object):
+
+    def __init__(self, limit: int) -> None:
+        self.semaphore = asyncio.Semaphore(limit)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> 'concurrent.futures.Future[T]':
+        # the loop starts on first use: lookup and the client run nothing
+        with self.lock:
+            if not self.loop:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='runner',
+                                 daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    @staticmethod
+    def thread(fn: Callable[..., T], *args: Any) -> 'asyncio.Future[T]':
+        # fn(*args) in a daemon thread of its own, rather than the loop's
+        # executor: blocking reads and waits can't queue behind each other,
+        # nor keep Python from exiting on an error
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[T] = loop.create_future()
+
+        def settle(result: Any, error: Optional[BaseException]) -> None:
+            if future.cancelled():
+                return
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
 
-    assemblies = sorted(projects.values())
-    logging.info('decompile (%i): %s', len(assemblies),
-                 ' '.join(os.path.basename(f) for f in assemblies))
+        def target() -> None:
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                loop.call_soon_threadsafe(settle, None, e)
+            else:
+                loop.call_soon_threadsafe(settle, result, None)
+        threading.Thread(target=target, daemon=True).start()
+        return future
+
+    async def run(self, args: List[str], name: str, stdout: Optional[int],
+                  cwd: Optional[str], lines: Optional[Callable[[str], None]],
+                  timeout: Optional[float],
+                  stdin: Optional[IO[bytes]] = None) -> str:
+        async with self.semaphore:
+            return await self.execute(args, name, stdout, cwd, lines, timeout,
+                                      stdin)
+
+    async def execute(self, args: List[str], name: str, stdout: Optional[int],
+                      cwd: Optional[str], lines: Optional[Callable[[str], None]],
+                      timeout: Optional[float],
+                      stdin: Optional[IO[bytes]] = None) -> str:
+        captured = stdout == subprocess.PIPE
+        output: List[str] = []
+
+        def log(pipe: IO[str]) -> None:
+            with pipe:
+                for line in pipe:
+                    logging.info('%s: %s', name, line.rstrip())
+
+        def capture(pipe: IO[str]) -> None:
+            with pipe:
+                for line in pipe:
+                    output.append(line)
+                    if lines:
+                        lines(line.rstrip('\n'))
+
+        start = time.time()
+        p = subprocess.Popen(
+            args, stdin=stdin,
+            stdout=subprocess.PIPE if stdout is None else stdout,
+            stderr=subprocess.PIPE, cwd=cwd, encoding='utf-8',
+            errors='replace')
+        pipes = [(cast(IO[str], p.stderr), log)]
+        if p.stdout:
+            pipes.append((p.stdout, capture if captured else log))
+        readers = [self.thread(fn, pipe) for pipe, fn in pipes]
+        waiter = self.thread(self.wait, p, name, args, start)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except TimeoutError:
+            logging.error('%s: killed after %gs', name, timeout)
+            p.kill()
+            await waiter
+            raise subprocess.TimeoutExpired(args, cast(float, timeout))
+        # the processes it left behind (build servers) may hold the pipes
+        # open: their readers are left to themselves
+        await asyncio.wait(readers, timeout=PIPE_GRACE)
+        for reader in readers:
+            if reader.done():
+                reader.result()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args)
+        return ''.join(output)
+
+    @staticmethod
+    def wait(p: 'subprocess.Popen[str]', name: str, args: List[str],
+             start: float) -> None:
+        if sys.platform == 'win32' or not profiler.enabled:
+            p.wait()
+            return
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        profiler.add({'cat': 'process', 'name': name, 'ts': start,
+                      'dur': time.time() - start,
+                      'cpu': usage.ru_utime + usage.ru_stime,
+                      'rss': max_rss(usage), 'pid': p.pid, 'tid': p.pid,
+                      'args': {'args': args}})
+
+
+runner = Runner(RUN_LIMIT)
+
+
+def run(args: List[str], name: str, stdout: Optional[int] = None,
+        cwd: Optional[str] = None,
+        lines: Optional[Callable[[str], None]] = None,
+        timeout: Optional[float] = None,
+        stdin: Optional[IO[bytes]] = None) -> str:
+    # subprocess.run(check=True, timeout=timeout) through the runner; returns
+    # the output with stdout=subprocess.PIPE, and passes each of its lines to
+    # lines as soon as it's written. stdin is a file, read as is
+    return runner.submit(
+        runner.run(args, name, stdout, cwd, lines, timeout, stdin)).result()
+
+
+# the stage of the step running in the current thread (decompile, fixes...),
+# recorded by Workspace for the files it writes
+running = threading.local()
+
+
+# Steps of a run, each after the steps it depends on. Steps are added in a
+# topological order, which is the order of a sequential run (-j1). Otherwise
+# up to jobs ready steps run at once, lowest nice value first, so the chains
+# of each project (decompile, fixes, patches, csproj) overlap each other and
+# the global steps instead of waiting for the whole tree at every stage.
+class Pipeline(object):
+
+    def __init__(self) -> None:
+        self.steps: dict[str, Tuple[Callable[[], None], List[str], int]] = {}
+
+    def add(self, name: str, fn: Callable[[], None],
+            after: Collection[str] = (), nice: int = 0) -> str:
+        assert name not in self.steps, name
+        for step in after:
+            assert step in self.steps, step
+        self.steps[name] = (fn, sorted(set(after)), nice)
+        return name
+
+    def step(self, name: str, fn: Callable[[], None]) -> None:
+        running.stage = name.split(':')[0]
+        try:
+            with profiler.span('step', name):
+                fn()
+        finally:
+            running.stage = None
+
+    def run(self, jobs: int) -> None:
+        if jobs == 1:
+            for name, (fn, _, _) in self.steps.items():
+                self.step(name, fn)
+            return
+
+        order = {name: i for i, name in enumerate(self.steps)}
+        sorter = graphlib.TopologicalSorter(
+            {name: after for name, (_, after, _) in self.steps.items()})
+        sorter.prepare()
+        ready: List[str] = []
+        running: dict[concurrent.futures.Future[None], str] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while sorter.is_active():
+                ready += sorter.get_ready()
+                ready.sort(key=lambda name: (self.steps[name][2], order[name]))
+                while ready and len(running) < jobs:
+                    name = ready.pop(0)
+                    logging.debug('start: %s', name)
+                    running[executor.submit(
+                        self.step, name, self.steps[name][0])] = name
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future, _ in completed(done):
+                    sorter.done(running.pop(future))
+
+
+# Files and directories of the output tree with their stat data, from a
+# single os.scandir() walk. Stages query it instead of walking the tree again
+# and update it as they create or delete files. Like glob(), dot files
+# (.editorconfig...) are left out.
+class Workspace(object):
+
+    def __init__(self, root: str = '.'):
+        self.root = root
+        self.entries: dict[str, os.stat_result] = {}
+        # the stage which last wrote each file, and what in the stage did
+        # when it's not the stage itself: a fix rule, a patch
+        self.stages: dict[str, str] = {}
+        self.origins: dict[str, str] = {}
+        # pipeline steps update it from several threads
+        self.lock = threading.RLock()
+        self.scan('')
+
+    def scan(self, path: str) -> None:
+        # (re)index path and everything below it, e.g. after a tool wrote it
+        entries = {}
+        if path:
+            path = os.path.normpath(path)
+            if not os.path.lexists(os.path.join(self.root, path)):
+                self.discard(path)
+                return
+            entries[path] = os.stat(os.path.join(self.root, path),
+                                    follow_symlinks=False)
+        directories = []
+        if not path or stat.S_ISDIR(entries[path].st_mode):
+            directories.append(path)
+        while directories:
+            directory = directories.pop()
+            with os.scandir(os.path.join(self.root, directory)) as it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    name = os.path.join(directory, e.name)
+                    entries[name] = e.stat(follow_symlinks=False)
+                    if e.is_dir(follow_symlinks=False):
+                        directories.append(name)
+        with self.lock:
+            self.discard(path)
+            self.entries.update(entries)
+            if getattr(running, 'stage', None):
+                self.stages.update((name, running.stage) for name in entries)
+                for name in entries:
+                    self.origins.pop(name, None)
+            if os.path.dirname(path):
+                self.add(os.path.dirname(path))
+
+    def add(self, path: str, origin: Optional[str] = None) -> None:
+        # record a file written by a stage, with its new parent directories
+        path = os.path.normpath(path)
+        with self.lock:
+            self.entries[path] = os.stat(os.path.join(self.root, path),
+                                         follow_symlinks=False)
+            if getattr(running, 'stage', None):
+                self.stages[path] = running.stage
+                if origin:
+                    self.origins[path] = origin
+                else:
+                    self.origins.pop(path, None)
+            path = os.path.dirname(path)
+            while path and path not in self.entries:
+                self.entries[path] = os.stat(os.path.join(self.root, path))
+                path = os.path.dirname(path)
+
+    def discard(self, path: str) -> None:
+        # forget path and everything below it
+        with self.lock:
+            if not path:
+                self.entries.clear()
+                return
+            path = os.path.normpath(path)
+            prefix = path + os.sep
+            for name in [name for name in self.entries
+                         if name == path or name.startswith(prefix)]:
+                del self.entries[name]
+
+    def remove(self, path: str) -> None:
+        if self.isdir(path):
+            shutil.rmtree(os.path.join(self.root, path))
+        else:
+            os.remove(os.path.join(self.root, path))
+        self.discard(path)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.normpath(path) in self.entries
+
+    def isdir(self, path: str) -> bool:
+        st = self.entries.get(os.path.normpath(path))
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def walk(self, path: str) -> List[Tuple[str, os.stat_result]]:
+        # path and everything below it
+        path = os.path.normpath(path)
+        prefix = path + os.sep
+        with self.lock:
+            return [(name, st) for name, st in self.entries.items()
+                    if name == path or name.startswith(prefix)]
+
+    def files(self, suffix: str, path: str = '') -> List[str]:
+        # like rglob('*' + suffix), in path if given
+        prefix = os.path.normpath(path) + os.sep if path else ''
+        with self.lock:
+            return sorted(name for name, st in self.entries.items()
+                          if name.endswith(suffix) and name.startswith(prefix)
+                          and stat.S_ISREG(st.st_mode))
+
+    def glob(self, pattern: str) -> List[str]:
+        # like glob(), '*' doesn't match across directories
+        parts = pattern.split(os.sep)
+        with self.lock:
+            return sorted(name for name in self.entries
+                          if name.count(os.sep) == len(parts) - 1 and all(
+                              fnmatch.fnmatch(n, p)
+                              for n, p in zip(name.split(os.sep), parts)))
+
+
+# The output directory is only updated by a successful run, at its end. The
+# tree is built in .decompile/staging, starting from hardlinks to the files
+# published by the previous run (but those of the projects decompiled again),
+# then published: new and changed files are moved into place, the files of
+# the previous run which weren't generated again are deleted, and unchanged
+# files are left alone with their mtime, so that MSBuild incremental builds
+# and IDE indexers don't see the whole tree change. Stages must replace
+# files (write_file), never write through them.
+#
+# .decompile/manifest.json lists the published files with their hash, their
+# stat data (to trust the hash) and the stage which wrote them. Directories
+# removed by --clean and old staging trees are moved to .decompile/trash and
+# deleted in the background.
+class Output(object):
+
+    def __init__(self, root: str = '.'):
+        self.root = os.path.abspath(root)
+        self.directory = os.path.join(self.root, '.decompile')
+        self.staging = os.path.join(self.directory, 'staging')
+        self.manifest = os.path.join(self.directory, 'manifest.json')
+        self.trash_dir = os.path.join(self.directory, 'trash')
+        self.previous: dict[str, dict[str, Any]] = {}
+        self.deleters: List[threading.Thread] = []
+        os.makedirs(self.trash_dir, exist_ok=True)
+        # left over by an interrupted run
+        for e in os.listdir(self.trash_dir):
+            self.delete(os.path.join(self.trash_dir, e))
+        if os.path.lexists(self.staging):
+            self.trash(self.staging)
+
+    def trash(self, path: str) -> None:
+        # a rename, it's deleted in the background
+        directory = tempfile.mkdtemp(dir=self.trash_dir)
+        os.rename(path, os.path.join(directory, os.path.basename(path)))
+        self.delete(directory)
+
+    def delete(self, path: str) -> None:
+        thread = threading.Thread(target=shutil.rmtree, args=(path,),
+                                  kwargs={'ignore_errors': True})
+        thread.start()
+        self.deleters.append(thread)
+
+    def finish(self) -> None:
+        for thread in self.deleters:
+            thread.join()
+
+    def clean(self) -> None:
+        for e in os.listdir(self.root):
+            if not e.startswith('.'):
+                self.trash(os.path.join(self.root, e))
+        for filename in [self.manifest, os.path.join(self.directory, TYPES_FILE)]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def prepare(self, skip: Collection[str]) -> None:
+        # the files of the previous run: the manifest, or the first time
+        # everything there, which older versions generated
+        try:
+            with open(self.manifest) as f:
+                self.previous = json.load(f)['files']
+        except FileNotFoundError:
+            self.previous = {name: {} for name, st in Workspace(
+                self.root).entries.items() if stat.S_ISREG(st.st_mode)}
+        os.makedirs(self.staging)
+        for name in self.previous:
+            src = os.path.join(self.root, name)
+            if name.split(os.sep)[0] in skip or not os.path.isfile(src):
+                continue
+            dst = os.path.join(self.staging, name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)  # no hardlinks on this file system
+
+    def publish(self, workspace: Workspace,
+                digests: Optional[dict[str, Tuple[int, int, str]]] = None) -> dict[str, dict[str, Any]]:
+        # returns the manifest's files; digests are the (size, mtime, sha256)
+        # of files already hashed
+        files: dict[str, dict[str, Any]] = {}
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+        for name in sorted(workspace.entries):
+            if workspace.isdir(name):
+                os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        for name in workspace.files(''):
+            src = os.path.join(self.staging, name)
+            dst = os.path.join(self.root, name)
+            previous = self.previous.get(name, {})
+            src_st = os.stat(src)
+            try:
+                dst_st: Optional[os.stat_result] = os.stat(dst)
+            except FileNotFoundError:
+                dst_st = None
+
+            def digest(path: str, st: os.stat_result) -> str:
+                # the manifest's hash, unless the file changed since
+                if previous.get('stat') == [st.st_size, st.st_mtime_ns]:
+                    return str(previous['sha256'])
+                return file_digest(path)
+
+            if dst_st and os.path.samestat(src_st, dst_st):
+                sha256 = digest(dst, dst_st)  # the hardlink was left alone
+                counts['unchanged'] += 1
+            else:
+                known = digests.get(name) if digests else None
+                if known and known[:2] == (src_st.st_size, src_st.st_mtime_ns):
+                    sha256 = known[2]
+                else:
+                    sha256 = file_digest(src)
+                if (dst_st and stat.S_ISREG(dst_st.st_mode)
+                        and dst_st.st_size == src_st.st_size
+                        and digest(dst, dst_st) == sha256):
+                    counts['unchanged'] += 1
+                else:
+                    if dst_st and stat.S_ISDIR(dst_st.st_mode):
+                        self.trash(dst)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(src, dst)
+                    counts['changed' if dst_st else 'new'] += 1
+                    dst_st = os.stat(dst)
+            assert dst_st
+            files[name] = {
+                'sha256': sha256,
+                'stat': [dst_st.st_size, dst_st.st_mtime_ns],
+                'stage': workspace.stages.get(name) or previous.get('stage', 'unknown'),
+            }
+            origin = workspace.origins.get(name) if name in workspace.stages \
+                else previous.get('origin')
+            if origin:
+                files[name]['origin'] = origin
+
+        for name in sorted(set(self.previous) - set(files), reverse=True):
+            dst = os.path.join(self.root, name)
+            if os.path.isfile(dst):
+                os.remove(dst)
+                counts['deleted'] += 1
+            # and the directories left empty
+            directory = os.path.dirname(name)
+            while directory:
+                try:
+                    os.rmdir(os.path.join(self.root, directory))
+                except OSError:
+                    break  # not empty, or gone
+                directory = os.path.dirname(directory)
+
+        write_file(self.manifest, json.dumps(
+            {'files': files}, indent=1, sort_keys=True).encode('utf-8'))
+        self.trash(self.staging)
+        logging.info('published: %s', ', '.join(
+            '%i %s' % (n, how) for how, n in counts.items()))
+        return files
+
+
+# Symbol index of the tree, in .decompile/symbols.db (SQLite): the types and
+# members declared in each .cs file with their line, the base types and
+# attributes of each, and the order of the types in the game assemblies (from
+# VRage/Network/OriginalTypes.cs, which ExtractTypes writes). The index step of
+# each project parses the files which changed since the last run (by stat,
+# then by hash); the index is written once the tree is published, so that it
+# always describes the tree. Queried by decompile.py lookup.
+INDEX_FILE = 'symbols.db'
+# the schema and what parse_declarations() finds: the index is rebuilt when
+# it changes
+INDEX_VERSION = 1
+INDEX_SCHEMA = '''
+CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL, sha256 TEXT NOT NULL);
+CREATE TABLE symbols (id INTEGER PRIMARY KEY, path TEXT NOT NULL,
+                      line INTEGER NOT NULL, kind TEXT NOT NULL,
+                      name TEXT NOT NULL, full_name TEXT NOT NULL,
+                      type_name TEXT);
+CREATE TABLE bases (symbol INTEGER NOT NULL, name TEXT NOT NULL,
+                    text TEXT NOT NULL);
+CREATE TABLE attributes (symbol INTEGER NOT NULL, name TEXT NOT NULL,
+                         text TEXT NOT NULL);
+CREATE TABLE original_types (path TEXT NOT NULL, assembly TEXT NOT NULL,
+                             position INTEGER NOT NULL,
+                             type_name TEXT NOT NULL);
+'''
+# created once a new index is filled, which is faster
+INDEX_INDEXES = '''
+CREATE INDEX symbols_path ON symbols (path);
+CREATE INDEX symbols_name ON symbols (name);
+CREATE INDEX symbols_full_name ON symbols (full_name);
+CREATE INDEX bases_symbol ON bases (symbol);
+CREATE INDEX bases_name ON bases (name);
+CREATE INDEX attributes_symbol ON attributes (symbol);
+CREATE INDEX attributes_name ON attributes (name);
+CREATE INDEX original_types_path ON original_types (path);
+CREATE INDEX original_types_type_name ON original_types (type_name);
+'''
+
+
+# (line, kind, name, full name, type name as in OriginalTypes or None, base
+# types, attributes)
+Symbol = Tuple[int, str, str, str, Optional[str], List[str], List[str]]
+# the symbols of a file, and its original types: (assembly, position, type
+# name)
+Declarations = Tuple[List[Symbol], List[Tuple[str, int, str]]]
+
+
+class SymbolIndex(object):
+
+    def __init__(self, directory: str):
+        self.filename = os.path.join(directory, INDEX_FILE)
+        # what the index has: path -> (size, mtime, sha256)
+        self.known: dict[str, Tuple[int, int, str]] = {}
+        self.current = False
+        if os.path.exists(self.filename):
+            with contextlib.closing(sqlite3.connect(self.filename)) as db:
+                [(version,)] = db.execute('PRAGMA user_version')
+                if version == INDEX_VERSION:
+                    self.current = True
+                    self.known = {path: (size, mtime, sha256) for path, size, mtime, sha256 in db.execute(
+                        'SELECT path, size, mtime, sha256 FROM files')}
+        # the files of the tree, and those which changed with their symbols
+        self.files: set[str] = set()
+        self.parsed: dict[str, Declarations] = {}
+        self.lock = threading.Lock()
+
+    def update(self, workspace: Workspace, project_name: str, jobs: int,
+               executor: Optional[concurrent.futures.ProcessPoolExecutor]) -> None:
+        filenames = workspace.files('.cs', project_name)
+        changed = []
+        for filename in filenames:
+            st = workspace.entries[filename]
+            known = self.known.get(filename)
+            if not known or known[:2] != (st.st_size, st.st_mtime_ns):
+                changed.append((filename, known[2] if known else ''))
+        results: List[Tuple[str, Optional[Declarations]]] = []
+        if not executor:
+            results = index_files(changed)
+        else:
+            size = max(16, len(changed) // (jobs * 4) + 1)
+            futures = [executor.submit(index_files, changed[i:i + size])
+                       for i in range(0, len(changed), size)]
+            for _, r in completed(futures):
+                results += r
+        with self.lock:
+            self.files.update(filenames)
+            self.parsed.update((f, r) for f, r in results if r is not None)
+        logging.debug('index %s: %i of %i files' %
+                      (project_name, len(self.parsed), len(filenames)))
+
+    def save(self, files: dict[str, dict[str, Any]]) -> None:
+        # files: as published, with their hash and stat data
+        if not self.current and os.path.exists(self.filename):
+            os.remove(self.filename)
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            if not self.current:
+                db.executescript(INDEX_SCHEMA)
+            with db:
+                stale = (set(self.known) - self.files) | (
+                    set(self.parsed) & set(self.known))
+                for path in sorted(stale):
+                    for table in ['bases', 'attributes']:
+                        db.execute('DELETE FROM %s WHERE symbol IN (SELECT id FROM symbols WHERE path = ?)' % table,
+                                   (path,))
+                    for table in ['symbols', 'original_types', 'files']:
+                        db.execute('DELETE FROM %s WHERE path = ?' %
+                                   table, (path,))
+                [(last,)] = db.execute('SELECT COALESCE(MAX(id), 0) FROM symbols')
+                rows: dict[str, List[Tuple[Any, ...]]] = {
+                    'symbols': [], 'bases': [], 'attributes': [], 'original_types': []}
+                for path, (symbols, original_types) in sorted(self.parsed.items()):
+                    for line, kind, name, full_name, type_name, bases, attributes in symbols:
+                        last += 1
+                        rows['symbols'].append(
+                            (last, path, line, kind, name, full_name, type_name))
+                        rows['bases'] += [(last, short_name(b), b)
+                                          for b in bases]
+                        rows['attributes'] += [(last, attribute_name(a), a)
+                                               for a in attributes]
+                    rows['original_types'] += [(path,) + t
+                                               for t in original_types]
+                for table, values in rows.items():
+                    if values:
+                        db.executemany('INSERT INTO %s VALUES (%s)' % (
+                            table, ', '.join('?' * len(values[0]))), values)
+                db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', [
+                    (path, files[path]['stat'][0], files[path]['stat'][1],
+                     files[path]['sha256']) for path in sorted(self.files)])
+            if not self.current:
+                db.executescript(INDEX_INDEXES)
+                db.execute('PRAGMA user_version = %i' % INDEX_VERSION)
+        logging.info('indexed: %i of %i files', len(self.parsed),
+                     len(self.files))
+
+
+def index_files(files: List[Tuple[str, str]]) -> List[Tuple[str, Optional[Declarations]]]:
+    # the declarations of each file (path, sha256 in the index), or None when
+    # its content is the same
+    results: List[Tuple[str, Optional[Declarations]]] = []
+    for filename, sha256 in files:
+        data = pathlib.Path(filename).read_bytes()
+        if hashlib.sha256(data).hexdigest() == sha256:
+            results.append((filename, None))
+            continue
+        text = data.decode('utf-8', errors='replace')
+        try:
+            results.append((filename, (parse_declarations(text),
+                                       parse_original_types(text))))
+        except Exception as e:
+            raise Exception('%s: %s' % (filename, e)) from e
+    return results
+
+
+# declarations are matched without their modifiers
+CS_MODIFIERS = re.compile(
+    r'(?:(?:public|private|protected|internal|static|readonly|const|volatile|virtual|override|abstract|sealed|extern|unsafe|new|async|partial|required|ref|fixed|implicit|explicit)\s+)*')
+# a type as written in a declaration: List<int>, int[], (int, string)?...
+CS_TYPE = r'(?:\((?:[^()]|\([^()]*\))*\)|[\w.:]+(?:<[^=;{}]*?>)?)(?:\?|\*|\[[,\s]*\])*'
+CS_TYPE_DECLARATION = re.compile(
+    r'(class|struct|interface|enum|record(?:\s+class|\s+struct)?)\s+@?(\w+)')
+CS_DELEGATE = re.compile(r'delegate\s+' + CS_TYPE + r'\s+@?(\w+)\s*[<(]')
+# (kind, pattern) in the order they're tried, the name in the last group
+CS_MEMBERS = [(kind, re.compile(pattern)) for kind, pattern in [
+    ('event', r'event\s+' + CS_TYPE + r'\s+@?([\w.]+)\s*[;{]?$'),
+    ('operator', r'(?:' + CS_TYPE + r'\s+)?(operator\s*(?:[^\s(]+|' +
+     CS_TYPE + r'))\s*\('),
+    ('constructor', r'(~?\w+)\s*\('),
+    ('indexer', CS_TYPE + r'\s+((?:[\w.]+\.)?this)\s*\['),
+    ('method', CS_TYPE + r'\s+@?([\w.]+?)(?:<[^()=;{}]*>)?\s*\('),
+    ('field', CS_TYPE + r'\s+@?(\w+)(?:\[[^\]]*\])?\s*(?:=(?!>).*|;)$'),
+    ('property', CS_TYPE + r'\s+@?([\w.]+)\s*(?:\{.*|=>.*)?$'),
+]]
+CS_ENUM_MEMBER = re.compile(r'^@?(\w+)\s*(?:=.*?)?,?$')
+CS_BRACES = re.compile('[{}]')
+CS_NAMESPACE = re.compile(r'^namespace\s+([\w.]+)\s*(;?)$')
+# what doesn't count for braces: strings, characters and comments
+CS_NOISE = re.compile(
+    r'@"(?:[^"]|"")*"|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|//.*|/\*.*?\*/')
+
+
+def parse_declarations(text: str) -> List[Symbol]:
+    # the types and members declared in C# as ILSpy writes it: one
+    # declaration per line, the braces of types on lines of their own
+    symbols: List[Symbol] = []
+    namespace = ''
+    # the braces open: (kind, namespace, type full name, name, type name)
+    # for namespaces and types, None for everything else
+    scopes: List[Optional[Tuple[str, str, str, str, str]]] = []
+    pending: Optional[Tuple[str, str, str, str, str]] = None
+    attributes: List[str] = []
+    for number, line in enumerate(text.splitlines(), 1):
+        scope = scopes[-1] if scopes else None
+        if scopes and not scope:
+            # in a body: only the braces count
+            if '{' not in line and '}' not in line:
+                continue
+            code = line.strip()
+            if code == '{':
+                scopes.append(None)
+                continue
+            if code == '}':
+                scopes.pop()
+                continue
+        code = line.strip()
+        if '"' in code or "'" in code or '/' in code:
+            code = CS_NOISE.sub(noise, code).strip()
+        if (not scopes or scope) and code and code[0] not in '{}#':
+            # attributes, on lines of their own or before a declaration
+            while code.startswith('['):
+                end = matching(code, 0)
+                if end < 0:
+                    break
+                attributes += [a for a in split_top(code[1:end])
+                               if not re.match(r'(assembly|module)\s*:', a)]
+                code = code[end + 1:].strip()
+            m = code.startswith('namespace') and CS_NAMESPACE.match(code)
+            if code and m and (not scope or scope[0] == 'namespace'):
+                namespace = m.group(1) if not scope else '%s.%s' % (
+                    scope[1], m.group(1))
+                if not m.group(2):
+                    pending = ('namespace', namespace, '', '', '')
+            elif code:
+                symbol, pending = parse_declaration(
+                    code, number, namespace, scope, attributes)
+                if symbol:
+                    symbols.append(symbol)
+                attributes = []
+        for c in CS_BRACES.findall(code):
+            if c == '{':
+                scopes.append(pending)
+                pending = None
+            elif c == '}' and scopes:
+                closed = scopes.pop()
+                if closed and closed[0] == 'namespace':
+                    namespace = scopes[-1][1] if scopes and scopes[-1] else ''
+    return symbols
+
+
+def noise(m: re.Match[str]) -> str:
+    # comments go, strings and characters stay as empty strings
+    return '' if m.group(0)[0] == '/' else '""'
+
+
+def parse_declaration(code: str, line: int, namespace: str,
+                      scope: Optional[Tuple[str, str, str, str, str]],
+                      attributes: List[str]) -> Tuple[Optional[Symbol], Optional[Tuple[str, str, str, str, str]]]:
+    # the symbol declared on this line, and the scope of its braces if it's a
+    # type
+    if scope and scope[0] != 'namespace':
+        _, _, parent, parent_name, parent_type = scope
+        prefix, type_prefix = parent + '.', parent_type + '+'
+    else:
+        parent = parent_name = ''
+        prefix = type_prefix = namespace + '.' if namespace else ''
+    modifiers = CS_MODIFIERS.match(code)
+    if modifiers:
+        code = code[modifiers.end():]
+    m = CS_TYPE_DECLARATION.match(code)
+    if m:
+        kind, name = re.sub(r'\s+', ' ', m.group(1)), m.group(2)
+        rest = code[m.end():].lstrip()
+        type_name = type_prefix + name
+        if rest.startswith('<'):
+            end = matching(rest, 0)
+            type_name += '`%i' % len(split_top(rest[1:end]))
+            rest = rest[end + 1:].lstrip()
+        if rest.startswith('('):  # record parameters
+            rest = rest[matching(rest, 0) + 1:].lstrip()
+        bases: List[str] = []
+        if rest.startswith(':') and kind != 'enum':
+            bases = split_top(re.split(r'\s+where\s', rest[1:])[0])
+        full_name = prefix + name
+        symbol = (line, kind.split(' ')[0], name, full_name, type_name, bases,
+                  attributes)
+        if code.endswith(';'):
+            return symbol, None  # record without a body
+        return symbol, (kind, namespace, full_name, name, type_name)
+    m = CS_DELEGATE.match(code)
+    if m:
+        name = m.group(1)
+        type_name = type_prefix + name
+        if code[m.end() - 1] == '<':
+            end = matching(code, m.end() - 1)
+            type_name += '`%i' % len(split_top(code[m.end():end]))
+        return (line, 'delegate', name, prefix + name, type_name, [],
+                attributes), None
+    if not scope or scope[0] == 'namespace':
+        return None, None
+    if scope[0] == 'enum':
+        m = CS_ENUM_MEMBER.match(code)
+        if m:
+            return (line, 'field', m.group(1), prefix + m.group(1), None, [],
+                    attributes), None
+        return None, None
+    for kind, pattern in CS_MEMBERS:
+        m = pattern.match(code)
+        if not m:
+            continue
+        written = re.sub(r'\s+', ' ', m.group(m.lastindex or 0))
+        if kind == 'constructor' and written.lstrip('~') != parent_name:
+            continue
+        if kind == 'constructor' and written.startswith('~'):
+            kind = 'destructor'
+        name = written if kind == 'operator' else written.split('.')[-1]
+        return (line, kind, name, prefix + written, None, [],
+                attributes), None
+    return None, None
+
+
+def parse_original_types(text: str) -> List[Tuple[str, int, str]]:
+    # (assembly, position, type name) of OriginalTypes.cs
+    if 'class OriginalTypes' not in text:
+        return []
+    original_types = []
+    assembly = ''
+    position = 0
+    for line in text.splitlines():
+        m = re.match(r'\s*\{"(.+)", new string\[\] \{$', line)
+        if m:
+            assembly, position = m.group(1), 0
+            continue
+        m = re.match(r'\s*"(.+)",$', line)
+        if m:
+            original_types.append((assembly, position, m.group(1)))
+            position += 1
+    return original_types
+
+
+def matching(s: str, start: int) -> int:
+    # the index of the bracket closing the one at start, or -1
+    depth = 0
+    for i in range(start, len(s)):
+        if s[i] in '([<{':
+            depth += 1
+        elif s[i] in ')]>}':
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+def split_top(s: str) -> List[str]:
+    # s split at the commas outside brackets
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(s):
+        if c in '([<{':
+            depth += 1
+        elif c in ')]>}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(s[start:i].strip())
+            start = i + 1
+    parts.append(s[start:].strip())
+    return [p for p in parts if p]
+
+
+def short_name(name: str) -> str:
+    # the name of a type as written, without its namespace and type arguments
+    return re.sub(r'<.*', '', name).split('.')[-1].strip().lstrip('@')
+
+
+def attribute_name(attribute: str) -> str:
+    # [return: Foo.BarAttribute(...)] is Bar
+    name = short_name(re.sub(r'^\w+\s*:\s*', '', attribute).split('(')[0])
+    return name[:-len('Attribute')] if name.endswith('Attribute') and name != 'Attribute' else name
+
+
+# --store: the published trees of all the game versions are archived in a
+# content-addressed store, each distinct file once. In the store directory:
+#   blobs/ab/cdef...: the files by the SHA-256 of their content, zstd
+#       compressed
+#   versions/<version>.json: the files of each version, with their hash
+#   files/ab/cdef...: the blobs decompressed by checkout, read-only: the trees
+#       it makes are hardlinks to them
+# Each project is stored as soon as it's final, in the pipeline, and the
+# files which didn't change since the last run by the hash of the output
+# manifest. The version's manifest is written once the tree is published.
+STORE_LEVEL = 10
+
+
+class Store(object):
+
+    def __init__(self, directory: str, previous: dict[str, dict[str, Any]]):
+        # previous: the output manifest's files
+        self.directory = directory
+        self.previous = previous
+        # path -> (size, mtime, sha256) of the files stored by this run
+        self.stored: dict[str, Tuple[int, int, str]] = {}
+        self.blobs = 0
+        self.lock = threading.Lock()
+        for d in ['blobs', 'versions']:
+            os.makedirs(os.path.join(directory, d), exist_ok=True)
+
+    def add(self, workspace: Workspace, path: str, jobs: int,
+            executor: Optional[concurrent.futures.ProcessPoolExecutor]) -> None:
+        # the files of path not stored yet, everything with path ''
+        files: List[Tuple[str, Optional[str]]] = []
+        stats = {}
+        with workspace.lock:
+            entries = workspace.walk(path) if path else list(
+                workspace.entries.items())
+        for name, st in entries:
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            stats[name] = (st.st_size, st.st_mtime_ns)
+            with self.lock:
+                stored = self.stored.get(name)
+            if stored and stored[:2] == stats[name]:
+                continue
+            previous = self.previous.get(name, {})
+            known = previous.get('sha256') \
+                if previous.get('stat') == list(stats[name]) else None
+            files.append((name, known))
+        results: List[Tuple[str, str]] = []
+        blobs = 0
+        if not executor:
+            results, blobs = store_files(self.directory, files)
+        else:
+            size = max(16, len(files) // (jobs * 4) + 1)
+            futures = [executor.submit(store_files, self.directory,
+                                       files[i:i + size])
+                       for i in range(0, len(files), size)]
+            for _, (r, b) in completed(futures):
+                results += r
+                blobs += b
+        with self.lock:
+            self.stored.update((name, stats[name] + (sha256,))
+                               for name, sha256 in results)
+            self.blobs += blobs
+        logging.debug('store %s: %i files, %i new blobs' %
+                      (path or 'tree', len(files), blobs))
+
+    def save(self, version: str, files: dict[str, dict[str, Any]]) -> None:
+        # files: as published; anything the pipeline didn't store is now,
+        # with .editorconfig which builds need, as dot files aren't published
+        if os.path.exists('.editorconfig'):
+            files = dict(files, **{'.editorconfig': {
+                'sha256': file_digest('.editorconfig'),
+                'stat': file_stat('.editorconfig')}})
+        missing = [(name, f['sha256']) for name, f in files.items()
+                   if self.stored.get(name, (0, 0, ''))[2] != f['sha256']]
+        if missing:
+            # back in the output directory
+            _, blobs = store_files(self.directory, missing)
+            self.blobs += blobs
+        write_file(os.path.join(self.directory, 'versions', '%s.json' % version),
+                   json.dumps({'files': {name: {'sha256': f['sha256'], 'size': f['stat'][0]}
+                                         for name, f in sorted(files.items())}},
+                              indent=1).encode('utf-8'))
+        logging.info('stored: %s, %i files, %i new blobs', version,
+                     len(files), self.blobs)
+
+
+def store_files(directory: str, files: List[Tuple[str, Optional[str]]]) -> Tuple[List[Tuple[str, str]], int]:
+    # the (path, sha256) of the files, hashed unless known, and the number
+    # of blobs written for them
+    # only needed with --store: imported here
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=STORE_LEVEL)
+    results = []
+    blobs = 0
+    for path, sha256 in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not sha256:
+            sha256 = hashlib.sha256(data).hexdigest()
+        blob = store_path(directory, 'blobs', sha256)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            write_file(blob, compressor.compress(data))
+            blobs += 1
+        results.append((path, sha256))
+    return results, blobs
+
+
+def store_path(directory: str, kind: str, sha256: str) -> str:
+    return os.path.join(directory, kind, sha256[:2], sha256[2:])
+
+
+def checkout(args: argparse.Namespace) -> None:
+    import zstandard
+    versions = os.path.join(args.store, 'versions')
+    if not args.version:
+        for e in sorted(os.listdir(versions)):
+            print(os.path.splitext(e)[0])
+        return
+    try:
+        with open(os.path.join(versions, '%s.json' % args.version)) as f:
+            files: dict[str, dict[str, Any]] = json.load(f)['files']
+    except FileNotFoundError:
+        print('no version %s in %s, see decompile.py checkout --store %s' %
+              (args.version, args.store, args.store))
+        exit(1)
+    output = args.output or args.version
+    if os.path.exists(output) and os.listdir(output):
+        print('not empty: %s' % output)
+        exit(1)
 
+    decompressed = 0
+    lock = threading.Lock()
+
+    def decompress(sha256: str) -> str:
+        # the file of the blob, shared by all the trees
+        nonlocal decompressed
+        filename = store_path(args.store, 'files', sha256)
+        if not os.path.exists(filename):
+            with open(store_path(args.store, 'blobs', sha256), 'rb') as f:
+                data = zstandard.ZstdDecompressor().decompress(f.read())
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = '%s.%i.tmp' % (filename, threading.get_native_id())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            # they're shared: edits must replace them
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp, filename)
+            with lock:
+                decompressed += 1
+        return filename
+
+    def link(name: str) -> None:
+        src = decompress(files[name]['sha256'])
+        dst = os.path.join(output, name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)  # no hardlinks to the store
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for _ in completed([executor.submit(link, name) for name in sorted(files)]):
+            pass
+    logging.info('checkout %s: %s, %i files (%i decompressed)', args.version,
+                 output, len(files), decompressed)
+
+
+# --git-fast-import: each run commits the published tree to a branch of a git
+# repository, through a git fast-import stream rather than a checkout. The
+# files are added to the stream as blobs as soon as their project is final,
+# in the pipeline, unless their content is in the last commit: these are
+# referenced by the object id recorded for their SHA-256 in .decompile/git.json,
+# with that commit and its files. The commit starts from the branch's tree:
+# the files the tree doesn't have anymore are deleted, those it has are
+# written, and the others (.gitignore, README...) are left as they are.
+class GitImport(object):
+
+    def __init__(self, directory: str, repo: str, branch: Optional[str],
+                 previous: dict[str, dict[str, Any]]):
+        # previous: the output manifest's files
+        self.repo = repo
+        self.previous = previous
+        self.filename = os.path.join(directory, 'git.json')
+        self.stream_file = os.path.join(directory, 'git-fast-import')
+        self.marks_file = os.path.join(directory, 'git-marks')
+        self.ref = 'refs/heads/%s' % branch if branch else run(
+            ['git', '-C', repo, 'symbolic-ref', 'HEAD'], 'git',
+            stdout=subprocess.PIPE, timeout=TOOL_TIMEOUT).strip()
+        self.head = self.rev_parse(self.ref)
+        state: dict[str, Any] = {}
+        with contextlib.suppress(FileNotFoundError):
+            with open(self.filename) as f:
+                state = json.load(f)
+        # the objects of the last commit exist as long as it does
+        if state.get('repo') != repo or not self.rev_parse(
+                '%s^{commit}' % state.get('commit')):
+            state = {}
+        self.state = state
+        # sha256 -> object id of the blobs in the repository
+        self.objects: dict[str, str] = state.get('objects', {})
+        # sha256 -> mark of the blobs of the stream
+        self.marks: dict[str, int] = {}
+        # path -> (size, mtime, sha256) of the files hashed by this run
+        self.hashed: dict[str, Tuple[int, int, str]] = {}
+        self.stream = open(self.stream_file, 'wb')
+        self.lock = threading.Lock()
+
+    def rev_parse(self, rev: str) -> Optional[str]:
+        try:
+            return run(['git', '-C', self.repo, 'rev-parse', '--verify',
+                        '--quiet', rev], 'git', stdout=subprocess.PIPE,
+                       timeout=TOOL_TIMEOUT).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def config(self, key: str) -> Optional[str]:
+        try:
+            return run(['git', '-C', self.repo, 'config', key], 'git',
+                       stdout=subprocess.PIPE, timeout=TOOL_TIMEOUT).strip()
+        except subprocess.CalledProcessError:
+            return None  # not set
+
+    def add(self, workspace: Workspace, path: str) -> None:
+        # the blobs of the files of path, everything with path ''
+        with workspace.lock:
+            entries = workspace.walk(path) if path else list(
+                workspace.entries.items())
+        blobs = 0
+        for name, st in entries:
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            size_mtime = (st.st_size, st.st_mtime_ns)
+            with self.lock:
+                hashed = self.hashed.get(name)
+            if hashed and hashed[:2] == size_mtime:
+                continue
+            previous = self.previous.get(name, {})
+            known = previous.get('sha256') \
+                if previous.get('stat') == list(size_mtime) else None
+            sha256, new = self.blob(name, known)
+            blobs += new
+            with self.lock:
+                self.hashed[name] = size_mtime + (sha256,)
+        logging.debug('git %s: %i new blobs', path or 'tree', blobs)
+
+    def blob(self, path: str, sha256: Optional[str]) -> Tuple[str, bool]:
+        # the file's sha256, and whether it was added to the stream
+        with self.lock:
+            if sha256 in self.objects or sha256 in self.marks:
+                return sha256, False
+        with open(path, 'rb') as f:
+            data = f.read()
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if sha256 in self.objects or sha256 in self.marks:
+                return sha256, False
+            self.marks[sha256] = len(self.marks) + 1
+            self.stream.write(b'blob\nmark :%i\ndata %i\n' %
+                              (self.marks[sha256], len(data)))
+            self.stream.write(data)
+            self.stream.write(b'\n')
+        return sha256, True
+
+    def commit(self, files: dict[str, dict[str, Any]], message: str) -> None:
+        # files: as published, in the output directory now, with
+        # .editorconfig as for the store; those the pipeline didn't read are
+        if os.path.exists('.editorconfig'):
+            files = dict(files, **{'.editorconfig': {
+                'sha256': file_digest('.editorconfig')}})
+        tree = {}
+        for name, f in sorted(files.items()):
+            tree[name.replace(os.sep, '/')], _ = self.blob(name, f['sha256'])
+        if self.head and self.head == self.state.get('commit') and \
+                tree == self.state.get('files'):
+            self.stream.close()
+            os.remove(self.stream_file)
+            logging.info('git: %s unchanged', self.ref)
+            return
+
+        committer = '%s <%s> %i %s' % (
+            self.config('user.name') or 'decompile.py',
+            self.config('user.email') or 'decompile.py', time.time(),
+            time.strftime('%z'))
+        data = message.encode('utf-8')
+        self.stream.write(b'commit %s\ncommitter %s\ndata %i\n%s\n' % (
+            self.ref.encode('utf-8'), committer.encode('utf-8'), len(data),
+            data))
+        # the files of the last commit, or those the output had, which
+        # aren't published anymore
+        last: dict[str, str] = self.state.get('files') or {
+            name.replace(os.sep, '/'): f.get('sha256', '')
+            for name, f in self.previous.items()}
+        if self.head:
+            self.stream.write(b'from %s\n' % self.head.encode('utf-8'))
+        for name in sorted(last.keys() - tree.keys()):
+            self.stream.write(b'D %s\n' % git_path(name))
+        for name, sha256 in tree.items():
+            if self.head and self.head == self.state.get('commit') and \
+                    last.get(name) == sha256:
+                continue  # as in the branch's tree already
+            # the blobs of the stream by mark, the others by id
+            blob = ':%i' % self.marks[sha256] if sha256 in self.marks \
+                else self.objects[sha256]
+            self.stream.write(b'M 100644 %s %s\n' % (blob.encode('utf-8'),
+                                                     git_path(name)))
+        self.stream.write(b'done\n')
+        self.stream.close()
+        with open(self.stream_file, 'rb') as stream:
+            run(['git', '-C', self.repo, 'fast-import', '--quiet', '--done',
+                 '--export-marks=%s' % self.marks_file], 'git fast-import',
+                timeout=TOOL_TIMEOUT, stdin=stream)
+        marks = {':%i' % mark: sha256 for sha256, mark in self.marks.items()}
+        with open(self.marks_file) as lines:
+            for line in lines:
+                mark, oid = line.split()
+                self.objects[marks[mark]] = oid
+        commit = self.rev_parse(self.ref)
+        write_file(self.filename, json.dumps({
+            'repo': self.repo, 'commit': commit, 'files': tree,
+            'objects': {sha256: self.objects[sha256]
+                        for sha256 in sorted(set(tree.values()))},
+        }, indent=1).encode('utf-8'))
+        os.remove(self.stream_file)
+        os.remove(self.marks_file)
+        logging.info('git: %s %s, %i files, %i new blobs', self.ref,
+                     cast(str, commit)[:12], len(tree), len(self.marks))
+
+
+def git_path(name: str) -> bytes:
+    # a path of a fast-import command, quoted if it must be
+    if name.startswith('"') or '\n' in name:
+        name = '"%s"' % name.replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+    return name.encode('utf-8')
+
+
+# --watch: after the first run, the game directory is watched (with inotify,
+# or by polling its listing) and once an update has landed, that is once
+# nothing changed there for WATCH_SETTLE seconds, the pipeline runs again if
+# assemblies of the tree changed. It keeps the projects of the others.
+WATCH_SETTLE = 5
+WATCH_POLL = 2
+# IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+# IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+
+def watch(args: argparse.Namespace) -> None:
+    game_dir = os.path.abspath(os.path.dirname(args.file[0]))
+    # before: an update during the first run is seen
+    watcher = Watcher(game_dir)
+    assemblies = run_pipeline(args)
+    # the tree is there now
+    args.clean = False
+    args.baseline = None
+    while True:
+        logging.info('watch: %s', game_dir)
+        watcher.wait()
+        changed = [f for f, sha256 in assemblies.items()
+                   if not os.path.exists(f) or file_digest(f) != sha256]
+        if not changed:
+            logging.info('watch: no assembly changed')
+            continue
+        logging.info('watch: %s changed', ', '.join(
+            os.path.basename(f) for f in changed))
+        try:
+            assemblies = run_pipeline(args, assemblies)
+        except Exception:
+            # the tree is as it was: everything changed since is done again
+            logging.exception('watch: run failed')
+
+
+class Watcher(object):
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.fd: Optional[int] = None
+        if sys.platform == 'linux':
+            try:
+                self.fd = inotify(directory)
+            except OSError as e:
+                logging.info('watch: no inotify (%s)', e)
+        self.listing: dict[str, Tuple[int, int]] = {}
+        if self.fd is None:
+            logging.info('watch: polling every %gs', WATCH_POLL)
+            self.listing = self.list()
+
+    def wait(self) -> None:
+        # returns once something changed, then nothing for WATCH_SETTLE
+        self.changed(None)
+        while self.changed(WATCH_SETTLE):
+            pass
+
+    def changed(self, timeout: Optional[float]) -> bool:
+        # whether something changed within timeout seconds (None: forever)
+        if self.fd is not None:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return False
+            with contextlib.suppress(BlockingIOError):
+                while os.read(self.fd, 65536):
+                    pass  # which events doesn't matter
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            listing = self.list()
+            if listing != self.listing:
+                self.listing = listing
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(WATCH_POLL if deadline is None else
+                       max(0, min(WATCH_POLL, deadline - time.monotonic())))
+
+    def list(self) -> dict[str, Tuple[int, int]]:
+        listing = {}
+        with os.scandir(self.directory) as entries:
+            for e in entries:
+                with contextlib.suppress(FileNotFoundError):
+                    st = e.stat()
+                    listing[e.name] = (st.st_size, st.st_mtime_ns)
+        return listing
+
+
+def inotify(directory: str) -> int:
+    # a non-blocking inotify descriptor for the changes of the directory's
+    # entries
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1')
+    if libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, 'inotify_add_watch: %s' % directory)
+    return int(fd)
+
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'se-decompiler')
+
+
+# Decompiled projects keyed by assembly content and decompiler flags. Each
+# entry is a directory named after its key, holding the project as the
+# decompiler wrote it (before fixes and patches). Its mtime is its last use,
+# for LRU.
+class DecompileCache(object):
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, assembly: str, *extra: str) -> str:
+        return hashlib.sha256(json.dumps([file_digest(assembly)] + list(extra)).encode(
+            'utf-8')).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return os.path.isdir(os.path.join(self.directory, key))
+
+    def restore(self, key: str, project_name: str) -> bool:
+        entry = os.path.join(self.directory, key)
+        if not os.path.isdir(entry):
+            return False
+        shutil.copytree(os.path.join(entry, 'tree'), project_name)
+        os.utime(entry)
+        return True
+
+    def store(self, key: str, project_name: str) -> None:
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        tmp = os.path.join(self.directory, 'tmp-%s-%i' % (key, os.getpid()))
+        shutil.copytree(project_name, os.path.join(tmp, 'tree'))
+        size = 0
+        for root, dirs, files in os.walk(tmp):
+            for file in files:
+                size += os.path.getsize(os.path.join(root, file))
+        with open(os.path.join(tmp, 'size'), 'w') as f:
+            f.write(str(size))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another run
+            shutil.rmtree(tmp)
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for e in os.scandir(self.directory):
+            if e.name.startswith('tmp-') or not e.is_dir():
+                continue
+            try:
+                with open(os.path.join(e.path, 'size')) as f:
+                    size = int(f.read())
+            except (OSError, ValueError):
+                size = 0  # incomplete entry: evict first
+            entries.append((e.stat().st_mtime if size else 0, size, e.path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_size and size:
+                break
+            logging.debug('cache evict: %s' % path)
+            shutil.rmtree(path)
+            total -= size
+
+
+def copy_dependencies(workspace: Workspace, game_dir: str, link: bool,
+                      jobs: int) -> None:
+    logging.info('copy dependencies')
+    os.makedirs('dependencies', exist_ok=True)
+    workspace.add('dependencies')
+    staging = [(os.path.join(game_dir, dep), os.path.join('dependencies', dep))
+               for dep in COMPILE_DEPENDENCIES + RUNTIME_DEPENDENCIES
+               if os.path.exists(os.path.join(game_dir, dep))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        staged = list(executor.map(functools.partial(stage, link=link),
+                                   *zip(*staging)))
+    # the manifest: how each file was staged
+    counts: dict[str, int] = {}
+    for (src, dst), how in zip(staging, staged):
+        workspace.add(dst)
+        counts[how] = counts.get(how, 0) + 1
+        logging.info('  %-9s %s (%i bytes)', how, dst, workspace.entries[
+            os.path.normpath(dst)].st_size)
+    logging.info('dependencies: %s', ', '.join(
+        '%i %s' % (n, how) for how, n in sorted(counts.items())))
+
+
+# Linux ioctl to share the extents of a file (btrfs, xfs, overlayfs on them...)
+FICLONE = 0x40049409
+
+
+def stage(src: str, dst: str, link: bool, hardlink: bool = True) -> str:
+    # make dst a copy of src, unless it's one already: same size and mtime, or
+    # same content when the mtime was lost (restored from a CI cache...).
+    # Returns how: unchanged, reflink, hardlink or copy.
+    st = os.stat(src)
+    try:
+        dst_st: Optional[os.stat_result] = os.stat(dst)
+    except FileNotFoundError:
+        dst_st = None
+    if dst_st and dst_st.st_size == st.st_size:
+        if dst_st.st_mtime_ns == st.st_mtime_ns:
+            return 'unchanged'
+        if file_digest(src) == file_digest(dst):
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+            return 'unchanged'
+
+    # never write through dst: it may be a hardlink to a game file
+    tmp = '%s.%i.tmp' % (dst, threading.get_native_id())
+    how = 'copy'
+    if link and sys.platform == 'linux':
+        try:
+            with open(src, 'rb') as s, open(tmp, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, tmp)
+            how = 'reflink'
+        except OSError:
+            os.remove(tmp)
+    if link and hardlink and how == 'copy':
+        try:
+            os.link(src, tmp)
+            how = 'hardlink'
+        except OSError:
+            pass  # another file system, or not supported
+    if how == 'copy':
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return how
+
+
+# ilspycmd, or DecompilerHost with --decompiler-host, through the decompile
+# cache. start() runs a single decompiler for all the projects which aren't
+# restored (from the cache or by a delta run). ilspycmd writes them all once
+# it exits. A host shares its metadata cache across them and fills all cores,
+# and the step of each project waits for it to print that its project is
+# written.
+class Decompiler(object):
+
+    def __init__(self, workspace: Workspace, netframework: str,
+                 cache: Optional[DecompileCache], delta: Optional['Delta'],
+                 ilspycmd: bool = False):
+        self.workspace = workspace
+        self.netframework = netframework
+        self.cache = cache
+        self.delta = delta
+        self.ilspycmd = ilspycmd
+        self.version = decompiler_version(ilspycmd)
+        logging.info('using %s', self.version)
+        self.keys: dict[str, str] = {}
+        # the projects given to the host, set once written (or once it failed)
+        self.done: dict[str, threading.Event] = {}
+        self.written: set[str] = set()
+        self.error: Optional[BaseException] = None
+
+    def run(self, projects: dict[str, str]) -> None:
+        self.start(projects)
+        for project_name in projects:
+            self.wait(project_name, projects[project_name])
+
+    def start(self, projects: dict[str, str]) -> None:
+        pending = {}
+        for project_name, filename in projects.items():
+            if self.delta and project_name in self.delta.fresh:
+                continue  # restored by wait()
+            if self.cache:
+                self.keys[project_name] = self.cache.key(
+                    filename, self.version, *decompiler_flags(self.netframework))
+                if self.cache.contains(self.keys[project_name]):
+                    continue
+            pending[project_name] = filename
+        if not pending:
+            return
+        for project_name in pending:
+            if self.workspace.isdir(project_name):
+                logging.debug('clean: %s' % project_name)
+                self.workspace.remove(project_name)
+            self.done[project_name] = threading.Event()
+        logging.info('decompile (%i): %s', len(pending),
+                     ' '.join(os.path.basename(f) for f in sorted(pending.values())))
+        threading.Thread(target=self.host, args=(pending,),
+                         name='DecompilerHost', daemon=True).start()
+
+    def host(self, projects: dict[str, str]) -> None:
+        names = {os.path.abspath(f): name for name, f in projects.items()}
+
+        def written(line: str) -> None:
+            name = names[line]
+            self.written.add(name)
+            self.done[name].set()
+        try:
+            if self.ilspycmd:
+                self.run_ilspycmd(projects)
+            else:
+                run([dotnet_tool('DecompilerHost')] +
+                    decompiler_flags(self.netframework) +
+                    ['-o', '.'] + sorted(projects.values()),
+                    'DecompilerHost (%i assemblies)' % len(projects),
+                    stdout=subprocess.PIPE, lines=written, timeout=DECOMPILE_TIMEOUT)
+        except BaseException as e:
+            self.error = e
+        finally:
+            for name in projects:
+                self.done[name].set()
+
+    def run_ilspycmd(self, projects: dict[str, str]) -> None:
+        assemblies = sorted(projects.values())
+        if len(assemblies) == 1:
+            # a single assembly is written directly in the output directory
+            run(ilspycmd(self.netframework) + ['-o', next(iter(projects))] + assemblies,
+                'ilspycmd %s' % os.path.basename(assemblies[0]),
+                timeout=DECOMPILE_TIMEOUT)
+        else:
+            run(ilspycmd(self.netframework) + ['-o', '.'] + assemblies,
+                'ilspycmd (%i assemblies)' % len(assemblies),
+                timeout=DECOMPILE_TIMEOUT)
+            for filename in glob.glob('*.sln'):
+                os.remove(filename)
+                self.workspace.discard(filename)
+        self.written.update(projects)
+
+    def wait(self, project_name: str, filename: str) -> None:
+        if self.delta and self.delta.restore(self.workspace, project_name):
+            return
+        if project_name not in self.done:
+            if self.workspace.isdir(project_name):
+                logging.debug('clean: %s' % project_name)
+                self.workspace.remove(project_name)
+            if self.cache and self.cache.restore(self.keys[project_name], project_name):
+                logging.info('cached: %s', project_name)
+                self.workspace.scan(project_name)
+                fix_permissions(self.workspace, project_name)
+                return
+            # evicted since start()
+            self.start({project_name: filename})
+        self.done[project_name].wait()
+        if project_name not in self.written:
+            raise Exception('%s failed before writing %s' % (
+                'ilspycmd' if self.ilspycmd else 'DecompilerHost',
+                project_name)) from self.error
+        logging.info('decompiled: %s', project_name)
+        self.workspace.scan(project_name)
+        fix_permissions(self.workspace, project_name)
+        if self.cache:
+            self.cache.store(self.keys[project_name], project_name)
+
+
+@functools.cache
+def decompiler_version(ilspycmd: bool = False) -> str:
+    # the version of ICSharpCode.Decompiler, and of the host itself
+    if ilspycmd:
+        v = run(['ilspycmd', '--disable-updatecheck', '--version'],
+                'ilspycmd --version', stdout=subprocess.PIPE,
+                timeout=TOOL_TIMEOUT)
+        return v.splitlines()[0]
+    v = run([dotnet_tool('DecompilerHost'), '--version'],
+            'DecompilerHost --version', stdout=subprocess.PIPE,
+            timeout=TOOL_TIMEOUT)
+    return '%s (%s)' % (v.splitlines()[0],
+                        file_digest(dotnet_assembly('DecompilerHost'))[:12])
+
+
+def decompiler_flags(netframework: str) -> List[str]:
+    # those of ilspycmd, which DecompilerHost takes too; it always writes
+    # projects as --project --nested-directories does
     # https://learn.microsoft.com/en-us/dotnet/csharp/whats-new/csharp-version-history
     # https://www.geeksforgeeks.org/c-sharp/c-sharp-version-history/
     # C# 4.0 (2010) .NET Framework 4.0
@@ -271,101 +2598,729 @@ def decompile(projects: dict[str, str], netframework: str) -> None:
     # C# 12 (2023) .NET 8.0
     # C# 13 (2024) .NET 9.0
     # C# 14 (2025) .NET 10.0
-    subprocess.run([
-        'ilspycmd',
-        '--disable-updatecheck',
+    return [
         '--languageversion', 'CSharp12_0',
-        '--project',
-        '--nested-directories',
         '--referencepath', netframework,
         '-ds', 'SortCustomAttributes=true',
-        '-o', '.'] + assemblies, check=True)
+    ]
+
+
+def ilspycmd(netframework: str) -> List[str]:
+    # writing projects as DecompilerHost does
+    return ['ilspycmd', '--disable-updatecheck', '--project',
+            '--nested-directories'] + decompiler_flags(netframework)
+
+
+# Types of the decompiled assemblies, hashed by HashTypes, and patches applied,
+# recorded in .decompile/types.json: the tree can then be the baseline of a
+# run on other versions of the assemblies (--baseline), which only decompiles
+# what changed. Each project is then either:
+#   unchanged: copied from the baseline, none of its types changed
+#   delta: copied, the files of the types removed are deleted, and those of
+#          the types added, changed or referring to a type which changed (in
+#          any project) are decompiled again, one by one (DecompilerHost
+#          -t, with --decompiler-host). Only those files are fixed and
+#          patched: the files of the patches which changed, or which change
+#          one of them, are decompiled again too.
+#   full: decompiled as usual, when it isn't in the baseline, when the
+#          assembly itself changed (attributes, references, resources...),
+#          when a type to decompile shares its file or has none, when too
+#          many types changed, or when it has types to decompile but
+#          ilspycmd is the decompiler
+# The decisions, with the types of each project, go to .decompile/delta.json.
+# With --type or --namespace, the tree itself is the starting point: only the
+# projects of the matching types are touched, and in them only the files of
+# those types are decompiled again (partial), fixed and patched. The tree is
+# then a mix of versions, which types.json doesn't describe: it's left as is.
+TYPES_FILE = 'types.json'
+DELTA_FILE = 'delta.json'
+# DecompilerHost -t loads the assembly again for each type: past this many
+# types or this share of the project, decompiling it all is faster
+DELTA_MAX_TYPES = 200
+DELTA_MAX_SHARE = 0.5
+
+
+class Delta(object):
+
+    def __init__(self, args: argparse.Namespace, projects: dict[str, str],
+                 cache_dir: Optional[str]):
+        self.baseline: Optional[str] = args.baseline
+        # a nested type is in the file of its top-level type
+        self.patterns = [p.split('+')[0] for p in args.type]
+        self.namespaces: List[str] = args.namespace
+        self.selected = bool(self.patterns or self.namespaces)
+        self.projects = projects
+        self.cache_dir = cache_dir
+        self.jobs = args.jobs
+        self.netframework = args.netframework
+        # ilspycmd -t doesn't decompile a type as in its project: with it, the
+        # projects with types to decompile are decompiled as usual
+        self.ilspycmd: bool = not args.decompiler_host
+        # what the tree depends on besides the assemblies and the patches:
+        # the decompiler, the fixes and project() (this file) and the hashes
+        self.settings = hashlib.sha256(json.dumps([
+            decompiler_version(self.ilspycmd), decompiler_flags(''),
+            args.fixes, args.projects, file_digest(__file__),
+            file_digest(dotnet_assembly('HashTypes')),
+        ]).encode('utf-8')).hexdigest()
+        self.patches: dict[str, dict[str, Any]] = {}
+        if args.patches:
+            for group in patch_groups(projects).values():
+                for filename, name in group:
+                    paths, created = patch_paths(filename)
+                    self.patches[name] = {'sha256': file_digest(filename),
+                                          'paths': paths, 'created': created}
+        self.types: dict[str, Any] = {}
+        # per project: the decisions, for delta.json, then for the delta
+        # ones the types to decompile with their files, the files to delete
+        # and all the files to fix and patch
+        self.plans: dict[str, dict[str, Any]] = {}
+        self.decompile: dict[str, dict[str, str]] = {}
+        self.delete: dict[str, set[str]] = {}
+        self.fresh: dict[str, set[str]] = {}
+        # whether OriginalTypes.cs is extracted again, or kept
+        self.extract_types = True
+
+    def hash(self) -> None:
+        hashes = type_hashes(self.projects.values(), self.cache_dir)
+        self.types = {name: hashes[os.path.abspath(path)]
+                      for name, path in self.projects.items()
+                      if os.path.abspath(path) in hashes}
+        if self.baseline:
+            self.plan(self.baseline)
+        elif self.selected:
+            self.select()
+
+    def plan(self, directory: str) -> None:
+        try:
+            with open(os.path.join(directory, '.decompile', TYPES_FILE)) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            baseline = {}
+        # the types which changed, in any project
+        changed: set[str] = set()
+        for name in set(self.types) | set(baseline.get('projects', {})):
+            new = self.types.get(name, {}).get('types', {})
+            old = baseline.get('projects', {}).get(name, {}).get('types', {})
+            changed.update(t for t in new.keys() | old.keys()
+                           if new.get(t, {}).get('hash') != old.get(t, {}).get('hash'))
+
+        for name in sorted(self.projects):
+            if not baseline:
+                plan = {'mode': 'full',
+                        'reason': 'no %s in baseline' % TYPES_FILE}
+            elif baseline['settings'] != self.settings:
+                plan = {'mode': 'full',
+                        'reason': 'other decompiler, fixes or projects'}
+            else:
+                plan = self.plan_project(name, directory, baseline, changed)
+            self.plans[name] = plan
+            if plan['mode'] == 'full':
+                logging.info('delta %s: full, %s', name, plan['reason'])
+            else:
+                logging.info('delta %s: %s, %i types added, %i removed, %i changed, %i decompiled',
+                             name, plan['mode'], len(plan['added']),
+                             len(plan['removed']), len(plan['changed']),
+                             len(plan['decompiled']))
+        modes = [plan['mode'] for plan in self.plans.values()]
+        logging.info('delta: %s', ', '.join(
+            '%i %s' % (modes.count(mode), mode) for mode in ['unchanged', 'delta', 'full']))
+
+    def plan_project(self, name: str, directory: str, baseline: dict[str, Any],
+                     changed: set[str]) -> dict[str, Any]:
+        old = baseline['projects'].get(name)
+        new = self.types.get(name)
+        root = os.path.join(directory, name)
+        if not old or not new or not os.path.isdir(root):
+            return {'mode': 'full', 'reason': 'not in baseline'}
+        if old['assembly'] != new['assembly']:
+            return {'mode': 'full', 'reason': 'assembly changed'}
+        old_types, new_types = old['types'], new['types']
+        plan: dict[str, Any] = {
+            'added': sorted(new_types.keys() - old_types.keys()),
+            'removed': sorted(old_types.keys() - new_types.keys()),
+            'changed': sorted(t for t in new_types.keys() & old_types.keys()
+                              if new_types[t]['hash'] != old_types[t]['hash']),
+        }
 
-    for project_name in projects:
-        fix_permissions(project_name)
-    for filename in glob.glob('*.sln'):
-        os.remove(filename)
+        existing = {os.path.relpath(os.path.join(d, f), directory)
+                    for d, _, files in os.walk(root) for f in files}
+        old_files = {t: type_file(name, v) for t, v in old_types.items()}
+        new_files = {t: type_file(name, v) for t, v in new_types.items()}
+        # files of several types (Foo and Foo<T>...) are decompiled at once
+        shared = {path.lower() for files in [old_files, new_files]
+                  for path, count in collections.Counter(
+                      p.lower() for p in files.values()).items() if count > 1}
+        type_of = {path: t for t, path in new_files.items()
+                   if path.lower() not in shared}
+        decompile = set(plan['added']) | set(plan['changed']) | {
+            t for t, v in new_types.items() if not changed.isdisjoint(v['references'])}
+        fresh = {new_files[t] for t in decompile} | {
+            old_files[t] for t in plan['removed']}
+        delete = {old_files[t] for t in plan['removed']} & existing
+
+        # patches which changed, or which change a fresh file, are applied
+        # again to fresh files
+        old_patches = {k: v for k, v in baseline['patches'].items()
+                       if k.startswith(name + '/')}
+        new_patches = {k: v for k, v in self.patches.items()
+                       if k.startswith(name + '/')}
+        created = {p for v in list(old_patches.values()) + list(new_patches.values())
+                   for p in v['created']}
+        touched = {k: set(old_patches.get(k, {}).get('paths', [])) | set(
+            new_patches.get(k, {}).get('paths', []))
+            for k in old_patches.keys() | new_patches.keys()}
+        applied: set[str] = set()
+        while True:
+            pending = sorted(k for k in touched.keys() - applied
+                             if old_patches.get(k) != new_patches.get(k)
+                             or not fresh.isdisjoint(touched[k]))
+            if not pending:
+                break
+            for k in pending:
+                applied.add(k)
+                for path in sorted(touched[k] - fresh):
+                    fresh.add(path)
+                    if path in created:
+                        delete.add(path)  # created again by the patch
+                    elif path in type_of:
+                        decompile.add(type_of[path])
+                    elif path in existing:
+                        return {'mode': 'full', 'reason': '%s patches %s, not a type file' % (k, path)}
+        delete &= existing
+        patched = {p for k in applied for p in touched[k]}
+
+        for t in sorted(decompile):
+            if '<' in new_types[t]['name']:
+                # compiler generated, not decompiled on its own
+                decompile.discard(t)
+                fresh.discard(new_files[t])
+            elif new_files[t].lower() in shared:
+                return {'mode': 'full', 'reason': '%s shares its file' % t}
+            elif t in old_types and new_files[t] not in existing | patched:
+                return {'mode': 'full', 'reason': 'no file for %s' % t}
+            elif t not in old_types and new_files[t] in existing - delete:
+                return {'mode': 'full', 'reason': '%s exists' % new_files[t]}
+        for t in plan['removed']:
+            if old_files[t].lower() in shared:
+                return {'mode': 'full', 'reason': '%s shares its file' % t}
+        if len(decompile) > min(DELTA_MAX_TYPES, DELTA_MAX_SHARE * len(new_types)):
+            return {'mode': 'full', 'reason': '%i types to decompile' % len(decompile)}
+        if decompile and self.ilspycmd:
+            return {'mode': 'full', 'reason': 'types to decompile with ilspycmd'}
+
+        plan['mode'] = 'delta' if fresh else 'unchanged'
+        plan['decompiled'] = sorted(decompile)
+        plan['deleted'] = sorted(delete)
+        plan['patches'] = sorted(applied)
+        self.decompile[name] = {t: new_files[t] for t in decompile}
+        self.delete[name] = delete
+        self.fresh[name] = fresh
+        return plan
+
+    def keep(self, names: Collection[str], extract_types: bool) -> None:
+        # --watch: the projects of assemblies which didn't change since the
+        # tree was made are kept, not decompiled, fixed nor patched again
+        for name in names:
+            self.decompile[name] = {}
+            self.delete[name] = set()
+            self.fresh[name] = set()
+        self.extract_types = extract_types
+        logging.info('watch: %i of %i projects unchanged%s', len(names),
+                     len(self.projects),
+                     '' if extract_types else ', OriginalTypes.cs kept')
+
+    def select(self) -> None:
+        for name in sorted(self.projects):
+            types = self.types.get(name, {}).get('types', {})
+            selected = sorted(t for t, v in types.items() if '<' not in v['name'] and (
+                any(fnmatch.fnmatchcase(t, p) or fnmatch.fnmatchcase(t.split('`')[0], p)
+                    for p in self.patterns)
+                or any(v['namespace'] == ns or v['namespace'].startswith(ns + '.')
+                       for ns in self.namespaces)))
+            if not selected:
+                self.fresh[name] = set()  # nothing to do
+                continue
+            files = {t: type_file(name, v) for t, v in types.items()}
+            counts = collections.Counter(p.lower() for p in files.values())
+            shared = [t for t in selected if counts[files[t].lower()] > 1]
+            if shared or self.ilspycmd:
+                self.plans[name] = {'mode': 'full', 'reason': '%s shares its file' % shared[0]
+                                    if shared else 'types to decompile with ilspycmd'}
+                logging.info('select %s: full, %s', name,
+                             self.plans[name]['reason'])
+                continue
+            self.plans[name] = {'mode': 'partial', 'decompiled': selected}
+            self.decompile[name] = {t: files[t] for t in selected}
+            self.delete[name] = set()
+            self.fresh[name] = set(self.decompile[name].values())
+            logging.info('select %s: %i types', name, len(selected))
+        if not self.plans:
+            raise Exception('no type matches --type or --namespace')
+
+    def restore(self, workspace: 'Workspace', name: str) -> bool:
+        # the project from the baseline, or as it is in the tree, with the
+        # types which changed or were selected decompiled again, if it's not
+        # decompiled as usual
+        if name not in self.fresh:
+            return False
+        if self.baseline:
+            logging.info('%s from baseline: %s',
+                         self.plans[name]['mode'], name)
+            if workspace.isdir(name):
+                workspace.remove(name)
+            for d, _, files in os.walk(os.path.join(self.baseline, name)):
+                target = os.path.relpath(d, self.baseline)
+                os.makedirs(target, exist_ok=True)
+                for f in files:
+                    # not hardlinked: editing one tree mustn't change the other
+                    stage(os.path.join(d, f), os.path.join(target, f), True,
+                          hardlink=False)
+        for path in sorted(self.delete[name]):
+            os.remove(path)
+        types = sorted(self.decompile[name].items())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.decompile_type, self.projects[name], t, path)
+                       for t, path in types]
+            for _ in completed(futures):
+                pass
+        if self.baseline:
+            workspace.scan(name)
+        else:
+            for _, path in types:
+                workspace.add(path)
+        return True
+
+    def decompile_type(self, assembly: str, type_name: str, path: str) -> None:
+        args = [dotnet_tool('DecompilerHost')] + \
+            decompiler_flags(self.netframework)
+        with tempfile.TemporaryDirectory() as tmp:
+            # written in tmp as <assembly>.decompiled.cs
+            run(args + ['-o', tmp, '-t', type_name, assembly],
+                'DecompilerHost -t %s' % type_name, timeout=TOOL_TIMEOUT)
+            [output] = os.listdir(tmp)
+            data = pathlib.Path(tmp, output).read_bytes()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, data)
+
+    def save(self, directory: str) -> None:
+        if self.selected:
+            return
+        write_file(os.path.join(directory, TYPES_FILE), json.dumps({
+            'settings': self.settings,
+            'projects': self.types,
+            'patches': self.patches,
+        }, sort_keys=True).encode('utf-8'))
+        if self.baseline:
+            write_file(os.path.join(directory, DELTA_FILE), json.dumps({
+                'baseline': self.baseline,
+                'projects': self.plans,
+            }, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def type_file(project_name: str, t: dict[str, str]) -> str:
+    # where DecompilerHost writes a top-level type, as ilspycmd --project
+    # --nested-directories does: namespace directories, and the name without
+    # its generic arity
+    def clean(name: str) -> str:
+        return re.sub(r'[<>:"/\\|?*\x00-\x1f]', '-', name)
+    parts = [clean(p) for p in t['namespace'].split('.') if t['namespace']]
+    name = clean(t['name'].split('`')[0])
+    return os.path.join(project_name, *parts, name + '.cs')
+
+
+# C# tokens which may contain braces (comments, strings, chars) or braces.
+# Interpolated strings are only started here: their holes are code, with
+# strings and braces of their own.
+CSHARP_BRACES = re.compile(r"""
+    //[^\n]*
+  | /\*.*?\*/
+  | (?:\$@?|@\$)"
+  | @"(?:[^"]|"")*"
+  | "(?:[^"\\\n]|\\.)*"
+  | '(?:[^'\\\n]|\\.)+'
+  | [{}]
+""", re.DOTALL | re.VERBOSE)
+# in the text of an interpolated string: its end, a hole, or what's neither
+# (escapes, {{ and, verbatim, "")
+CSHARP_INTERPOLATED = re.compile(r'\\.|\{\{|[{"]', re.DOTALL)
+CSHARP_INTERPOLATED_VERBATIM = re.compile(r'""|\{\{|[{"]')
+
+
+def block_end(s: str, start: int, level: int = 0) -> int:
+    # the end of the block from start, or of the hole start is in with
+    # level 1; -1 if it doesn't end
+    i = start
+    while m := CSHARP_BRACES.search(s, i):
+        i = m.end(0)
+        token = m.group(0)
+        if token == '{':
+            level += 1
+        elif token == '}':
+            level -= 1
+            if level == 0:
+                return i
+            if level < 0:
+                break
+        elif token in ('$"', '$@"', '@$"'):
+            i = interpolated_end(s, i, '@' in token)
+            if i < 0:
+                break
+    return -1
+
+
+def interpolated_end(s: str, start: int, verbatim: bool) -> int:
+    # the end of the interpolated string whose text starts at start
+    text = CSHARP_INTERPOLATED_VERBATIM if verbatim else CSHARP_INTERPOLATED
+    i = start
+    while m := text.search(s, i):
+        i = m.end(0)
+        if m.group(0) == '"':
+            return i
+        if m.group(0) == '{':
+            i = block_end(s, i, 1)
+            if i < 0:
+                break
+    return -1
 
 
 def remove_block(pattern: str, s: str) -> str:
-    cuts = []
+    chunks = []
+    end = 0
     for m in re.finditer(pattern, s):
-        i = m.start(0)
-        level = 0
-        while i < len(s):
-            if s[i] == '{':
-                level += 1
-            elif s[i] == '}':
-                level -= 1
-                if level == 0:
-                    break
-            i += 1
-        if level == 0:
-            cuts += [(m.start(0), i+1)]
-    for start, end in reversed(cuts):
-        s = s[:start] + s[end:]
-    return s
-
+        if m.start(0) < end:
+            continue  # inside a block already removed
+        e = block_end(s, m.end(0))
+        if e < 0:
+            continue
+        chunks.append(s[end:m.start(0)])
+        end = e
+    if not chunks:
+        return s
+    chunks.append(s[end:])
+    return ''.join(chunks)
+
+
+# (name, marker, fix): a fix only runs on files containing its marker, which
+# is looked up in the raw bytes so most files are never decoded
+FIXES: List[Tuple[str, bytes, Callable[[str], str]]] = [
+    # error CS0104: 'Nullable' is an ambiguous reference between 'VRage.Serialization.NullableAttribute' and 'System.Runtime.CompilerServices.NullableAttribute'
+    ('nullable', b'[Nullable]', lambda s: s.replace(
+        '[Nullable]', '[VRage.Serialization.Nullable]')),
+
+    # stabilize "E:\\Repo1\\Sources\\..." which varies with Repo1/2/3 depending on the build and pollutes the diff
+    ('repo-path', b'\\Repo', lambda s: re.sub(
+        r'"[A-Z]:\\+Repo[0-9]\\+Sources\\+', '"', s)),
+
+    # ILSpy generated these explicit interface implementation from .override directive in CreateInstance, but they don't compile and are useless
+    ('actor', b'_003C_003EActor', lambda s: remove_block(
+        r'\s*private class \w+_003C_003EActor', s)),
+    ('accessor', b'_003C_003EAccessor', lambda s: remove_block(
+        r'\s*protected class \w+_003C_003EAccessor', s)),
+    ('sync-composer', b'003C_003ESyncComposer', lambda s: remove_block(
+        r'\s*protected class \w+003C_003ESyncComposer', s)),
+
+    # error CS0238: [...] cannot be sealed because it is not an override
+    ('sealed-invoke', b'public sealed void Invoke(', lambda s: s.replace(
+        'public sealed void Invoke(', 'public void Invoke(')),
+]
 
-def fixes() -> None:
-    logging.info('fixes')
 
+def fix_source(data: bytes, timings: Optional[dict[str, float]] = None) -> Tuple[Optional[bytes], List[str]]:
+    fixes = [(name, fix) for name, marker, fix in FIXES if marker in data]
+    if not fixes:
+        return None, []
+    original = data.decode('utf-8')
+    buf = original
+    hits = []
+    for name, fix in fixes:
+        start = time.perf_counter()
+        fixed = fix(buf)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + \
+                time.perf_counter() - start
+        if fixed != buf:
+            hits.append(name)
+            buf = fixed
+    if not hits:
+        return None, []
+    return buf.encode('utf-8'), hits
+
+
+def fix_files(filenames: List[str]) -> Tuple[dict[str, List[str]], dict[str, int], List[dict[str, Any]]]:
+    # the files changed with the rules which changed them, the hits of each
+    # rule, and the profile events
+    start, cpu = time.time(), time.thread_time()
+    changed = {}
+    hits: dict[str, int] = {}
+    timings: dict[str, float] = {}
+    for filename in filenames:
+        try:
+            # open/write as binary or it may convert line endings
+            with open(filename, 'rb') as f:
+                buf, names = fix_source(f.read(), timings)
+            if buf is not None:
+                write_file(filename, buf)
+        except Exception as e:
+            raise Exception('%s: %s' % (filename, e)) from e
+        if names:
+            changed[filename] = names
+        for name in names:
+            hits[name] = hits.get(name, 0) + 1
+    # the rules ran interleaved: show their total time one after the other
+    events = [event('fixes', 'fixes (%i files)' % len(filenames), start,
+                    time.time() - start, time.thread_time() - cpu)]
+    for name, wall in timings.items():
+        events.append(event('fix', name, start, wall, wall))
+        start += wall
+    return changed, hits, events
+
+
+def editorconfig() -> None:
     # ignore .NET 9 Windows Forms security analyzer, a breaking change
     # https://learn.microsoft.com/en-us/dotnet/core/compatibility/windows-forms/9.0/security-analyzers#recommended-action
-    with open('.editorconfig', 'wb') as f:
-        f.write(b'''[*.cs]
+    data = b'''[*.cs]
 dotnet_diagnostic.WFO1000.severity = silent
-''')
-
-    for filename in pathlib.Path('.').rglob('*.cs'):
-        # open/write as binary or it may convert line endings
-        with open(filename, 'rb') as f:
-            original = f.read().decode('utf-8')
-        buf = original
-
-        # error CS0104: 'Nullable' is an ambiguous reference between 'VRage.Serialization.NullableAttribute' and 'System.Runtime.CompilerServices.NullableAttribute'
-        buf = buf.replace('[Nullable]', '[VRage.Serialization.Nullable]')
-
-        # stabilize "E:\\Repo1\\Sources\\..." which varies with Repo1/2/3 depending on the build and pollutes the diff
-        buf = re.sub(r'"[A-Z]:\\+Repo[0-9]\\+Sources\\+', '"', buf)
-
-        # ILSpy generated these explicit interface implementation from .override directive in CreateInstance, but they don't compile and are useless
-        buf = remove_block(r'\s*private class \w+_003C_003EActor', buf)
-        buf = remove_block(r'\s*protected class \w+_003C_003EAccessor', buf)
-        buf = remove_block(r'\s*protected class \w+003C_003ESyncComposer', buf)
-
-        # error CS0238: [...] cannot be sealed because it is not an override
-        buf = buf.replace('public sealed void Invoke(', 'public void Invoke(')
-
-        if buf != original:
-            with open(filename, 'wb') as f:
-                f.write(buf.encode('utf-8'))
-
-
-def patches(projects: dict[str, str], game_dir: str, check: bool) -> None:
-    logging.info('apply patches')
+'''
+    # it's an input of every compilation: keep its mtime
+    if not os.path.exists('.editorconfig') or pathlib.Path('.editorconfig').read_bytes() != data:
+        write_file('.editorconfig', data)
+
+
+def fixes(workspace: Workspace, project_name: str, jobs: int,
+          executor: Optional[concurrent.futures.ProcessPoolExecutor],
+          fresh: Optional[dict[str, set[str]]] = None) -> None:
+    filenames = workspace.files('.cs', project_name)
+    if fresh is not None and project_name in fresh:
+        filenames = [f for f in filenames if f in fresh[project_name]]
+    changed: dict[str, List[str]] = {}
+    hits: dict[str, int] = {}
+    if not executor:
+        changed, hits, events = fix_files(filenames)
+        profiler.add(*events)
+    else:
+        # several chunks per worker to even out the load
+        size = max(16, len(filenames) // (jobs * 4) + 1)
+        futures = [executor.submit(fix_files, filenames[i:i + size])
+                   for i in range(0, len(filenames), size)]
+        for _, (c, h, events) in completed(futures):
+            changed.update(c)
+            for name, count in h.items():
+                hits[name] = hits.get(name, 0) + count
+            profiler.add(*events)
+
+    for filename, rules in changed.items():
+        workspace.add(filename, 'fixes: %s' % ', '.join(rules))
+    logging.info('fixed %s: %i of %i files', project_name,
+                 len(changed), len(filenames))
+    for name, _, _ in FIXES:
+        if hits.get(name):
+            logging.debug('fix %s %s: %i' % (project_name, name, hits[name]))
+
+
+# the assemblies ExtractTypes lists the types of (see ExtractTypes.cs)
+EXTRACT_TYPES_ASSEMBLIES = ['Sandbox.Game.dll', 'Sandbox.Graphics.dll',
+                            'SpaceEngineers.Game.dll', 'Sandbox.Common.dll']
+
+
+def extract_types(game_dir: str, cache_dir: Optional[str],
+                  verify: bool) -> str:
+    # ExtractTypes reads the metadata of the game assemblies, resolving base
+    # types and attributes across any of the game_dir/*.dll, so the output is
+    # keyed by all of them and the tool itself; verify extracts them again
+    # even if cached
+    tool = dotnet_tool('ExtractTypes')
+    filename = None
+    if cache_dir:
+        key = hashlib.sha256(json.dumps(
+            [(os.path.basename(f), file_digest(f))
+             for f in sorted(glob.glob(os.path.join(game_dir, '*.dll')))] +
+            [file_digest(dotnet_assembly('ExtractTypes'))]
+        ).encode('utf-8')).hexdigest()
+        filename = os.path.join(cache_dir, 'types-%s.cs' % key)
+        if os.path.exists(filename) and not verify:
+            logging.info('cached: %s', os.path.basename(filename))
+            with open(filename) as f:
+                return f.read()
+
+    # the order of the types is the network protocol: with verify, those read
+    # from the metadata are compared with MyTypeTable.ShouldRegister itself,
+    # loading the game, and a mismatch fails the run
+    logging.info('extract types%s', ' (verify)' if verify else '')
+    types = run([tool] + (['--verify'] if verify else []) + [game_dir],
+                'ExtractTypes', stdout=subprocess.PIPE, timeout=TOOL_TIMEOUT)
+
+    if filename:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        for old in glob.glob(os.path.join(os.path.dirname(filename), 'types-*.cs')):
+            os.remove(old)
+        tmp = '%s.%i' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(types)
+        os.replace(tmp, filename)
+    return types
+
+
+# what the patches of a project change: the files, the hunks which failed and
+# the patches which changed each file
+PatchResult = Tuple[dict[str, Optional[bytes]], List[patcher.Rejected],
+                    dict[str, List[str]]]
+
+
+# The patches of each project, checked then applied as soon as the project is
+# fixed. With check or refresh, nothing is written until every project has
+# been checked: finish() then applies them all. In the projects of a delta
+# run or of --type, only the patches changing the files decompiled again
+# apply, to those files.
+class Patches(object):
+
+    def __init__(self, workspace: Workspace, projects: dict[str, str],
+                 check: bool, refresh: bool,
+                 executor: Optional[concurrent.futures.ProcessPoolExecutor],
+                 fresh: Optional[dict[str, set[str]]] = None,
+                 directory: Optional[str] = None):
+        self.workspace = workspace
+        self.check = check
+        self.refresh = refresh
+        # .decompile, where the report of refresh goes (else only logged)
+        self.directory = directory
+        self.executor = executor
+        self.fresh = fresh
+        # OriginalTypes.cs, unless it's kept as it is (--watch)
+        self.types: Optional[str] = None
+        self.results: dict[str, PatchResult] = {}
+        self.groups = patch_groups(projects)
+        # the patches applied to each project
+        self.applied: dict[str, List[Tuple[str, str]]] = {}
+
+    def deferred(self) -> bool:
+        return self.check or self.refresh
+
+    def extract_types(self, game_dir: str, cache_dir: Optional[str],
+                      verify: bool) -> None:
+        self.types = extract_types(game_dir, cache_dir, verify)
+
+    def apply(self, project: str) -> None:
+        if project == 'VRage' and self.types is not None:
+            # extract types for network compatibility, then VRage/use-original-types.patch uses it
+            original_types = os.path.join(
+                'VRage', 'VRage', 'Network', 'OriginalTypes.cs')
+            write_file(original_types, self.types.encode('utf-8'))
+            self.workspace.add(original_types)
+
+        group = self.groups[project]
+        only = None
+        if self.fresh is not None and project in self.fresh:
+            # those of the files decompiled again, on those files only
+            only = self.fresh[project]
+            group = [(filename, name) for filename, name in group
+                     if not only.isdisjoint(patch_paths(filename)[0])]
+        self.applied[project] = group
+        for _, name in group:
+            logging.info('apply: %s' % name)
+        # projects don't share files so their patches are checked in parallel
+        if self.executor:
+            changes, rejected, origins, events = self.executor.submit(
+                dry_run, group, only).result()
+        else:
+            changes, rejected, origins, events = dry_run(group, only)
+        self.results[project] = changes, rejected, origins
+        profiler.add(*events)
+        if not self.deferred():
+            self.commit(project)
+
+    def finish(self) -> None:
+        # check every hunk before writing anything
+        if self.refresh and any(rejected for _, rejected, _ in self.results.values()):
+            refresh_patches(self.workspace, self.applied, self.results,
+                            self.directory)
+        rejected = [r for project in sorted(self.results)
+                    for r in self.results[project][1]]
+        if rejected and self.check:
+            for r in rejected:
+                logging.warning('%s', r)
+            raise Exception('%i patch hunks failed' % len(rejected))
+        for project in sorted(self.results):
+            self.commit(project)
+
+    def commit(self, project: str) -> None:
+        changes, rejected, origins = self.results[project]
+        for r in rejected:
+            logging.warning('%s', r)
+        patcher.commit('.', changes)
+        for path, data in changes.items():
+            if data is None:
+                self.workspace.discard(path)
+            else:
+                self.workspace.add(path, 'patches: %s' %
+                                   ', '.join(origins[path]))
 
-    # extract types for network compatibility, then VRage/use-original-types.patch uses it
-    types = subprocess.run([dotnet_binary('ExtractTypes'), game_dir],
-                           stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout
-    with open(os.path.join('VRage', 'VRage', 'Network', 'OriginalTypes.cs'), 'w') as f:
-        f.write(types)
 
-    patch_dir = os.path.join(os.path.dirname(__file__), 'patches')
-    for filename in sorted(pathlib.Path(patch_dir).rglob('*.patch')):
+def patch_groups(projects: Collection[str]) -> dict[str, List[Tuple[str, str]]]:
+    # the (filename, name) of the patches of each project, in order
+    groups: dict[str, List[Tuple[str, str]]] = {}
+    for filename in sorted(pathlib.Path(PATCH_DIR).rglob('*.patch')):
         project = os.path.basename(os.path.dirname(filename))
         patch = os.path.basename(filename)
         if project not in projects:
             logging.debug('skip: %s/%s' % (project, patch))
             continue
-        logging.info('apply: %s/%s' % (project, patch))
-        r = subprocess.run(['patch', '-p1', '--binary',
-                           '-f', '-s', '-i', filename], check=check)
-
-    for e in pathlib.Path('.').rglob('*.orig'):
-        os.remove(e)
-    for e in pathlib.Path('.').rglob('*.rej'):
-        os.remove(e)
+        groups.setdefault(project, []).append(
+            (str(filename), '%s/%s' % (project, patch)))
+    return groups
+
+
+def patch_paths(filename: str) -> Tuple[List[str], List[str]]:
+    # the files a patch may change and, among them, those it creates
+    paths: List[str] = []
+    created: List[str] = []
+    for file_patch in patcher.parse(filename):
+        for path in file_patch.paths():
+            paths.append(os.path.normpath(path))
+            if file_patch.created():
+                created.append(os.path.normpath(path))
+    return sorted(set(paths)), sorted(set(created))
+
+
+def dry_run(patches: List[Tuple[str, str]], only: Optional[set[str]] = None) -> Tuple[dict[str, Optional[bytes]], List[patcher.Rejected], dict[str, List[str]], List[dict[str, Any]]]:
+    timings: List[Tuple[str, float, float, float]] = []
+    changes, rejected, origins = patcher.dry_run('.', patches, timings, only)
+    return changes, rejected, origins, [event('patch', *t) for t in timings]
+
+
+# where refresh_patches() reports what it did with each hunk, in .decompile:
+# not in the tree, which is published
+REFRESH_FILE = 'refresh-patches.json'
+
+
+def refresh_patches(workspace: Workspace,
+                    groups: dict[str, List[Tuple[str, str]]],
+                    results: dict[str, PatchResult],
+                    directory: Optional[str]) -> None:
+    failed = sorted(project for project in results if results[project][1])
+    relocator = patcher.Relocator([r.hunk for project in failed
+                                   for r in results[project][1] if r.hunk])
+    logging.info('refresh patches: index sources')
+    for filename in workspace.files('.cs'):
+        with open(filename, 'rb') as f:
+            relocator.scan(filename, f.read())
+
+    report = []
+    for project in failed:
+        changes, rejected, origins, refreshed, r = patcher.refresh(
+            '.', groups[project], relocator)
+        results[project] = (changes, rejected, origins)
+        report += r
+        for patch, data in refreshed.items():
+            logging.info('refreshed: %s', patch)
+            with open(patch, 'wb') as f:
+                f.write(data)
+    for entry in report:
+        logging.info('%s: hunk #%i %s: %s -> %s', entry['patch'], entry['hunk'],
+                     entry['status'], entry['from'], entry.get('to', '?'))
+    if directory:
+        write_file(os.path.join(directory, REFRESH_FILE),
+                   json.dumps(report, indent=2).encode('utf-8'))
 
 
 class CSProj(object):
@@ -374,6 +3329,18 @@ class CSProj(object):
         self.filename = filename
 
     def __enter__(self) -> Any:
+        return self.load()
+
+    def __exit__(self, exc_type: None, exc_val: None, traceback: None) -> None:
+        self.save()
+
+    def package_version(self, include: str) -> str:
+        # the version save() writes: the known packages' one
+        if include in PACKAGES:
+            return PACKAGES[include]['Version']
+        return self.package_references[include]['Version']
+
+    def load(self) -> 'CSProj':
         self.tree = lxml.etree.parse(self.filename)
         self.properties: dict[str, str] = {}
         self.disable_debug_symbols_in_release = False
@@ -418,7 +3385,7 @@ class CSProj(object):
             root.remove(e)
         return self
 
-    def __exit__(self, exc_type: None, exc_val: None, traceback: None) -> None:
+    def save(self) -> None:
         root = self.tree.getroot()
 
         if self.properties:
@@ -452,10 +3419,7 @@ class CSProj(object):
                 e = lxml.etree.Element('PackageReference')
                 # attrib dict has no order, but lxml respects set() order
                 e.set('Include', self.package_references[k]['Include'])
-                version = self.package_references[k]['Version']
-                if k in PACKAGES:
-                    version = PACKAGES[k]['Version']
-                e.set('Version', version)
+                e.set('Version', self.package_version(k))
                 package_references.append(e)
             root.append(package_references)
 
@@ -486,120 +3450,194 @@ class CSProj(object):
             root.append(contents)
 
         lxml.etree.indent(self.tree.getroot(), space='  ')
-        with open(self.filename, 'wb') as f:
-            f.write(lxml.etree.tostring(self.tree, pretty_print=True))
-
-
-def project(name: str) -> None:
-    with CSProj(os.path.join(name, '%s.csproj' % name)) as project:
-        # https://learn.microsoft.com/en-us/dotnet/standard/frameworks
-        # Target frameworks in SDK-style projects: net481, net8, net9
-        project.properties['TargetFramework'] = 'net9'
-        if 'DebugSymbols' in project.properties:
-            del project.properties['DebugSymbols']
-
-        if name in (
-            'Sandbox.Game',
-            'VRage',
-        ):
-            # https://aka.ms/binaryformatter
-            project.properties['EnableUnsafeBinaryFormatterSerialization'] = 'true'
-        if name in (
-            'SpaceEngineers',
-            'SpaceEngineersDedicated',
-            'VRage.Dedicated',
-            'VRage.Platform.Windows',
-            'VRage.RemoteClient.Core',
-            'VRageRemoteClient',
-        ):
-            project.properties['TargetFramework'] += '-windows'
-
-        project.package_references['DotNet.ReproducibleBuilds'] = {
-            'Include': 'DotNet.ReproducibleBuilds',
-            'Version': '1.2.25',
-            'PrivateAssets': 'All',
-        }
-        project.sdk = {
-            'Name': 'DotNet.ReproducibleBuilds.Isolated',
-            'Version': '1.2.25',
+        write_file(self.filename, lxml.etree.tostring(
+            self.tree, pretty_print=True))
+
+
+def project(name: str, project: CSProj, projects: Collection[str]) -> None:
+    # https://learn.microsoft.com/en-us/dotnet/standard/frameworks
+    # Target frameworks in SDK-style projects: net481, net8, net9
+    project.properties['TargetFramework'] = 'net9'
+    if 'DebugSymbols' in project.properties:
+        del project.properties['DebugSymbols']
+
+    if name in (
+        'Sandbox.Game',
+        'VRage',
+    ):
+        # https://aka.ms/binaryformatter
+        project.properties['EnableUnsafeBinaryFormatterSerialization'] = 'true'
+    if name in (
+        'SpaceEngineers',
+        'SpaceEngineersDedicated',
+        'VRage.Dedicated',
+        'VRage.Platform.Windows',
+        'VRage.RemoteClient.Core',
+        'VRageRemoteClient',
+    ):
+        project.properties['TargetFramework'] += '-windows'
+
+    project.package_references['DotNet.ReproducibleBuilds'] = {
+        'Include': 'DotNet.ReproducibleBuilds',
+        'Version': '1.2.25',
+        'PrivateAssets': 'All',
+    }
+    project.sdk = {
+        'Name': 'DotNet.ReproducibleBuilds.Isolated',
+        'Version': '1.2.25',
+    }
+    project.disable_debug_symbols_in_release = False
+
+    for include in sorted(project.references.keys()):
+        if 'HintPath' not in project.references[include]:
+            continue
+        hint_path = project.references[include]['HintPath']
+        basename = os.path.basename(hint_path)
+        project_name, _ = os.path.splitext(basename)
+        # replace references with project references we have source for
+        if project_name in projects:
+            del project.references[include]
+            csproj = os.path.join('..', project_name,
+                                  '%s.csproj' % project_name)
+            project.project_references.add(csproj)
+            continue
+        # replace known dependencies with the relative copy
+        if basename in COMPILE_DEPENDENCIES:
+            project.references[include] = {
+                'HintPath': os.path.join('..', 'dependencies', basename)}
+            continue
+        # replace known binary references with packages
+        if include in PACKAGES:
+            del project.references[include]
+            # may be different, e.g. ProtoBuf.Net -> protobuf-net
+            actual = PACKAGES[include]['Include']
+            project.package_references[actual] = PACKAGES[include]
+            continue
+        # ignore .NET Framework runtime
+        if '.NETFramework' in hint_path:
+            del project.references[include]
+            continue
+        raise Exception('%s: unexpected reference: %s, hint path %s' % (
+            name, include, hint_path))
+
+    def ensure_project(project_name: str, other: str) -> None:
+        if project_name == name:
+            csproj = os.path.join('..', other, '%s.csproj' % other)
+            project.project_references.add(csproj)
+
+    # mark XmlSerializers as dependencies so they get built
+    for project_name in sorted(projects):
+        if project_name.endswith('XmlSerializers'):
+            ensure_project('SpaceEngineers', project_name)
+            ensure_project('SpaceEngineersDedicated', project_name)
+
+    def ensure_package(project_name: str, include: str) -> None:
+        if project_name == name:
+            project.package_references[include] = PACKAGES[include]
+
+    ensure_package('VRage.Dedicated', 'Core.System.ServiceProcess')
+    ensure_package('VRage.Dedicated',
+                   'System.ServiceProcess.ServiceController')
+    ensure_package('VRage.Library', 'protobuf-net')
+    ensure_package('VRage.Platform.Windows', 'System.Management')
+    ensure_package('VRage.RemoteClient.Core',
+                   'System.Windows.Forms.DataVisualization')
+
+    def ensure_reference(project_name: str, include: str, hint_path: str) -> None:
+        if project_name == name:
+            project.references[include] = {
+                'HintPath': os.path.join('..', 'dependencies', hint_path)}
+
+    ensure_reference('VRageRemoteClient',
+                     'TelerikCommon', 'TelerikCommon.dll')
+
+    def copy_dependency(project_name: str, path: str) -> None:
+        if project_name == name:
+            project.copy.add(os.path.join('..', 'dependencies', path))
+
+    for dep in RUNTIME_DEPENDENCIES:
+        copy_dependency('SpaceEngineers', dep)
+    for dep in SERVER_RUNTIME_DEPENDENCIES:
+        copy_dependency('SpaceEngineersDedicated', dep)
+
+
+# The projects with their references. Each .csproj is loaded once, its
+# references, packages and dependencies are resolved in memory by project()
+# against the names of all the projects of the tree, then it's written back.
+# Projects are updated independently, in parallel by the pipeline.
+class ProjectGraph(object):
+
+    def __init__(self, workspace: Workspace, names: Collection[str]):
+        self.workspace = workspace
+        self.names = set(names)
+        self.projects: dict[str, CSProj] = {}
+        self.lock = threading.Lock()
+
+    def update(self, name: str) -> None:
+        filename = os.path.join(name, '%s.csproj' % name)
+        with profiler.span('csproj', 'load %s' % name):
+            csproj = CSProj(filename).load()
+        project(name, csproj, self.names)
+        with profiler.span('csproj', 'save %s' % name):
+            csproj.save()
+        self.workspace.add(filename)
+        with self.lock:
+            self.projects[name] = csproj
+
+    def references(self, name: str) -> List[str]:
+        # project references are ../<name>/<name>.csproj
+        return sorted(n for n in (
+            os.path.basename(os.path.dirname(path))
+            for path in self.projects[name].project_references)
+            if n in self.projects)
+
+    def levels(self) -> List[List[str]]:
+        # projects in build order, each level only references earlier levels
+        sorter = graphlib.TopologicalSorter(
+            {name: self.references(name) for name in self.projects})
+        sorter.prepare()
+        levels = []
+        while sorter.is_active():
+            level = sorted(sorter.get_ready())
+            sorter.done(*level)
+            levels.append(level)
+        return levels
+
+    def export(self, filename: str) -> None:
+        logging.info('project graph: %s', filename)
+        levels = self.levels()
+        if filename.endswith('.dot'):
+            lines = ['digraph projects {']
+            for name in sorted(self.projects):
+                lines.append('  "%s";' % name)
+                for reference in self.references(name):
+                    lines.append('  "%s" -> "%s";' % (name, reference))
+            lines.append('}')
+            with open(filename, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            return
+        graph = {
+            'projects': {name: {
+                'path': self.projects[name].filename,
+                'references': self.references(name),
+                'packages': {v['Include']: self.projects[name].package_version(k)
+                             for k, v in self.projects[name].package_references.items()},
+                'dependencies': sorted(
+                    os.path.basename(r['HintPath'])
+                    for r in self.projects[name].references.values()
+                    if 'HintPath' in r),
+                'copy': sorted(os.path.basename(c)
+                               for c in self.projects[name].copy),
+            } for name in sorted(self.projects)},
+            'order': [name for level in levels for name in level],
+            'levels': levels,
         }
-        project.disable_debug_symbols_in_release = False
+        with open(filename, 'w') as f:
+            json.dump(graph, f, indent=2)
+            f.write('\n')
 
-        for include in sorted(project.references.keys()):
-            if 'HintPath' not in project.references[include]:
-                continue
-            hint_path = project.references[include]['HintPath']
-            basename = os.path.basename(hint_path)
-            project_name, _ = os.path.splitext(basename)
-            # replace references with project references we have source for
-            if os.path.exists(project_name):
-                del project.references[include]
-                csproj = os.path.join('..', project_name,
-                                      '%s.csproj' % project_name)
-                project.project_references.add(csproj)
-                continue
-            # replace known dependencies with the relative copy
-            if basename in COMPILE_DEPENDENCIES:
-                project.references[include] = {
-                    'HintPath': os.path.join('..', 'dependencies', basename)}
-                continue
-            # replace known binary references with packages
-            if include in PACKAGES:
-                del project.references[include]
-                # may be different, e.g. ProtoBuf.Net -> protobuf-net
-                actual = PACKAGES[include]['Include']
-                project.package_references[actual] = PACKAGES[include]
-                continue
-            # ignore .NET Framework runtime
-            if '.NETFramework' in hint_path:
-                del project.references[include]
-                continue
-            raise Exception('%s: unexpected reference: %s, hint path %s' % (
-                name, include, hint_path))
-
-        def ensure_project(project_name: str, other: str) -> None:
-            if project_name == name:
-                csproj = os.path.join('..', other, '%s.csproj' % other)
-                project.project_references.add(csproj)
-
-        # mark XmlSerializers as dependencies so they get built
-        for path in sorted(glob.glob(os.path.join('*', '*.csproj'))):
-            project_name = os.path.basename(os.path.dirname(path))
-            if project_name.endswith('XmlSerializers'):
-                ensure_project('SpaceEngineers', project_name)
-                ensure_project('SpaceEngineersDedicated', project_name)
-
-        def ensure_package(project_name: str, include: str) -> None:
-            if project_name == name:
-                project.package_references[include] = PACKAGES[include]
-
-        ensure_package('VRage.Dedicated', 'Core.System.ServiceProcess')
-        ensure_package('VRage.Dedicated',
-                       'System.ServiceProcess.ServiceController')
-        ensure_package('VRage.Library', 'protobuf-net')
-        ensure_package('VRage.Platform.Windows', 'System.Management')
-        ensure_package('VRage.RemoteClient.Core',
-                       'System.Windows.Forms.DataVisualization')
-
-        def ensure_reference(project_name: str, include: str, hint_path: str) -> None:
-            if project_name == name:
-                project.references[include] = {
-                    'HintPath': os.path.join('..', 'dependencies', hint_path)}
-
-        ensure_reference('VRageRemoteClient',
-                         'TelerikCommon', 'TelerikCommon.dll')
-
-        def copy_dependency(project_name: str, path: str) -> None:
-            if project_name == name:
-                project.copy.add(os.path.join('..', 'dependencies', path))
-
-        for dep in RUNTIME_DEPENDENCIES:
-            copy_dependency('SpaceEngineers', dep)
-        for dep in SERVER_RUNTIME_DEPENDENCIES:
-            copy_dependency('SpaceEngineersDedicated', dep)
-
-
-def create_solution(filename: str) -> None:
+
+def create_solution(workspace: Workspace, filename: str) -> None:
     logging.info('creating solution')
 
     solution = lxml.etree.Element('Solution')
@@ -612,26 +3650,157 @@ def create_solution(filename: str) -> None:
     configurations.append(lxml.etree.Element(
         'BuildType', attrib={'Name': 'Release'}))
 
-    for path in sorted(glob.glob(os.path.join('*', '*.csproj'))):
+    for path in workspace.glob(os.path.join('*', '*.csproj')):
         project = lxml.etree.Element('Project', attrib={'Path': path})
         solution.append(project)
 
     lxml.etree.indent(solution, space='  ')
-    with open(filename, 'wb') as f:
-        f.write(lxml.etree.tostring(solution, pretty_print=True))
-    fix_permissions(filename)
-
-
-def fix_permissions(path: str) -> None:
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            assert mode == 0o644  # rw-r--r--
-            os.chmod(os.path.join(root, file), mode)
-        for directory in dirs:
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
-            assert mode == 0o755  # rwxr-xr-x
-            os.chmod(os.path.join(root, directory), mode)
+    write_file(filename, lxml.etree.tostring(solution, pretty_print=True))
+    workspace.add(filename)
+    fix_permissions(workspace, filename)
+
+
+# decompile.py --build: each project is built with dotnet build in the staging
+# tree as soon as it's final and the projects it references are built, the
+# build servers (MSBuild nodes, the compiler server) kept warm from one to the
+# next. Their outputs go to .decompile/build (by the Directory.Build.props
+# there, which only the staging tree sees) so that the next run builds
+# incrementally, with a binary log of each. The logs are then summarized into
+# the compile times of the projects, and the errors are mapped to what last
+# changed their file: a patch, fix rules, or else the stage which wrote it.
+BUILD_DIR = 'build'
+BUILD_ARGS = ['--configuration', 'Release', '--no-dependencies',
+              '-p:RestoreRecursive=false', '-p:EnableWindowsTargeting=true',
+              '-p:WarningLevel=0', '-maxCpuCount', '-nologo']
+BUILD_PROPS = b'''<Project>
+  <!-- by decompile.py: the outputs of the builds of its staging tree -->
+  <PropertyGroup>
+    <BaseIntermediateOutputPath>$(MSBuildThisFileDirectory)build/obj/$(MSBuildProjectName)/</BaseIntermediateOutputPath>
+    <BaseOutputPath>$(MSBuildThisFileDirectory)build/bin/$(MSBuildProjectName)/</BaseOutputPath>
+  </PropertyGroup>
+  <Import Project="$([MSBuild]::GetPathOfFileAbove('Directory.Build.props', '$(MSBuildThisFileDirectory)..'))"
+          Condition="'$([MSBuild]::GetPathOfFileAbove('Directory.Build.props', '$(MSBuildThisFileDirectory)..'))' != ''" />
+</Project>
+'''
+
+
+class Builder(object):
+
+    def __init__(self, directory: str, previous: dict[str, dict[str, Any]]):
+        # directory is .decompile, previous the manifest's files
+        self.directory = os.path.join(directory, BUILD_DIR)
+        self.previous = previous
+        self.logs = os.path.join(self.directory, 'logs')
+        # whether each project built, once it's done
+        self.built: dict[str, concurrent.futures.Future[bool]] = {}
+        self.failed: List[str] = []
+        props = os.path.join(directory, 'Directory.Build.props')
+        if not os.path.exists(props) or pathlib.Path(props).read_bytes() != BUILD_PROPS:
+            write_file(props, BUILD_PROPS)
+        os.makedirs(self.logs, exist_ok=True)
+
+    def expect(self, names: Collection[str]) -> None:
+        # the projects which will be built: those referencing them wait
+        for name in names:
+            self.built[name] = concurrent.futures.Future()
+
+    def start(self, graph: 'ProjectGraph', name: str) -> None:
+        references = sorted(n for n in (
+            os.path.basename(os.path.dirname(path))
+            for path in graph.projects[name].project_references)
+            if n in self.built)
+        runner.submit(self.build(name, references))
+
+    async def build(self, name: str, references: List[str]) -> None:
+        future = self.built[name]
+        binlog = os.path.join(self.logs, '%s.binlog' % name)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(binlog)  # of the previous run
+        try:
+            for reference in references:
+                if not await asyncio.wrap_future(self.built[reference]):
+                    logging.warning('not built: %s, %s failed', name,
+                                    reference)
+                    future.set_result(False)
+                    return
+            logging.info('build: %s', name)
+            await runner.run(
+                ['dotnet', 'build', os.path.abspath(
+                    os.path.join(name, '%s.csproj' % name))] + BUILD_ARGS +
+                ['-bl:%s' % binlog], 'dotnet build %s' % name,
+                subprocess.DEVNULL, None, None, BUILD_TIMEOUT)
+            logging.info('built: %s', name)
+            future.set_result(True)
+        except subprocess.SubprocessError:
+            logging.warning('build failed: %s', name)  # errors in report()
+            future.set_result(False)
+        except BaseException as e:
+            future.set_exception(e)
+
+    def report(self, workspace: Workspace) -> None:
+        self.failed = sorted(name for name, future in self.built.items()
+                             if not future.result())
+        binlogs = [os.path.join(self.logs, '%s.binlog' % name)
+                   for name in sorted(self.built)]
+        binlogs = [f for f in binlogs if os.path.exists(f)]
+        if not binlogs:
+            return
+        summary = json.loads(run([dotnet_tool('BuildLog')] + binlogs,
+                                 'BuildLog', stdout=subprocess.PIPE,
+                                 timeout=TOOL_TIMEOUT))
+        projects = []
+        errors = []
+        for project_file, project in summary.items():
+            name = os.path.splitext(os.path.basename(project_file))[0]
+            projects.append(dict(name=name, duration=project['duration'],
+                                 compile=project['compile'],
+                                 succeeded=project['succeeded'],
+                                 errors=len(project['errors'])))
+            for error in project['errors']:
+                path = os.path.relpath(error['file']) if error['file'] else ''
+                errors.append(dict(error, file=path, project=name,
+                                   origin=self.origin(workspace, path)))
+        projects.sort(key=lambda p: -p['compile'])
+        width = max([len(p['name']) for p in projects] + [7])
+        logging.info('%-*s %10s %10s %6s', width, 'project', 'wall (s)',
+                     'csc (s)', 'errors')
+        for p in projects:
+            logging.info('%-*s %10.3f %10.3f %6i', width, p['name'],
+                         p['duration'], p['compile'], p['errors'])
+        for e in errors:
+            logging.error('%s(%i,%i): error %s: %s [%s] (%s)', e['file'],
+                          e['line'], e['column'], e['code'], e['message'],
+                          e['project'], e['origin'])
+        write_file(os.path.join(self.directory, 'report.json'), json.dumps(
+            {'projects': projects, 'errors': errors}, indent=2).encode('utf-8'))
+
+    def origin(self, workspace: Workspace, path: str) -> str:
+        # the patch or fix rules which last changed path, or else the stage
+        # which wrote it, in this run or a previous one
+        if path in workspace.stages:
+            return workspace.origins.get(path) or workspace.stages[path]
+        previous = self.previous.get(path)
+        if previous:
+            return str(previous.get('origin') or previous['stage'])
+        return 'build'  # generated by the build itself, or not in the tree
+
+
+def fix_permissions(workspace: Workspace, path: str) -> None:
+    file_mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+    assert file_mode == 0o644  # rw-r--r--
+    dir_mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+    assert dir_mode == 0o755  # rwxr-xr-x
+    for name, st in workspace.walk(path):
+        if stat.S_ISDIR(st.st_mode):
+            mode = dir_mode
+        elif stat.S_ISREG(st.st_mode):
+            mode = file_mode
+        else:
+            continue
+        # only touch what differs, most files already have the right mode
+        if stat.S_IMODE(st.st_mode) != mode:
+            os.chmod(os.path.join(workspace.root, name), mode)
+            workspace.add(name)
 
 
 if __name__ == '__main__':
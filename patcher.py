@@ -0,0 +1,626 @@
+# Apply unified diffs in-process, like patch -p1 --binary -f.
+#
+# Lines are compared as bytes, line endings included (--binary). Hunks are
+# located like GNU patch: at the expected line shifted by the offset of the
+# previous hunk, then searching outwards, then ignoring up to 2 lines of
+# leading and trailing context (fuzz). Failed hunks are returned instead of
+# being written to .rej files, and nothing is written until commit().
+
+import difflib
+import os
+import re
+import shutil
+import time
+import zlib
+
+from typing import Any, List, Optional, Tuple
+
+MAX_FUZZ = 2
+
+# relocation of failed hunks: windows of lines compared without indentation
+WINDOW = 3
+BASE = 1000003
+MODULUS = (1 << 61) - 1
+MAX_HITS = 50  # windows seen more often than this don't locate anything
+CONTEXT = 3
+
+HUNK_HEADER = re.compile(
+    rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@([^\r\n]*)')
+
+
+class Hunk(object):
+
+    def __init__(self, old_start: int, new_start: int, lines: List[bytes],
+                 heading: bytes = b''):
+        self.old_start = old_start
+        self.new_start = new_start
+        # ' ', '-' or '+' followed by the line, with its line ending
+        self.lines = lines
+        self.heading = heading  # after @@, usually the enclosing declaration
+
+    def old(self) -> List[bytes]:
+        return [line[1:] for line in self.lines if line[:1] in b' -']
+
+    def new(self) -> List[bytes]:
+        return [line[1:] for line in self.lines if line[:1] in b' +']
+
+    def context(self) -> Tuple[int, int]:
+        # leading and trailing context lines
+        prefix = 0
+        while prefix < len(self.lines) and self.lines[prefix][:1] == b' ':
+            prefix += 1
+        if prefix == len(self.lines):
+            return prefix, prefix
+        suffix = 0
+        while self.lines[-1 - suffix][:1] == b' ':
+            suffix += 1
+        return prefix, suffix
+
+
+class FilePatch(object):
+
+    def __init__(self, old_path: str, new_path: str):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks: List[Hunk] = []
+
+    def created(self) -> bool:
+        return self.old_path == '/dev/null'
+
+    def deleted(self) -> bool:
+        return self.new_path == '/dev/null'
+
+    def paths(self) -> List[str]:
+        # candidates in order of preference, stripped like -p1
+        names = [self.old_path, self.new_path]
+        if self.created():
+            names = [self.new_path]
+        elif self.deleted():
+            names = [self.old_path]
+        return [strip(name) for name in names]
+
+
+class Rejected(object):
+
+    def __init__(self, patch: str, path: str, number: int,
+                 hunk: Optional[Hunk], reason: str):
+        self.patch = patch
+        self.path = path
+        self.number = number  # 1-based like patch, 0 for the whole file
+        self.hunk = hunk
+        self.reason = reason
+
+    def __str__(self) -> str:
+        if self.hunk is None:
+            return '%s: %s: %s' % (self.patch, self.path, self.reason)
+        return '%s: %s: hunk #%i %s' % (self.patch, self.path, self.number,
+                                        self.reason)
+
+
+def strip(path: str) -> str:
+    # -p1
+    parts = path.split('/', 1)
+    return parts[1] if len(parts) > 1 else path
+
+
+def split_lines(data: bytes) -> List[bytes]:
+    # keep line endings, and don't split on \r unlike bytes.splitlines()
+    lines = [line + b'\n' for line in data.split(b'\n')]
+    last = lines.pop()[:-1]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def header_path(line: bytes) -> str:
+    # '--- a/path\tdate'
+    return line[4:].rstrip(b'\r\n').split(b'\t')[0].decode('utf-8')
+
+
+def parse(filename: str) -> List[FilePatch]:
+    with open(filename, 'rb') as f:
+        lines = split_lines(f.read())
+    file_patches: List[FilePatch] = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith(b'--- ') and i < len(lines) and lines[i].startswith(b'+++ '):
+            file_patches.append(FilePatch(
+                header_path(line), header_path(lines[i])))
+            i += 1
+            continue
+        m = HUNK_HEADER.match(line)
+        if not m:
+            continue  # garbage between patches, like patch
+        if not file_patches:
+            raise Exception('%s:%i: hunk without file header' % (filename, i))
+        old_start, old_len, new_start, new_len = (
+            int(g) if g is not None else 1 for g in m.groups()[:4])
+        hunk_lines: List[bytes] = []
+        while i < len(lines) and (old_len > 0 or new_len > 0 or lines[i].startswith(b'\\')):
+            line = lines[i]
+            i += 1
+            if line.startswith(b'\\'):
+                # \ No newline at end of file
+                if hunk_lines:
+                    hunk_lines[-1] = hunk_lines[-1].rstrip(b'\n')
+                continue
+            if line in (b'\n', b'\r\n'):
+                line = b' ' + line  # empty context line, trailing space lost
+            kind = line[:1]
+            if kind == b' ':
+                old_len -= 1
+                new_len -= 1
+            elif kind == b'-':
+                old_len -= 1
+            elif kind == b'+':
+                new_len -= 1
+            else:
+                raise Exception('%s:%i: malformed hunk line' % (filename, i))
+            hunk_lines.append(line)
+        if old_len != 0 or new_len != 0:
+            raise Exception('%s:%i: truncated hunk' % (filename, i))
+        file_patches[-1].hunks.append(
+            Hunk(old_start, new_start, hunk_lines, m.group(5)))
+    return file_patches
+
+
+def match(lines: List[bytes], pattern: List[bytes], where: int,
+          prefix_fuzz: int, suffix_fuzz: int) -> bool:
+    # where is 0-based here
+    if where < 0 or where + len(pattern) - suffix_fuzz > len(lines):
+        return False
+    for i in range(prefix_fuzz, len(pattern) - suffix_fuzz):
+        if lines[where + i] != pattern[i]:
+            return False
+    return True
+
+
+def locate(lines: List[bytes], hunk: Hunk, pattern: List[bytes], offset: int,
+           frozen: int, fuzz: int) -> Optional[Tuple[int, int, int]]:
+    # GNU patch locate_hunk(): returns (0-based position, prefix fuzz, suffix
+    # fuzz), positions before frozen are already patched
+    prefix_context, suffix_context = hunk.context()
+    context = max(prefix_context, suffix_context)
+    prefix_fuzz = fuzz + prefix_context - context
+    suffix_fuzz = fuzz + suffix_context - context
+    first = hunk.old_start if pattern else hunk.old_start + 1
+    guess = first + offset  # 1-based
+    if not pattern:
+        return guess - 1, 0, 0
+    max_where = len(lines) - (len(pattern) - suffix_fuzz) + 1
+    min_where = frozen + 1
+    max_pos = max_where - guess
+    max_neg = min(guess - min_where, guess - 1)
+
+    if prefix_fuzz < 0 and hunk.old_start <= 1:
+        # can only match the start of the file
+        if suffix_fuzz < 0 and (len(pattern) != len(lines) or prefix_context < frozen):
+            return None
+        if frozen <= prefix_context and 1 - guess <= max_pos and match(
+                lines, pattern, 0, 0, max(suffix_fuzz, 0)):
+            return 0, 0, max(suffix_fuzz, 0)
+        return None
+    prefix_fuzz = max(prefix_fuzz, 0)
+
+    if suffix_fuzz < 0:
+        # can only match the end of the file
+        where = len(lines) - len(pattern)
+        if where >= 0 and guess - 1 - where <= max_neg and match(
+                lines, pattern, where, prefix_fuzz, 0):
+            return where, prefix_fuzz, 0
+        return None
+
+    for delta in range(max(max_pos, max_neg) + 1):
+        if delta <= max_pos and match(lines, pattern, guess - 1 + delta,
+                                      prefix_fuzz, suffix_fuzz):
+            return guess - 1 + delta, prefix_fuzz, suffix_fuzz
+        if 0 < delta <= max_neg and match(lines, pattern, guess - 1 - delta,
+                                          prefix_fuzz, suffix_fuzz):
+            return guess - 1 - delta, prefix_fuzz, suffix_fuzz
+    return None
+
+
+def locate_hunks(lines: List[bytes], hunks: List[Hunk]) -> List[Optional[int]]:
+    # 0-based position of the old lines of each hunk, None if it fails
+    positions: List[Optional[int]] = []
+    offset = 0
+    frozen = 0  # 1-based, last line consumed by a hunk
+    for hunk in hunks:
+        pattern = hunk.old()
+        prefix_context, suffix_context = hunk.context()
+        found = None
+        for fuzz in range(min(MAX_FUZZ, max(prefix_context, suffix_context)) + 1):
+            found = locate(lines, hunk, pattern, offset, frozen, fuzz)
+            if found is not None:
+                break
+        if found is None:
+            positions.append(None)
+            continue
+        where, _, _ = found
+        positions.append(where)
+        first = hunk.old_start if pattern else hunk.old_start + 1
+        offset = where + 1 - first
+        if prefix_context < len(hunk.lines):
+            frozen = where + len(pattern) - suffix_context
+    return positions
+
+
+def patch_lines(lines: List[bytes], located: List[Tuple[int, Hunk]]) -> List[bytes]:
+    # apply hunks at their (0-based, increasing) positions
+    patched = []
+    end = 0
+    for where, hunk in located:
+        prefix_context, suffix_context = hunk.context()
+        if prefix_context == len(hunk.lines):
+            continue  # context only
+        # only replace the changed lines, context stays as in the file
+        new = hunk.new()
+        start = where + prefix_context
+        patched += lines[end:start]
+        patched += new[prefix_context:len(new) - suffix_context]
+        end = where + len(hunk.old()) - suffix_context
+    patched += lines[end:]
+    return patched
+
+
+def apply_hunks(lines: List[bytes], hunks: List[Hunk]) -> Tuple[List[bytes], List[Tuple[int, Hunk]]]:
+    # returns the patched lines and the failed (1-based number, hunk)
+    positions = locate_hunks(lines, hunks)
+    located = [(p, h) for p, h in zip(positions, hunks) if p is not None]
+    failed = [(number, h) for number, (p, h) in enumerate(
+        zip(positions, hunks), 1) if p is None]
+    if not located:
+        return lines, failed
+    return patch_lines(lines, located), failed
+
+
+# In-memory view of the files under root, written by commit().
+class Tree(object):
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files: dict[str, Optional[bytes]] = {}
+        self.changed: set[str] = set()
+        # the patches which changed each file, in order
+        self.patches: dict[str, List[str]] = {}
+
+    def read(self, path: str) -> Optional[bytes]:
+        if path not in self.files:
+            try:
+                with open(os.path.join(self.root, path), 'rb') as f:
+                    self.files[path] = f.read()
+            except FileNotFoundError:
+                self.files[path] = None
+        return self.files[path]
+
+    def write(self, path: str, data: Optional[bytes], name: str) -> None:
+        self.files[path] = data
+        self.changed.add(path)
+        if name not in self.patches.setdefault(path, []):
+            self.patches[path].append(name)
+
+    def changes(self) -> dict[str, Optional[bytes]]:
+        return {path: self.files[path] for path in sorted(self.changed)}
+
+    def origins(self) -> dict[str, List[str]]:
+        return {path: self.patches[path] for path in sorted(self.changed)}
+
+
+def apply(tree: Tree, filename: str, name: str,
+          only: Optional[set[str]] = None) -> List[Rejected]:
+    # only: the files to patch, the others are left alone
+    rejected = []
+    for file_patch in parse(filename):
+        paths = file_patch.paths()
+        if only is not None and only.isdisjoint(os.path.normpath(p) for p in paths):
+            continue
+        path = next((p for p in paths if tree.read(p) is not None), paths[0])
+        data = tree.read(path)
+        if data is None and not file_patch.created():
+            for number, hunk in enumerate(file_patch.hunks, 1):
+                rejected.append(Rejected(name, path, number, hunk,
+                                         "FAILED, can't find file to patch"))
+            continue
+        patched, failed = apply_hunks(split_lines(data or b''),
+                                      file_patch.hunks)
+        for number, hunk in failed:
+            rejected.append(Rejected(name, path, number, hunk,
+                                     'FAILED at %i' % hunk.old_start))
+        if len(failed) == len(file_patch.hunks):
+            continue
+        if file_patch.deleted() and not patched:
+            tree.write(path, None, name)
+        else:
+            tree.write(path, b''.join(patched), name)
+    return rejected
+
+
+def dry_run(root: str, patches: List[Tuple[str, str]],
+            timings: Optional[List[Tuple[str, float, float, float]]] = None,
+            only: Optional[set[str]] = None) -> Tuple[dict[str, Optional[bytes]], List[Rejected], dict[str, List[str]]]:
+    # apply (filename, name) patches in order, in memory; timings gets the
+    # (name, start time, wall time, CPU time) of each patch. Also returns the
+    # names of the patches which changed each file, those of which a hunk
+    # applied to it.
+    tree = Tree(root)
+    rejected = []
+    for filename, name in patches:
+        start, cpu = time.time(), time.thread_time()
+        rejected += apply(tree, filename, name, only)
+        if timings is not None:
+            timings.append((name, start, time.time() - start,
+                            time.thread_time() - cpu))
+    return tree.changes(), rejected, tree.origins()
+
+
+def commit(root: str, changes: dict[str, Optional[bytes]]) -> None:
+    for path, data in changes.items():
+        filename = os.path.join(root, path)
+        if data is None:
+            if os.path.exists(filename):
+                os.remove(filename)
+            continue
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        # replace the file rather than writing through it, it may be a
+        # hardlink
+        tmp = '%s.%i.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        os.replace(tmp, filename)
+
+
+# Relocate failed hunks, possibly in another file, for --refresh-patches.
+#
+# Windows of WINDOW consecutive lines of the failed hunks are hashed first,
+# then a single pass of rolling hashes over the tree records where those
+# windows occur. Each hit votes for a hunk start, and the best candidates are
+# checked by aligning the hunk with the file lines.
+
+
+def normalize(line: bytes) -> bytes:
+    return line.strip()
+
+
+def window_hashes(lines: List[bytes]) -> List[int]:
+    # hash of lines[i:i + WINDOW] for each i
+    power = pow(BASE, WINDOW - 1, MODULUS)
+    hashes = []
+    h = 0
+    values = [zlib.crc32(normalize(line)) for line in lines]
+    for i, value in enumerate(values):
+        if i >= WINDOW:
+            h = (h - values[i - WINDOW] * power) % MODULUS
+        h = (h * BASE + value) % MODULUS
+        if i >= WINDOW - 1:
+            hashes.append(h)
+    return hashes
+
+
+def trivial(lines: List[bytes]) -> bool:
+    # blank lines and braces are everywhere
+    return all(len(normalize(line)) <= 1 for line in lines)
+
+
+class Relocator(object):
+
+    def __init__(self, hunks: List[Hunk]):
+        self.queries: set[int] = set()
+        for hunk in hunks:
+            old = hunk.old()
+            for i, h in enumerate(window_hashes(old)):
+                if not trivial(old[i:i + WINDOW]):
+                    self.queries.add(h)
+        self.hits: dict[int, List[Tuple[str, int]]] = {}
+
+    def scan(self, path: str, data: bytes) -> None:
+        for i, h in enumerate(window_hashes(split_lines(data))):
+            if h in self.queries:
+                self.hits.setdefault(h, []).append((path, i))
+
+    def candidates(self, hunk: Hunk) -> List[Tuple[str, int]]:
+        # (path, 0-based start), most votes first
+        votes: dict[Tuple[str, int], int] = {}
+        for i, h in enumerate(window_hashes(hunk.old())):
+            hits = self.hits.get(h, [])
+            if len(hits) > MAX_HITS:
+                continue
+            for path, j in hits:
+                votes[(path, j - i)] = votes.get((path, j - i), 0) + 1
+        return sorted(votes, key=lambda k: (-votes[k], abs(k[1] + 1 - hunk.old_start)))
+
+
+def rebuild(hunk: Hunk, lines: List[bytes], start: int) -> Optional[Hunk]:
+    # the same change against lines around start: removed lines must all be
+    # found, context is taken from the file
+    old = hunk.old()
+    if not old:
+        return None
+    slack = max(10, len(old))
+    lo = max(0, start - slack)
+    hi = min(len(lines), start + len(old) + slack)
+    matcher = difflib.SequenceMatcher(
+        None, [normalize(line) for line in old],
+        [normalize(line) for line in lines[lo:hi]], autojunk=False)
+    mapping = {}
+    for i, j, n in matcher.get_matching_blocks():
+        for k in range(n):
+            mapping[i + k] = lo + j + k
+    if len(mapping) * 2 < len(old):
+        return None
+
+    removed = set()
+    anchors: dict[int, List[bytes]] = {}  # added lines after a file line
+    anchor = None
+    pending: List[bytes] = []
+    i = 0
+    for line in hunk.lines:
+        if line[:1] == b'+':
+            if anchor is None:
+                pending.append(line)
+            else:
+                anchors.setdefault(anchor, []).append(line)
+            continue
+        if i in mapping:
+            anchor = mapping[i]
+            if pending:
+                anchors.setdefault(anchor - 1, []).extend(pending)
+                pending = []
+        elif line[:1] == b'-':
+            return None
+        if line[:1] == b'-':
+            removed.add(mapping[i])
+        i += 1
+    if pending:
+        return None
+
+    first = min(mapping.values())
+    last = max(mapping.values())
+    out = anchors.get(first - 1, [])
+    for f in range(first, last + 1):
+        out.append((b'-' if f in removed else b' ') + lines[f])
+        out += anchors.get(f, [])
+    changes = [k for k, line in enumerate(out) if line[:1] != b' ']
+    if not changes:
+        return None
+    begin = max(0, changes[0] - CONTEXT)
+    end = min(len(out), changes[-1] + CONTEXT + 1)
+    leading = sum(1 for line in out[:begin] if line[:1] != b'+')
+    return Hunk(first + 1 + leading, 0, out[begin:end], hunk.heading)
+
+
+def format_hunks(old_path: str, new_path: str, hunks: List[Hunk]) -> bytes:
+    # hunks sorted by position, new line numbers are recomputed
+    out = [b'--- %s\n+++ %s\n' % (old_path.encode('utf-8'),
+                                  new_path.encode('utf-8'))]
+    delta = 0
+    for hunk in hunks:
+        old_len = len(hunk.old())
+        new_len = len(hunk.new())
+        # like diff: empty ranges start at the line before
+        old_start = hunk.old_start
+        if not old_len:
+            new_start = old_start + delta + 1
+        elif not new_len:
+            new_start = old_start + delta - 1
+        else:
+            new_start = old_start + delta
+
+        def span(start: int, n: int) -> bytes:
+            return b'%i' % start if n == 1 else b'%i,%i' % (start, n)
+
+        out.append(b'@@ -%s +%s @@%s\n' % (
+            span(old_start, old_len), span(max(new_start, 0), new_len),
+            hunk.heading))
+        for line in hunk.lines:
+            out.append(line)
+            if not line.endswith(b'\n'):
+                out.append(b'\n\\ No newline at end of file\n')
+        delta += new_len - old_len
+    return b''.join(out)
+
+
+def refresh(root: str, patches: List[Tuple[str, str]], relocator: Relocator) -> Tuple[dict[str, Optional[bytes]], List[Rejected], dict[str, List[str]], dict[str, bytes], List[dict[str, Any]]]:
+    # like dry_run(), relocating failed hunks; also returns the refreshed
+    # patches and a report of the failed hunks
+    tree = Tree(root)
+    rejected = []
+    refreshed = {}
+    report: List[dict[str, Any]] = []
+    for filename, name in patches:
+        file_patches = parse(filename)
+        # path -> header paths, [(position, hunk, (path, number, hunk as in
+        # the patch))] against the current tree
+        sections: dict[str, Tuple[str, str,
+                                  List[Tuple[int, Hunk, Tuple[str, int, Hunk]]]]] = {}
+        # path -> the hunks written back as they are: unresolved, or
+        # overlapping another one
+        unplaced: dict[str, List[Hunk]] = {}
+        # number -> the report's entry of the hunks which failed in place
+        entries: dict[int, dict[str, Any]] = {}
+        relocated = False
+        for file_patch in file_patches:
+            paths = file_patch.paths()
+            path = next((p for p in paths if tree.read(p) is not None),
+                        paths[0])
+            data = tree.read(path)
+            lines = split_lines(data or b'')
+            positions: List[Optional[int]] = [None] * len(file_patch.hunks)
+            if data is not None or file_patch.created():
+                positions = locate_hunks(lines, file_patch.hunks)
+            section = sections.setdefault(path, (
+                file_patch.old_path, file_patch.new_path, []))
+            for number, (where, hunk) in enumerate(zip(positions, file_patch.hunks), 1):
+                if where is not None:
+                    h = rebuild(hunk, lines, where)
+                    if h is None:
+                        h = Hunk(where + 1 if hunk.old() else where, 0,
+                                 hunk.lines, hunk.heading)
+                    section[2].append(
+                        (h.old_start - 1 if h.old() else where, h, (path, number, hunk)))
+                    continue
+                entry: dict[str, Any] = {
+                    'patch': name, 'hunk': number,
+                    'from': '%s:%i' % (path, hunk.old_start)}
+                report.append(entry)
+                entries[number] = entry
+                for candidate, start in relocator.candidates(hunk)[:5]:
+                    candidate_data = tree.read(candidate)
+                    if candidate_data is None:
+                        continue
+                    h = rebuild(hunk, split_lines(candidate_data), start)
+                    if h is None:
+                        continue
+                    entry['status'] = 'moved' if candidate != path else 'relocated'
+                    entry['to'] = '%s:%i' % (candidate, h.old_start)
+                    sections.setdefault(candidate, (
+                        'a/' + candidate, 'b/' + candidate, []))[2].append(
+                        (h.old_start - 1, h, (path, number, hunk)))
+                    relocated = True
+                    break
+                else:
+                    entry['status'] = 'unresolved'
+                    rejected.append(Rejected(name, path, number, hunk,
+                                             'FAILED at %i' % hunk.old_start))
+                    unplaced.setdefault(path, []).append(hunk)
+
+        kept: dict[str, List[Tuple[int, Hunk]]] = {}
+        for path, (_, _, located) in sections.items():
+            located.sort(key=lambda k: k[0])
+            # drop relocated hunks changing the same lines as another one,
+            # sharing context is fine
+            kept[path] = []
+            end = 0
+            for where, hunk, (origin, number, original) in located:
+                prefix_context, suffix_context = hunk.context()
+                if where + prefix_context < end:
+                    rejected.append(Rejected(name, origin, number, original,
+                                             'overlaps another hunk at %s:%i' % (
+                                                 path, hunk.old_start)))
+                    if number in entries:
+                        entries[number]['status'] = 'overlapping'
+                    unplaced.setdefault(origin, []).append(original)
+                    continue
+                kept[path].append((where, hunk))
+                end = where + len(hunk.old()) - suffix_context
+
+        out = []
+        for path, (old_path, new_path, _) in sections.items():
+            if kept[path]:
+                patched = patch_lines(
+                    split_lines(tree.read(path) or b''), kept[path])
+                if new_path == '/dev/null' and not patched:
+                    tree.write(path, None, name)
+                else:
+                    tree.write(path, b''.join(patched), name)
+            # the others stay in the patch, to be fixed by hand
+            hunks = [hunk for _, hunk in kept[path]] + unplaced.get(path, [])
+            if hunks:
+                out.append(format_hunks(old_path, new_path, sorted(
+                    hunks, key=lambda h: h.old_start)))
+        if relocated:
+            refreshed[filename] = b''.join(out)
+    return tree.changes(), rejected, tree.origins(), refreshed, report
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Tests of decompile.py which need neither the game nor .NET:
+#   python -m unittest test_decompile
+
+import os
+import tempfile
+import unittest
+
+import decompile
+import patcher
+
+ACTOR = r'\s*private class \w+_003C_003EActor'
+
+
+class RemoveBlockTest(unittest.TestCase):
+
+    def check(self, block: str) -> None:
+        s = 'public class Foo\n{\n\tpublic int X;%s\n\n\tpublic int Y;\n}\n'
+        self.assertEqual(decompile.remove_block(ACTOR, s % (
+            '\n\n\tprivate class Foo_003C_003EActor\n\t{\n%s\n\t}' % block)), s % '')
+
+    def test_braces(self) -> None:
+        self.check(
+            '\t\tpublic object CreateInstance()\n\t\t{\n\t\t\treturn new Foo();\n\t\t}')
+
+    def test_strings_and_comments(self) -> None:
+        self.check('\t\tstring a = "}";\n\t\tstring b = @"{""}";\n'
+                   "\t\tchar c = '}';\n\t\t// }\n\t\t/* { */")
+
+    def test_interpolated_strings(self) -> None:
+        self.check('\t\tstring a = $"{(b ? "}" : "{")}";')
+        self.check('\t\tstring a = $@"{(b ? "}" : "{")}"" }";')
+        self.check('\t\tstring a = @$"{{ {b:N2} }}";')
+        self.check('\t\tstring a = $"\\" {{ {$"{(b ? \'}\' : \'{\')}"} }}";')
+        self.check('\t\tstring a = $"{new Bar { X = 1 }.X}";')
+
+    def test_unbalanced(self) -> None:
+        # left as is, rather than cut anywhere
+        s = 'class Foo\n{\n\tprivate class Foo_003C_003EActor\n\t{\n\t\tstring a = $"{(b ? "}" : "{")}";\n'
+        self.assertEqual(decompile.remove_block(ACTOR, s), s)
+
+
+class PatchOriginsTest(unittest.TestCase):
+
+    def test_applied_hunks(self) -> None:
+        # a.patch changes A.cs, but its hunk of B.cs fails: B.cs is only
+        # b.patch's
+        with tempfile.TemporaryDirectory() as root:
+            for name in ['A.cs', 'B.cs']:
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write('one\ntwo\nthree\n')
+            patches = {
+                'a.patch': '--- a/A.cs\n+++ b/A.cs\n@@ -1,3 +1,3 @@\n one\n-two\n+2\n three\n'
+                '--- a/B.cs\n+++ b/B.cs\n@@ -1,3 +1,3 @@\n one\n-zwei\n+2\n three\n',
+                'b.patch': '--- a/B.cs\n+++ b/B.cs\n@@ -1,3 +1,3 @@\n one\n two\n-three\n+3\n',
+            }
+            for name, text in patches.items():
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write(text)
+            changes, rejected, origins = patcher.dry_run(
+                root, [(os.path.join(root, name), name) for name in patches])
+        self.assertEqual(sorted(changes), ['A.cs', 'B.cs'])
+        self.assertEqual([(r.patch, r.path) for r in rejected],
+                         [('a.patch', 'B.cs')])
+        self.assertEqual(origins, {'A.cs': ['a.patch'], 'B.cs': ['b.patch']})
+
+
+if __name__ == '__main__':
+    unittest.main()